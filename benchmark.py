@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# This script times the analysis, serialization and loading of images, on synthetic images of several sizes or on a JSON file.
+# Results can be written as JSON, and compared to the results of a previous run.
+#
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+import click_analysis
+import polygon_analysis
+from lib.model import to_dict, parse_dict, encode, parse_object, np_encoder, to_json
+from lib.synthetic import synthetic_images
+from lib.utils import load_js
+
+DEFAULT_SIZES="100,1000"
+DEFAULT_TOLERANCE=0.1
+
+# Number of images checked against the dense engine, which is slow
+CHECK_IMAGES=100
+
+# Batch sizes of click analysis
+BATCH_SIZES=(8, 32, 128)
+
+def best_time(func, repeat) :
+    """Best wall time of several runs, in seconds"""
+    res = None
+    for i in range(repeat) :
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        res = duration if res is None else min(res, duration)
+    return res
+
+def dumps(data) :
+    return json.dumps(data, default=np_encoder)
+
+def bench_codec(items, repeat) :
+    text = dumps(to_dict(items))
+    compact = dumps(encode(items, compact=True))
+
+    return {
+        "to_dict" : best_time(lambda : to_dict(items), repeat),
+        "encode" : best_time(lambda : encode(items), repeat),
+        "encode_compact" : best_time(lambda : encode(items, compact=True), repeat),
+        "parse_dict" : best_time(lambda : parse_dict(json.loads(text)), repeat),
+        "parse_object" : best_time(lambda : json.loads(text, object_hook=parse_object), repeat),
+        "parse_object_compact" : best_time(lambda : json.loads(compact, object_hook=parse_object), repeat)}
+
+def bench_files(items, repeat, folder) :
+    """Time writing and loading a JSON file of items"""
+    filename = os.path.join(folder, "bench.json")
+    return {
+        "to_json" : best_time(lambda : to_json(items, filename), repeat),
+        "load_js" : best_time(lambda : load_js(filename, use_cache=False), repeat)}
+
+def bench_analysis(imgs, repeat) :
+    """Time process_img of both analysis, without output of images"""
+    return {
+        "click_analysis" : best_time(lambda : list(click_analysis.process_img(img) for img in imgs), repeat),
+        "polygon_analysis" : best_time(lambda : list(polygon_analysis.process_img(img) for img in imgs), repeat)}
+
+def check_engines(imgs) :
+    """Check that the maximas and scores of the grid free engine (coarse to fine) are the ones of the dense engine"""
+    for img in imgs[:CHECK_IMAGES] :
+        click_x, click_y = img.click_coords()
+        matrix = click_analysis.density_matrix(click_x, click_y, engine=click_analysis.ENGINE_DENSE)
+        maxx, maxy = click_analysis.find_maximas(matrix)
+        x, y, scores = click_analysis.coarse_maximas(click_x, click_y)
+        # Order of maximas of equal scores may differ by rounding : compared as sorted points
+        expected = sorted(zip(maxx.tolist(), maxy.tolist(), matrix[maxy, maxx]))
+        actual = sorted(zip(x.tolist(), y.tolist(), scores))
+        if list(point[:2] for point in expected) != list(point[:2] for point in actual) :
+            raise RuntimeError("Coarse to fine maximas differ from dense engine on image %s" % img.id)
+        if not np.allclose(list(point[2] for point in expected), list(point[2] for point in actual), rtol=1e-9) :
+            raise RuntimeError("Coarse to fine scores differ from dense engine on image %s" % img.id)
+
+def bench_peaks(imgs, repeat) :
+    """Time the detection of maximas alone : peak_local_max() on the full matrix, versus the grid free engine"""
+    clicks = list(img.click_coords() for img in imgs)
+    matrices = list(click_analysis.density_matrix(click_x, click_y, engine=click_analysis.ENGINE_SEPARABLE) for click_x, click_y in clicks)
+    return {
+        "peaks_full_resolution" : best_time(lambda : list(click_analysis.find_maximas(matrix) for matrix in matrices), repeat),
+        "peaks_coarse_to_fine" : best_time(lambda : list(click_analysis.coarse_maximas(*coords) for coords in clicks), repeat)}
+
+def bench_engines(imgs, repeat) :
+    """Time click analysis with each engine"""
+    check_engines(imgs)
+    return {
+        "click_engine_%s" % engine : best_time(lambda : list(click_analysis.process_img(img, engine=engine) for img in imgs), repeat)
+        for engine in click_analysis.ENGINES if engine != click_analysis.ENGINE_DENSE}
+
+def bench_batch(imgs, repeat) :
+    """Time click analysis by batches of images, to compare with the 'separable' engine one image at a time"""
+    def run(size) :
+        for idx in range(0, len(imgs), size) :
+            click_analysis.process_batch(imgs[idx:idx + size])
+
+    return {"click_batch_%d" % size : best_time(lambda : run(size), repeat) for size in BATCH_SIZES}
+
+def bench_main(imgs, repeat, folder, args=[]) :
+    """Time main_process of both analysis, end to end, from input file to output file"""
+    infile = os.path.join(folder, "input.json")
+    outfile = os.path.join(folder, "output.json")
+    to_json(imgs, infile)
+
+    def run(main) :
+        main([infile, outfile, "--no-cache", "--quiet"] + args)
+
+    return {
+        "main_click_analysis" : best_time(lambda : run(click_analysis.main), repeat),
+        "main_polygon_analysis" : best_time(lambda : run(polygon_analysis.main), repeat)}
+
+BENCHMARKS = {
+    "codec" : lambda imgs, repeat, folder : bench_codec(imgs, repeat),
+    "files" : bench_files,
+    "analysis" : lambda imgs, repeat, folder : bench_analysis(imgs, repeat),
+    "engines" : lambda imgs, repeat, folder : bench_engines(imgs, repeat),
+    "peaks" : lambda imgs, repeat, folder : bench_peaks(imgs, repeat),
+    "batch" : lambda imgs, repeat, folder : bench_batch(imgs, repeat),
+    "main" : bench_main}
+
+
+def git_commit() :
+    try :
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError) :
+        return None
+
+def run_benchmarks(datasets, benchmarks, repeat) :
+    """Run benchmarks on each dataset.
+    :param datasets: Dict of name => list of items
+    :return: List of dicts with keys 'dataset', 'size', 'benchmark', 'seconds', 'ms_per_item'"""
+    res = []
+    for name, items in datasets.items() :
+        with tempfile.TemporaryDirectory() as folder :
+            for benchmark in benchmarks :
+                for key, seconds in BENCHMARKS[benchmark](items, repeat, folder).items() :
+                    res.append(dict(dataset=name, size=len(items), benchmark=key, seconds=seconds,
+                                    ms_per_item=1000 * seconds / max(len(items), 1)))
+                    print("%-12s %-24s %6d items %10.3f s %10.3f ms/item" % (
+                        name, key, len(items), seconds, res[-1]["ms_per_item"]), file=sys.stderr)
+    return res
+
+def compare(results, baseline, tolerance) :
+    """Print ratios of durations to a baseline.
+    :return: List of regressions : benchmarks slower than baseline by more than tolerance"""
+    reference = {(item["dataset"], item["benchmark"]) : item["seconds"] for item in baseline["results"]}
+    regressions = []
+    print("Compared to %s (%s) :" % (baseline["meta"].get("commit"), baseline["meta"].get("date")))
+    for item in results :
+        key = (item["dataset"], item["benchmark"])
+        if not key in reference :
+            continue
+        ratio = item["seconds"] / reference[key]
+        flag = ""
+        if ratio > 1 + tolerance :
+            regressions.append(key)
+            flag = "REGRESSION"
+        print("%-12s %-24s %6.2fx %s" % (key[0], key[1], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file', type=str, nargs="?", help="JSON file of images or results. Synthetic images are used by default")
+    parser.add_argument('--sizes', '-s', type=str, default=DEFAULT_SIZES, metavar="n1,n2,n3",
+                        help="Numbers of synthetic images. %s by default" % DEFAULT_SIZES)
+    parser.add_argument('--clicks', type=int, default=30, help="Clicks per synthetic image. 30 by default")
+    parser.add_argument('--polygons', type=int, default=6, help="Polygons per synthetic image. 6 by default")
+    parser.add_argument('--actors', type=int, default=20, help="Distinct actors of synthetic images. 20 by default")
+    parser.add_argument('--vertices', type=int, default=4, help="Vertices per polygon of synthetic images. 4 by default")
+    parser.add_argument('--benchmarks', '-b', type=str, default=",".join(BENCHMARKS), metavar="b1,b2",
+                        help="Benchmarks to run, among : %s. All by default" % ", ".join(BENCHMARKS))
+    parser.add_argument('--repeat', '-r', type=int, default=3, help="Number of runs of each benchmark. 3 by default")
+    parser.add_argument('--output', '-o', type=str, help="Write results to this JSON file")
+    parser.add_argument('--compare', '-c', type=str, metavar="baseline.json", help="Compare to results of a previous run")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="With --compare, exit with an error if a benchmark is slower by more than this ratio. %.1f by default" % DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    benchmarks = args.benchmarks.split(",")
+    for benchmark in benchmarks :
+        if not benchmark in BENCHMARKS :
+            parser.error("Unknown benchmark : %s" % benchmark)
+
+    params = dict(clicks=args.clicks, polygons=args.polygons, actors=args.actors, vertices=args.vertices)
+    if args.input_file :
+        datasets = {os.path.basename(args.input_file) : load_js(args.input_file, use_cache=False)}
+        # Only images can be analysed
+        if type(datasets[os.path.basename(args.input_file)][0]).__name__ != "Image" :
+            benchmarks = list(benchmark for benchmark in benchmarks if benchmark in ("codec", "files"))
+    else :
+        datasets = {"synth-%s" % size : synthetic_images(int(size), **params) for size in args.sizes.split(",")}
+
+    results = run_benchmarks(datasets, benchmarks, args.repeat)
+
+    meta = dict(
+        commit=git_commit(),
+        date=datetime.now().isoformat(timespec="seconds"),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        cpus=os.cpu_count(),
+        input_file=args.input_file,
+        params=params,
+        repeat=args.repeat)
+
+    if args.output :
+        with open(args.output, "w") as f :
+            json.dump(dict(meta=meta, results=results), f, indent=2)
+
+    if args.compare :
+        with open(args.compare) as f :
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance) :
+            sys.exit(1)
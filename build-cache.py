@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# This script converts input JSON files into binary caches of numpy arrays, mapped in memory when loaded.
+# Caches are picked up by load_js and analysis scripts, as long as the source file is unchanged.
+#
+import argparse
+
+from lib.cache import build_cache, is_valid, cache_path
+from lib.utils import iter_js
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_files', type=str, nargs="+", metavar="input.json", help="Input files")
+    parser.add_argument('--force', '-f', action="store_true", help="Rebuild caches that are up to date")
+    args = parser.parse_args()
+
+    for input_file in args.input_files :
+
+        if not args.force and is_valid(input_file) :
+            print("%s : cache is up to date" % input_file)
+            continue
+
+        count = build_cache(input_file, iter_js(input_file, compact=True, use_cache=False))
+        print("%s : %d images cached in %s" % (input_file, count, cache_path(input_file)))
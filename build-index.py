@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# This script builds the id index of JSON files of images or results : byte offset and length of each item, with metadata columns.
+# Indexes are used by --ids of analysis scripts and by notebooks, to read only the requested items. They are also built on first use.
+#
+import argparse
+
+from lib.index import build_index, is_valid, index_path
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_files', type=str, nargs="+", metavar="file.json", help="Input or result files")
+    parser.add_argument('--force', '-f', action="store_true", help="Rebuild indexes that are up to date")
+    args = parser.parse_args()
+
+    for input_file in args.input_files :
+
+        if not args.force and is_valid(input_file) :
+            print("%s : index is up to date" % input_file)
+            continue
+
+        count = build_index(input_file)
+        print("%s : %d items indexed in %s" % (input_file, count, index_path(input_file)))
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# This script applies the quality filters of metadata.ipynb to the raw metadata of installations (raw-metadata.csv),
+# and writes metadata.csv with the flags 'controlled', 'IGNControlled' and 'GoogleControlled'
+#
+import argparse
+import os
+
+import pandas as pd
+
+from lib.metadata import build_metadata, CAMPAIGNS, RAW_METADATA, JS_FILE_TEMPLATE
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_file', type=str, help="Output CSV file (metadata.csv)")
+    parser.add_argument('--input', type=str, default=RAW_METADATA, help="Raw metadata. %s by default" % RAW_METADATA)
+    for campaign in CAMPAIGNS :
+        default = JS_FILE_TEMPLATE.format(campaign=campaign.lower())
+        parser.add_argument('--%s' % campaign.lower(), type=str, default=default, metavar="polygon-analysis.json",
+                            help="Polygon analysis of the %s campaign. %s by default" % (campaign, default))
+    parser.add_argument('--projections', type=str, metavar="out_dir",
+                        help="Also write the projected surfaces of each campaign to projection-{campaign}.csv in this folder")
+    args = parser.parse_args()
+
+    table = pd.read_csv(args.input)
+    projections = build_metadata(table, {campaign : getattr(args, campaign.lower()) for campaign in CAMPAIGNS})
+    table.to_csv(args.output_file, index=None)
+
+    if args.projections :
+        os.makedirs(args.projections, exist_ok=True)
+        for campaign, projection in projections.items() :
+            projection.to_csv(os.path.join(args.projections, "projection-%s.csv" % campaign.lower()), index=None)
+
+    print("%d installations, %d controlled" % (len(table), table["controlled"].sum()) + "".join(
+        ", %d %sControlled" % (table["%sControlled" % campaign].sum(), campaign) for campaign in CAMPAIGNS))
@@ -1,133 +1,595 @@
 #!/usr/bin/env python
 import os
+from functools import lru_cache
 
 import matplotlib.pyplot as plt
 import numpy as np
 from skimage.feature import peak_local_max
 
+from lib import render
+from lib.io_stage import write_output, write_png
+from lib.metrics import stage
 from lib.model import Point, ClickResult
-from lib.utils import get_image, main_process, Phase, Campaign, Arg
+from lib.utils import load_image, main_process, Phase, Campaign, Arg, Memo, THRESHOLDS_ARG, display_key
 
 SIGMA=25
 WIDTH=400
 HEIGHT=400
 DEFAULT_THRESHOLD=2.0
 
+# Kernels are truncated at TRUNCATE * sigma (relative error < exp(-TRUNCATE**2 / 2))
+TRUNCATE=4.0
+
+# Density engines
+ENGINE_DENSE="dense"
+ENGINE_WINDOW="window"
+ENGINE_SEPARABLE="separable"
+ENGINE_COARSE="coarse"
+ENGINE_AUTO="auto"
+ENGINES=[ENGINE_AUTO, ENGINE_DENSE, ENGINE_WINDOW, ENGINE_SEPARABLE, ENGINE_COARSE]
+DEFAULT_ENGINE=ENGINE_AUTO
+
+# Engine 'auto' : coarse to fine up to this number of clicks, separable above
+COARSE_MAX_CLICKS=600
+
+# Engine 'coarse' : step of the coarse grid (pixels). Candidates are refined in a window of this radius
+COARSE_STEP=4
+
+# Images of a batch with up to this number of clicks are padded together
+BATCH_MIN_CLICKS=32
+
+# Analyses and source images displayed in notebooks, see prepare_display()
+DISPLAYS=Memo()
+
+# Version of the analysis : to be increased when results change, to invalidate cached results
+VERSION=3
+
 X=None
 Y=None
 
 
+@lru_cache(maxsize=8)
+def gaussian_kernel_1d(sigma) :
+    """Truncated 1D gaussian, equal to 1 at its center"""
+    radius = int(np.ceil(TRUNCATE * sigma))
+    offsets = np.arange(-radius, radius + 1)
+    return np.exp(-0.5 * offsets ** 2 / (sigma ** 2))
 
-def process_img(
-        img, out_folder=None, display=False, threshold=DEFAULT_THRESHOLD, sigma=SIGMA, campaign=Campaign.GOOGLE,
-        clicks_to_draw=None,
-        selected_idx=None,
-        **kargs):
+
+@lru_cache(maxsize=8)
+def gaussian_kernel(sigma) :
+    """Precomputed truncated 2D kernel, equal to 1 at its center"""
+    kernel = gaussian_kernel_1d(sigma)
+    return np.outer(kernel, kernel)
+
+
+@lru_cache(maxsize=8)
+def convolution_matrix(size, sigma) :
+    """Banded matrix M such that M @ v is the convolution of v with the truncated 1D kernel"""
+    kernel = gaussian_kernel_1d(sigma)
+    radius = kernel.shape[0] // 2
+    idx = np.arange(size)
+    offsets = idx[:, None] - idx[None, :]
+    return np.where(np.abs(offsets) <= radius, kernel[np.clip(offsets + radius, 0, 2 * radius)], 0)
+
+
+def on_grid(click_x, click_y) :
+    """Mask of clicks lying exactly on a pixel of the image"""
+    return (np.mod(click_x, 1) == 0) & (np.mod(click_y, 1) == 0) & \
+           (click_x >= 0) & (click_x < WIDTH) & (click_y >= 0) & (click_y < HEIGHT)
+
+
+def add_full_kernel(matrix, x, y, sigma) :
+    """Add the kernel of a click outside of the pixel grid.
+    Like the dense engine, it is normalized by its maximum within the image"""
+
+    # Distance to the closest pixel, for normalization
+    dx = x - np.clip(np.round(x), 0, WIDTH - 1)
+    dy = y - np.clip(np.round(y), 0, HEIGHT - 1)
+
+    kx = np.exp(-0.5 * ((np.arange(WIDTH) - x) ** 2 - dx ** 2) / (sigma ** 2))
+    ky = np.exp(-0.5 * ((np.arange(HEIGHT) - y) ** 2 - dy ** 2) / (sigma ** 2))
+    matrix += np.outer(ky, kx)
+
+
+def stamp_kernel(matrix, x, y, kernel) :
+    """Add a centered kernel at pixel (x, y), clipped to the borders of the matrix"""
+    radius = kernel.shape[0] // 2
+    height, width = matrix.shape
+
+    x0, x1 = max(x - radius, 0), min(x + radius + 1, width)
+    y0, y1 = max(y - radius, 0), min(y + radius + 1, height)
+
+    matrix[y0:y1, x0:x1] += kernel[
+        y0 - y + radius:y1 - y + radius,
+        x0 - x + radius:x1 - x + radius]
+
+
+def density_matrix(click_x, click_y, sigma=SIGMA, engine=DEFAULT_ENGINE) :
     """
+    Sum of gaussian kernels centered on clicks, each normalized to a maximum of 1.
 
-    :param img: Image object  metea data of image being processed
-    :param out: Output folder for output image : None if no output is requested
-    :param display: If true Display resulting output image
-    :param threshold: Threshold for detection of points. Eirger as absolute number (if > 1) or ratio of number of clicks (<1)
-    :param sigma: size of the kernels
-    :param campaign: "google" or "ign" : only used ig display=True, for showing source image
-    :return: result clicks or None if no match is found
+    :param engine:
+        'dense' : Reference implementation, evaluating each kernel over the full image.
+        'window' : Stamps a precomputed truncated kernel around each click.
+        'separable' : Splats clicks in an histogram and convolves it with a separable truncated kernel.
+    :return: Matrix of HEIGHT x WIDTH
     """
 
     global X, Y
 
-    if X is None :
-        X, Y = np.meshgrid(np.arange(0, WIDTH), np.arange(0, HEIGHT))
+    if engine == ENGINE_DENSE :
 
-    nb_clicks = len(img.clicks)
+        if X is None:
+            X, Y = np.meshgrid(np.arange(0, WIDTH), np.arange(0, HEIGHT))
 
-    # Clicks coordinates
-    click_x = np.array(list(click.x for click in img.clicks))
-    click_y = np.array(list(click.y for click in img.clicks))
+        matrix = np.zeros((WIDTH, HEIGHT))
+
+        for x, y in zip(click_x, click_y):
+            kernel = 1 / (2 * np.pi * sigma) * np.exp(-0.5 * ((X - x) ** 2 + (Y - y) ** 2) / (sigma ** 2))
+            matrix += kernel / np.max(kernel)
+
+        return matrix
 
-    # Work matrix
-    matrix = np.zeros((WIDTH, HEIGHT))
+    matrix = np.zeros((HEIGHT, WIDTH))
 
-    # Draw kernels at clicks
-    for x, y in zip(click_x, click_y):
-        kernel = 1 / (2 * np.pi * sigma) * np.exp(-0.5 * ((X - x) ** 2 + (Y - y) ** 2) / (sigma ** 2))
-        matrix += kernel / np.max(kernel)
+    click_x = np.asarray(click_x)
+    click_y = np.asarray(click_y)
 
-    # Find maximas
+    # Clicks between pixels or outside of the image need a kernel of their own
+    grid = on_grid(click_x, click_y)
+    for x, y in zip(click_x[~grid], click_y[~grid]) :
+        add_full_kernel(matrix, x, y, sigma)
+
+    grid_x = click_x[grid].astype(int)
+    grid_y = click_y[grid].astype(int)
+
+    if engine == ENGINE_WINDOW :
+        kernel = gaussian_kernel(sigma)
+        for x, y in zip(grid_x, grid_y) :
+            stamp_kernel(matrix, x, y, kernel)
+
+    elif engine == ENGINE_SEPARABLE :
+        hist = np.zeros((HEIGHT, WIDTH))
+        np.add.at(hist, (grid_y, grid_x), 1)
+        # Convolve rows then columns, as products with banded matrices
+        matrix += convolution_matrix(HEIGHT, sigma) @ hist @ convolution_matrix(WIDTH, sigma).T
+
+    else :
+        raise Exception("Unknown engine : %s" % engine)
+
+    return matrix
+
+
+def find_maximas(matrix) :
+    """Local maximas of the density matrix, as arrays of x and y"""
     res = peak_local_max(matrix)
-    maxy = res[:, 0]
-    maxx = res[:, 1]
+    return res[:, 1], res[:, 0]
+
+
+def select_engine(engine, nb_clicks) :
+    if engine == ENGINE_AUTO :
+        return ENGINE_COARSE if nb_clicks <= COARSE_MAX_CLICKS else ENGINE_SEPARABLE
+    return engine
+
+
+def kernel_norms(click_x, click_y, sigma) :
+    """Normalization of the kernel of each click, as in the dense engine : by its maximum over the pixels of the image"""
+    dx = click_x - np.clip(np.round(click_x), 0, WIDTH - 1)
+    dy = click_y - np.clip(np.round(click_y), 0, HEIGHT - 1)
+    return np.exp(0.5 * (dx ** 2 + dy ** 2) / (sigma ** 2))
+
+
+def point_density(x, y, click_x, click_y, norms, sigma) :
+    """Density at points (x, y), equal to the dense matrix at these points"""
+    d2 = (np.asarray(x, float)[..., None] - click_x) ** 2 + (np.asarray(y, float)[..., None] - click_y) ** 2
+    return np.exp(-0.5 * d2 / (sigma ** 2)) @ norms
+
+
+def coarse_maximas(click_x, click_y, sigma=SIGMA, step=COARSE_STEP) :
+    """Local maximas of the density, coarse to fine : the gradient of the density is computed on a grid of given step,
+    cells where it changes sign in both directions hold a mode, and are refined on the pixels of a window around them.
+    Same result as peak_local_max() on the dense matrix.
+    :return: Arrays of x, y and density of maximas, sorted by decreasing density"""
+
+    click_x = np.asarray(click_x, float)
+    click_y = np.asarray(click_y, float)
+    if len(click_x) == 0 :
+        return np.zeros(0, int), np.zeros(0, int), np.zeros(0)
+
+    norms = kernel_norms(click_x, click_y, sigma)
+
+    maximas = set()
+    for x, y in coarse_cells(click_x, click_y, norms, sigma, step) :
+        maximas.update(window_maximas(x, y, click_x, click_y, norms, sigma, radius=step))
+
+    return sort_maximas(maximas, click_x, click_y, norms, sigma)
+
+
+def coarse_cells(click_x, click_y, norms, sigma, step=COARSE_STEP) :
+    """Centers of the cells of the coarse grid of given step where the gradient of the density changes sign in both directions"""
+
+    # Coarse grid, including the last pixel
+    xs = np.append(np.arange(0, WIDTH - 1, step), WIDTH - 1)
+    ys = np.append(np.arange(0, HEIGHT - 1, step), HEIGHT - 1)
+
+    # Gradient of the density on the coarse grid, as products of separable kernels
+    kx = np.exp(-0.5 * (xs[None, :] - click_x[:, None]) ** 2 / (sigma ** 2))
+    ky = np.exp(-0.5 * (ys[:, None] - click_y[None, :]) ** 2 / (sigma ** 2)) * norms
+    grad_x = ky @ (kx * (click_x[:, None] - xs[None, :]))
+    grad_y = (ky * (click_y[None, :] - ys[:, None])) @ kx
+
+    # Cells where the gradient goes from positive to negative, along x and y
+    rising_x = (grad_x[:-1, :-1] > 0) | (grad_x[1:, :-1] > 0)
+    falling_x = (grad_x[:-1, 1:] <= 0) | (grad_x[1:, 1:] <= 0)
+    rising_y = (grad_y[:-1, :-1] > 0) | (grad_y[:-1, 1:] > 0)
+    falling_y = (grad_y[1:, :-1] <= 0) | (grad_y[1:, 1:] <= 0)
+
+    return list(((xs[i] + xs[i + 1]) // 2, (ys[j] + ys[j + 1]) // 2)
+                for j, i in zip(*np.nonzero(rising_x & falling_x & rising_y & falling_y)))
+
+
+def sort_maximas(maximas, click_x, click_y, norms, sigma) :
+    """Arrays of x, y and density of a set of maximas (x, y), in the order of peak_local_max() : decreasing density, then position"""
+    maxx = np.array(list(x for x, y in maximas), int)
+    maxy = np.array(list(y for x, y in maximas), int)
+    scores = point_density(maxx, maxy, click_x, click_y, norms, sigma)
+
+    order = np.lexsort((maxx, maxy, -scores))
+    return maxx[order], maxy[order], scores[order]
+
+
+def window_maximas(x, y, click_x, click_y, norms, sigma, radius) :
+    """Pixels of the window of given radius around (x, y) that are local maximas of their 3x3 neighbourhood.
+    Like peak_local_max(), the border of the image is excluded"""
+    xs = np.arange(max(x - radius - 1, 0), min(x + radius + 2, WIDTH))
+    ys = np.arange(max(y - radius - 1, 0), min(y + radius + 2, HEIGHT))
+    grid = point_density(xs[None, :], ys[:, None], click_x, click_y, norms, sigma)
+
+    # Maximum of the 3x3 neighbourhood of inner pixels
+    height, width = grid.shape
+    neighbours = np.max([grid[j:height - 2 + j, i:width - 2 + i] for j in range(3) for i in range(3)], axis=0)
+    is_max = grid[1:-1, 1:-1] >= neighbours
+
+    inner_x, inner_y = np.meshgrid(xs[1:-1], ys[1:-1])
+    is_max &= (np.abs(inner_x - x) <= radius) & (np.abs(inner_y - y) <= radius)
+    return list(zip(inner_x[is_max], inner_y[is_max]))
+
+
+def batch_density(coords, sigma=SIGMA) :
+    """Density matrices of several images at once, equal to the 'separable' engine.
+    The histogram of clicks convolved with the separable kernel is the product of the kernels of clicks along y and along x :
+    clicks of images are padded into arrays of (images, clicks), and each stack is computed by a single matmul.
+    Images are stacked by groups of similar numbers of clicks (see batch_groups()) : a busy image does not pad the others.
+    :param coords: List of (click_x, click_y) per image
+    :return: Array of len(coords) x HEIGHT x WIDTH"""
+
+    groups = batch_groups(list(len(x) for x, y in coords))
+    if len(groups) <= 1 :
+        return padded_density(coords, sigma)
+
+    res = np.empty((len(coords), HEIGHT, WIDTH))
+    for group in groups :
+        res[group] = padded_density(list(coords[idx] for idx in group), sigma)
+    return res
+
+
+def batch_groups(counts) :
+    """Indices of images grouped by number of clicks, such that padding a group to its largest image
+    at most doubles its clicks, or adds at most BATCH_MIN_CLICKS clicks per image"""
+    groups = []
+    limit = -1
+    for idx in np.argsort(counts, kind="stable") :
+        if counts[idx] > limit :
+            groups.append([])
+            limit = max(2 * counts[idx], BATCH_MIN_CLICKS)
+        groups[-1].append(idx)
+    return groups
+
+
+def padded_density(coords, sigma) :
+    """Density matrices of images padded to the same number of clicks, by a single matmul"""
+
+    nb_clicks = max((len(x) for x, y in coords), default=0)
+    click_x = np.zeros((len(coords), nb_clicks))
+    click_y = np.zeros((len(coords), nb_clicks))
+    # Padding clicks have a weight of 0
+    weights = np.zeros((len(coords), nb_clicks))
+    for idx, (x, y) in enumerate(coords) :
+        click_x[idx, :len(x)] = x
+        click_y[idx, :len(y)] = y
+        weights[idx, :len(x)] = kernel_norms(np.asarray(x, float), np.asarray(y, float), sigma)
+
+    dx = np.arange(WIDTH)[None, None, :] - click_x[:, :, None]
+    dy = np.arange(HEIGHT)[None, :, None] - click_y[:, None, :]
+    kx = np.exp(-0.5 * dx ** 2 / (sigma ** 2))
+    ky = np.exp(-0.5 * dy ** 2 / (sigma ** 2)) * weights[:, None, :]
+
+    # Kernels of clicks on the grid are truncated, as in the separable engine. Others are full, as in add_full_kernel()
+    radius = gaussian_kernel_1d(sigma).shape[0] // 2
+    grid = on_grid(click_x, click_y)
+    kx[grid[:, :, None] & (np.abs(dx) > radius)] = 0
+    ky[grid[:, None, :] & (np.abs(dy) > radius)] = 0
+
+    return ky @ kx
+
+
+def batch_maximas(matrices) :
+    """Local maximas of a stack of matrices, as found by peak_local_max() on each of them :
+    pixels equal to the maximum of their 3x3 neighbourhood and above the minimum of their matrix, excluding the border.
+    :return: Arrays of index of matrix, x, y and density of maximas, sorted by matrix, then in the order of peak_local_max()"""
+
+    # Maximum filter of the whole stack, separable along x and y
+    rows = np.maximum(np.maximum(matrices[:, :, :-2], matrices[:, :, 1:-1]), matrices[:, :, 2:])
+    neighbours = np.maximum(np.maximum(rows[:, :-2], rows[:, 1:-1]), rows[:, 2:])
+
+    inner = matrices[:, 1:-1, 1:-1]
+    is_max = (inner >= neighbours) & (inner > matrices.min(axis=(1, 2))[:, None, None])
+
+    idx, maxy, maxx = np.nonzero(is_max)
+    maxx += 1
+    maxy += 1
+    scores = matrices[idx, maxy, maxx]
+
+    order = np.lexsort((maxx, maxy, -scores, idx))
+    return idx[order], maxx[order], maxy[order], scores[order]
+
+
+def select_clicks(img_id, maxx, maxy, scores, threshold, nb_clicks, tag=False) :
+    """Keep maximas above threshold.
+    :param scores: Density at maximas
+    :param tag: If true, tag the result with the threshold
+    :return: ClickResult and absolute threshold"""
+
+    out = ClickResult(img_id, threshold if tag else None)
 
     if threshold < 1 :
         threshold = threshold * nb_clicks
 
-    # Add them to model
-    out = ClickResult(img.id)
-
-    for x, y in zip(maxx, maxy):
-        score = matrix[y, x]
+    for x, y, score in zip(maxx, maxy, scores):
 
         if score > threshold:
             pt = Point(x, y, score=score)
             out.clicks.append(pt)
 
-    if clicks_to_draw is None :
-        clicks_to_draw = out.clicks
+    return out, threshold
 
-    # Plots
-    if out_folder or display:
 
-        #fig = plt.figure(figsize=(16, 12))
-        fig = plt.gcf()
+def draw_plot(fig, image, matrix, click_x, click_y, maxx, maxy, maxv, maxidx, threshold) :
+    """Draw the source image and the density matrix side by side, with clicks and selected points"""
 
-        maxx = np.array([click.x for click in clicks_to_draw])
-        maxy = np.array([click.y for click in clicks_to_draw])
-        maxv = np.array([click.score for click in clicks_to_draw])
+    def draw_points(ax):
 
-        maxidx = selected_idx if selected_idx is not None else np.argmax(maxv)
-        maxv = maxv[maxidx]
+        ax.plot(click_x, click_y, 'r*', markersize=5, label="annotations")
+        ax.scatter(maxx, maxy, s=200, color=(0, 0, 0), marker='x', linewidth=1, label="selected points  (> %0.1f)" % threshold)
+        if maxidx is not None :
+            ax.scatter(maxx[maxidx:maxidx + 1], maxy[maxidx:maxidx + 1],
+                label="maximum consensus (%0.1f)" % maxv[maxidx],
+                s=200, color=(0, 1, 0), marker='x', linewidth=2)
 
-        path = get_image(img.id, phase=Phase.CLICK, campaign=campaign)
-        image = plt.imread(path)
+        ax.legend(loc='upper left')
 
-        def draw_points():
+    heat_ax = fig.add_subplot(1, 2, 2)
+    draw_points(heat_ax)
+    # Not in place : the matrix may be rendered in background
+    matrix = np.where(matrix < 0.1, np.nan, matrix)
+    heat_plt = heat_ax.imshow(matrix)
 
-            plt.plot(click_x, click_y, 'r*', markersize=5, label="annotations")
-            plt.scatter(maxx, maxy, s=200, color=(0, 0, 0), marker='x', linewidth=1, label="selected points  (> %0.1f)" % threshold)
-            plt.scatter(maxx[maxidx:maxidx + 1], maxy[maxidx:maxidx + 1],
-                label="maximum consensus (%0.1f)" % maxv,
-                s=200, color=(0, 1, 0), marker='x', linewidth=2)
+    img_ax = fig.add_subplot(1, 2, 1)
+    draw_points(img_ax)
+    img_ax.imshow(image)
 
-            plt.legend(loc='upper left')
+    cax = fig.add_axes([heat_ax.get_position().x1 + 0.01, heat_ax.get_position().y0, 0.02, heat_ax.get_position().height])
+    cbar = fig.colorbar(heat_plt, cax=cax)  # Similar to fig.colorbar(im, cax = cax)
+    cbar.set_label(r'Point annotation consensus (-)', fontsize=12)
 
-        heat_ax = plt.subplot2grid((1, 2), (0, 1))
-        draw_points()
-        matrix[matrix < 0.1] = np.nan
-        heat_plt = plt.imshow(matrix)
 
-        img_ax = plt.subplot2grid((1, 2), (0, 0))
-        draw_points()
-        plt.imshow(image)
+def plot_args(matrix, click_x, click_y, clicks, threshold, selected_idx=None) :
+    """Arguments of draw_plot() and render.click_plot() : points to draw, and index of the one of maximum consensus"""
+    maxx = np.array([click.x for click in clicks])
+    maxy = np.array([click.y for click in clicks])
+    maxv = np.array([click.score for click in clicks])
 
-        cax = fig.add_axes([heat_ax.get_position().x1 + 0.01, heat_ax.get_position().y0, 0.02, heat_ax.get_position().height])
-        cbar = plt.colorbar(heat_plt, cax=cax)  # Similar to fig.colorbar(im, cax = cax)
-        cbar.set_label(r'Point annotation consensus (-)', fontsize=12)
+    if selected_idx is None and len(maxv) > 0 :
+        selected_idx = np.argmax(maxv)
 
-        if out_folder :
-            plt.savefig(os.path.join(out_folder,'%s.png' % img.id))
-        else:
-            fig.show()
+    return matrix, click_x, click_y, maxx, maxy, maxv, selected_idx, threshold
+
+
+def render_plot(filename, img_id, campaign, *args) :
+    """Render the diagnostic image of an image to a PNG file, with OpenCV"""
+    image = load_image(img_id, phase=Phase.CLICK, campaign=campaign)
+    with stage("render") :
+        write_png(filename, render.click_plot(image, *args))
+
+
+def analyse(img, threshold=DEFAULT_THRESHOLD, sigma=SIGMA, engine=DEFAULT_ENGINE, thresholds=None, plot=False) :
+    """Find maximas of the density of clicks of an image, and select the ones above threshold.
+    See process_img() for parameters.
+    :param plot: If true, the density matrix is computed even if the engine finds maximas without it
+    :return: Result, absolute threshold and density matrix (None for the 'coarse' engine, unless plot is true).
+        For a sweep, list of results instead of result"""
+
+    # Clicks coordinates
+    click_x, click_y = img.click_coords()
+    nb_clicks = len(click_x)
+
+    engine = select_engine(engine, nb_clicks)
+
+    if engine == ENGINE_COARSE :
+        # Maximas straight from clicks : the matrix is only computed for plots
+        matrix = None
+        with stage("peaks") :
+            maxx, maxy, scores = coarse_maximas(click_x, click_y, sigma)
 
-    if len(out.clicks) == 0 :
-        return None
     else :
-        return out
+        # Draw kernels at clicks
+        with stage("density") :
+            matrix = density_matrix(click_x, click_y, sigma, engine)
+
+        # Find maximas
+        with stage("peaks") :
+            maxx, maxy = find_maximas(matrix)
+            scores = matrix[maxy, maxx]
+
+    # Threshold sweep : same matrix and maximas for all thresholds
+    if thresholds :
+        results = []
+        with stage("select") :
+            for thres in thresholds :
+                res, _ = select_clicks(img.id, maxx, maxy, scores, thres, nb_clicks, tag=True)
+                if len(res.clicks) > 0 :
+                    results.append(res)
+        return results, None, matrix
+
+    # Add them to model
+    with stage("select") :
+        res, threshold = select_clicks(img.id, maxx, maxy, scores, threshold, nb_clicks)
 
+    if plot and matrix is None :
+        matrix = density_matrix(click_x, click_y, sigma, ENGINE_WINDOW)
 
-if __name__ == '__main__':
+    return res, threshold, matrix
 
+
+def prepare_display(img, threshold=DEFAULT_THRESHOLD, sigma=SIGMA, campaign=Campaign.GOOGLE, engine=DEFAULT_ENGINE, **kargs) :
+    """Analysis and source image of an image to display, memoized by annotations and parameters.
+    Safe in background threads : notebooks prepare the next images while one is shown (see previous_next()).
+    Other arguments of process_img() are ignored.
+    :return: Result, absolute threshold, density matrix and source image. They should not be modified"""
+
+    def prepare() :
+        res, abs_threshold, matrix = analyse(img, threshold, sigma, engine, plot=True)
+        return res, abs_threshold, matrix, load_image(img.id, phase=Phase.CLICK, campaign=campaign)
+
+    return DISPLAYS.get(display_key(img, threshold, sigma, str(campaign), engine), prepare)
+
+
+def process_img(
+        img, out=None, display=False, threshold=DEFAULT_THRESHOLD, sigma=SIGMA, campaign=Campaign.GOOGLE,
+        clicks_to_draw=None,
+        selected_idx=None,
+        engine=DEFAULT_ENGINE,
+        thresholds=None,
+        **kargs):
+    """
+
+    :param img: Image object  metea data of image being processed
+    :param out: Output folder for output image : None if no output is requested
+    :param display: If true Display resulting output image
+    :param threshold: Threshold for detection of points. Eirger as absolute number (if > 1) or ratio of number of clicks (<1)
+    :param sigma: size of the kernels
+    :param campaign: "google" or "ign" : only used ig display=True, for showing source image
+    :param engine: Engine used to compute the density of clicks. See density_matrix().
+        'coarse' : finds maximas on a coarse grid, refined at full resolution, see coarse_maximas().
+        'auto' : 'coarse' up to COARSE_MAX_CLICKS clicks, 'separable' above
+    :param thresholds: List of thresholds to sweep in a single pass. Overrides threshold. No image is drawn.
+    :return: result clicks or None if no match is found.
+        For a sweep, list of results (one per threshold with a match), tagged with their threshold
+    """
+
+    # Threshold sweep : no image is drawn
+    if thresholds :
+        return analyse(img, sigma=sigma, engine=engine, thresholds=thresholds)[0]
+
+    if display :
+        # Memoized : see prepare_display()
+        res, threshold, matrix, image = prepare_display(img, threshold, sigma, campaign, engine)
+    else :
+        res, threshold, matrix = analyse(img, threshold, sigma, engine, plot=bool(out))
+
+    if clicks_to_draw is None :
+        clicks_to_draw = res.clicks
+
+    # Plots
+    if out or display:
+
+        click_x, click_y = img.click_coords()
+        args = plot_args(matrix, click_x, click_y, clicks_to_draw, threshold, selected_idx)
+
+        if out :
+            # Headless : rendered with OpenCV, in background
+            write_output(render_plot, os.path.join(out, '%s.png' % img.id), img.id, campaign, *args)
+
+        if display :
+            fig = plt.gcf()
+            draw_plot(fig, image, *args)
+            fig.show()
+
+    if len(res.clicks) == 0 :
+        return None
+    else :
+        return res
+
+
+def process_batch(imgs, out=None, display=False, threshold=DEFAULT_THRESHOLD, sigma=SIGMA, thresholds=None, campaign=Campaign.GOOGLE, **kargs) :
+    """Process several images at once : the density matrices and maximas of all images are computed in single vectorized passes.
+    Same results as process_img() with the 'separable' engine. With display, images are processed one at a time.
+    :param imgs: List of Image
+    :return: List of results of process_img(), one per image"""
+
+    if display :
+        kargs["engine"] = ENGINE_SEPARABLE
+        return list(process_img(img, out, display, threshold, sigma, campaign, thresholds=thresholds, **kargs) for img in imgs)
+
+    coords = list(img.click_coords() for img in imgs)
+
+    with stage("density") :
+        matrices = batch_density(coords, sigma)
+
+    with stage("peaks") :
+        idx, maxx, maxy, scores = batch_maximas(matrices)
+        # Split maximas per image
+        bounds = np.cumsum(np.bincount(idx, minlength=len(imgs)))[:-1]
+        maximas = zip(np.split(maxx, bounds), np.split(maxy, bounds), np.split(scores, bounds))
+
+    res = []
+    with stage("select") :
+        for matrix, img, (click_x, click_y), (img_x, img_y, img_scores) in zip(matrices, imgs, coords, maximas) :
+            if thresholds :
+                results = list(select_clicks(img.id, img_x, img_y, img_scores, thres, len(click_x), tag=True)[0] for thres in thresholds)
+                res.append(list(result for result in results if len(result.clicks) > 0))
+            else :
+                result, abs_threshold = select_clicks(img.id, img_x, img_y, img_scores, threshold, len(click_x))
+                res.append(result if len(result.clicks) > 0 else None)
+                if out :
+                    # Copy : the matrix would keep the whole batch alive until rendered
+                    args = plot_args(matrix.copy(), click_x, click_y, result.clicks, abs_threshold)
+                    write_output(render_plot, os.path.join(out, '%s.png' % img.id), img.id, campaign, *args)
+    return res
+
+
+def cache_params(args) :
+    """Parameters of the analysis, for the result cache"""
+    # Batches are processed with the separable engine
+    engine = ENGINE_SEPARABLE if getattr(args, "batch_size", 1) > 1 else args.engine
+    # Engine 'auto' depends on the number of clicks : any change of its rule gives new keys
+    if engine == ENGINE_AUTO :
+        engine = [select_engine(engine, 0), COARSE_MAX_CLICKS, select_engine(engine, COARSE_MAX_CLICKS + 1)]
+    return dict(version=VERSION, sigma=SIGMA, threshold=args.threshold, thresholds=args.thresholds, engine=engine)
+
+
+def check_args(args) :
+    # Batches are processed with the separable engine
+    if args.batch_size > 1 and not args.engine in (ENGINE_AUTO, ENGINE_SEPARABLE) :
+        return "--batch-size uses the 'separable' engine : --engine %s is not supported" % args.engine
+    return None
+
+
+def main(argv=None) :
     threshold_arg = Arg('--threshold', '-t', type=float, default=DEFAULT_THRESHOLD,
                         help="Threshold value as absolute number of clicks (if >1) or ratio of number of clicks (if <1). 2 by default")
+    engine_arg = Arg('--engine', '-e', choices=ENGINES, default=DEFAULT_ENGINE,
+                        help="Engine computing the density of clicks. "
+                             "'auto' (default) : 'coarse' up to %d clicks, 'separable' above. "
+                             "'coarse' : finds maximas on a coarse grid, refined at full resolution. "
+                             "'window' : stamps a precomputed truncated kernel around each click. "
+                             "'separable' : convolves an histogram of clicks with a separable kernel, faster for many clicks. "
+                             "'dense' : reference implementation, evaluating each kernel on the whole image." % COARSE_MAX_CLICKS)
 
-    main_process(process_img, [threshold_arg])
+    main_process(process_img, [threshold_arg, THRESHOLDS_ARG, engine_arg], cache_params, argv,
+                 batch_function=process_batch, fetch_phase=Phase.CLICK, check_args=check_args)
 
+
+if __name__ == '__main__':
+    main()
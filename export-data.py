@@ -2,7 +2,12 @@
 # This script extract input data from SQL db and dumps it into JSON
 #
 
+import json
 import os
+import sqlite3
+import sys
+from contextlib import closing
+from datetime import datetime
 
 import pymysql
 from dotenv import load_dotenv
@@ -11,7 +16,7 @@ from lib.model import *
 import argparse
 
 # For surface, image was displayed on 500 px instead of 400
-from lib.utils import Campaign
+from lib.utils import Campaign, ResultWriter, open_output, eprint, iter_js, FORMAT_JSON, FORMAT_JSONL
 
 SURFACE_RATIO = 0.8
 
@@ -27,10 +32,10 @@ POLYGON_SRC_IMAGES = {
 
 SQL_CLICK="""
    SELECT 
+      bosseurAction.idImage as imageId,
       action.coordX as x, 
       action.coordY as y,
       action.pv as isPV,
-      bosseurAction.idImage as imageId,
       bosseurAction.dateAction as actionDate,
       bosseur.idBosseur as actorId,
       bosseur.region as actorRegion, 
@@ -38,15 +43,16 @@ SQL_CLICK="""
    FROM  prd_bdappv_actionPV as action  
    LEFT JOIN prd_bdappv_bosseurAction as bosseurAction ON action.idActionPV = bosseurAction.idAction
    LEFT JOIN prd_bdappv_bosseur as bosseur ON bosseurAction.idBosseur = bosseur.idBosseur
-   WHERE bosseurAction.sourceImg = {SourceImg}
+   WHERE bosseurAction.sourceImg = {SourceImg} {Since}
+   ORDER BY bosseurAction.idImage, action.idActionPV
 """
 
 SQL_POLYGON="""
    SELECT 
+      bosseurAction.idImage as imageId,
       point.coordX as x, 
       point.coordY as y,
       point.idSurface as polygonId,
-      bosseurAction.idImage as imageId,
       bosseurAction.dateAction as actionDate,
       bosseur.idBosseur as actorId,
       bosseur.region as actorRegion,
@@ -55,8 +61,8 @@ SQL_POLYGON="""
    LEFT JOIN prd_bdappv_zoneSurface as surface ON point.idSurface = surface.idSurface
    LEFT JOIN prd_bdappv_bosseurAction as bosseurAction ON surface.idActionSurface = bosseurAction.idAction
    LEFT JOIN prd_bdappv_bosseur as bosseur ON bosseurAction.idBosseur = bosseur.idBosseur
-   WHERE bosseurAction.sourceImg = {SourceImg}
-   ORDER BY point.idSurfacePoint
+   WHERE bosseurAction.sourceImg = {SourceImg} {Since}
+   ORDER BY bosseurAction.idImage, point.idSurfacePoint
 """
 
 SQL_IMG="""
@@ -69,97 +75,233 @@ SQL_IMG="""
          dep.nom as department
    FROM prd_bdappv_image as image 
    LEFT JOIN pv_installation as install ON image.idInstallation = install.id_utilisateur
-   LEFT JOIN pv_departement as dep ON dep.numero = install.departement"""
+   LEFT JOIN pv_departement as dep ON dep.numero = install.departement
+   ORDER BY image.idImage"""
 
 
+# Condition on actions, for incremental export.
+# Actions at the watermark date are read again : some may not have been committed at previous export. Those already exported are skipped
+SQL_SINCE="AND bosseurAction.dateAction >= '{Since}'"
 
-def load_imgs(campaign, filter):
-   """Load image data from DB"""
-   imgs = dict()
+# Number of rows fetched at once
+BATCH_SIZE=10000
+
+# Last exported dateAction, stored next to the output file
+WATERMARK_SUFFIX=".watermark"
+SINCE_LAST="last"
+
+def parse_date(date):
+   """dateAction as datetime : either read from DB, or as ISO string (with ' ' or 'T' separator). None stays None"""
+   if date is None or isinstance(date, datetime) :
+      return date
+   return datetime.fromisoformat(str(date))
+
+def format_date(date):
+   """Canonical format of dates in watermarks and SQL conditions, as MySQL : '2020-01-31 12:00:00'"""
+   return date.isoformat(sep=" ")
+
+def action_key(action):
+   """Identity of an action, to skip actions already exported"""
+   return parse_date(action.date), action.actorId
 
-   conn = pymysql.connect(
+
+def connect_mysql():
+   """Connection to the DB configured in .env, with an unbuffered cursor : rows are streamed from the server"""
+   return pymysql.connect(
       host=os.environ["DB_HOST"],
       port=int(os.environ["DB_PORT"]),
       user=os.environ["DB_USER"],
       password=os.environ["DB_PASS"],
       database=os.environ["DB_NAME"],
-      cursorclass=pymysql.cursors.DictCursor)
-
-   with conn :
-      # Fetch all images
-      with conn.cursor() as cursor :
-         cursor.execute(SQL_IMG)
-         for row in cursor :
-            img = Image(row["img_id"], row["city"], row["department"], row["region"], row["install_id"])
-            imgs[row["id"]] = img
-
-      # Fetch clicks
-      with conn.cursor() as cursor:
-         cursor.execute(SQL_CLICK.format(SourceImg=CLICK_SRC_IMAGES[campaign]))
-         for row in cursor:
-            action = Action(row["actorCountry"], row["actorRegion"], row["actionDate"], row["actorId"])
-            imageId = row["imageId"]
-
-            if imageId is None :
-               print("Bad action : ", row)
-               continue
-
-            if row["isPV"] :
-               click = Click(row["x"], row["y"], action)
-               imgs[imageId].clicks.append(click)
-            else :
-               imgs[imageId].notPvActions.append(action)
-
-      # Fetch polygons
-      with conn.cursor() as cursor:
-         cursor.execute(SQL_POLYGON.format(SourceImg=POLYGON_SRC_IMAGES[campaign]))
-
-         # Dict of polygonId => (polygon)
-         polygons = dict()
-         for row in cursor:
-            action = Action(row["actorCountry"], row["actorRegion"], row["actionDate"], row["actorId"])
-            imageId = row["imageId"]
-
-            polygonId = row["polygonId"]
-            if polygonId in polygons :
-               polygon = polygons[polygonId]
-            else:
-               # Ne polygon ? Create it and add it to image
-               polygon = Polygon(action)
-               polygons[polygonId] = polygon
-               imgs[imageId].polygons.append(polygon)
-
-            point = Point(
-               int(row["x"] * SURFACE_RATIO),
-               int(row["y"] * SURFACE_RATIO))
-            polygon.points.append(point)
-
-   # Filter images having at least one click
-   if filter :
-      res = list(img for img in imgs.values() if ((len(img.clicks) > 0) or (len(img.polygons) > 0)))
-   else:
-      res = list(imgs.values())
-
-   return res
-
+      cursorclass=pymysql.cursors.SSCursor)
+
+def connect_sqlite(filename):
+   """Connection to a SQLite copy of the DB, with the same tables"""
+   return lambda : closing(sqlite3.connect(filename))
+
+
+def iter_rows(connect, sql, batch_size=BATCH_SIZE):
+   """Stream the rows of a query as tuples, in batches of batch_size.
+   Each query has its own connection : a streamed result set has to be read entirely before the next query"""
+   with connect() as conn :
+      cursor = conn.cursor()
+      try :
+         cursor.execute(sql)
+         while True :
+            rows = cursor.fetchmany(batch_size)
+            if not rows :
+               break
+            yield from rows
+      finally:
+         cursor.close()
+
+
+class ImageRows :
+   """Rows of a query sorted by image id (first column), consumed image by image.
+   Keeps the latest action date (fifth column) of rows read, as datetime"""
+
+   def __init__(self, rows):
+      self.rows = iter(rows)
+      self.next = next(self.rows, None)
+      self.last_date = None
+
+   def pop(self, imageId):
+      """Rows of given image. Rows of previous images (without image) are skipped"""
+      res = []
+      while self.next is not None and (self.next[0] is None or self.next[0] < imageId) :
+         eprint("Bad action : ", self.next)
+         self.next = next(self.rows, None)
+
+      while self.next is not None and self.next[0] == imageId :
+         res.append(self.next)
+         date = parse_date(self.next[4])
+         if date is not None and (self.last_date is None or date > self.last_date) :
+            self.last_date = date
+         self.next = next(self.rows, None)
+      return res
+
+
+def iter_imgs(connect, campaign, filter, batch_size=BATCH_SIZE, since=None, previous=None, stats=None):
+   """Stream images from DB, one at a time.
+   Images, clicks and polygons are read in parallel, sorted by image id, and merged.
+   :param since: Only read actions with a later or same dateAction, as datetime or ISO string
+   :param previous: Dict of id => Image previously exported : actions read are added to them, unless already there
+   :param stats: Dict filled with 'changed' : list of ids of images with new actions, 'watermark' : latest dateAction read"""
+
+   since = parse_date(since)
+   where = SQL_SINCE.format(Since=format_date(since)) if since is not None else ""
+   clicks = ImageRows(iter_rows(connect, SQL_CLICK.format(SourceImg=CLICK_SRC_IMAGES[campaign], Since=where), batch_size))
+   polygons = ImageRows(iter_rows(connect, SQL_POLYGON.format(SourceImg=POLYGON_SRC_IMAGES[campaign], Since=where), batch_size))
+   changed = []
+
+   for id, img_id, city, install_id, region, department in iter_rows(connect, SQL_IMG, batch_size) :
+      img = Image(img_id, city, department, region, install_id)
+
+      # Keys of actions already exported
+      exported = set()
+      if previous is not None and img_id in previous :
+         old = previous.pop(img_id)
+         img.clicks, img.notPvActions, img.polygons = old.clicks, old.notPvActions, old.polygons
+         exported.update((click.x, click.y) + action_key(click.action) for click in img.clicks)
+         exported.update(action_key(action) for action in img.notPvActions)
+         exported.update(tuple((pt.x, pt.y) for pt in poly.points) + action_key(poly.action) for poly in img.polygons)
+      nb_actions = len(img.clicks) + len(img.notPvActions) + len(img.polygons)
+
+      img_clicks = clicks.pop(id)
+      for imageId, x, y, isPV, actionDate, actorId, actorRegion, actorCountry in img_clicks :
+         action = Action(actorCountry, actorRegion, actionDate, actorId)
+         if isPV :
+            if (x, y) + action_key(action) not in exported :
+               img.clicks.append(Click(x, y, action))
+         elif action_key(action) not in exported :
+            img.notPvActions.append(action)
+
+      # Dict of polygonId => (polygon)
+      img_polygons = dict()
+      img_points = polygons.pop(id)
+      for imageId, x, y, polygonId, actionDate, actorId, actorRegion, actorCountry in img_points :
+         if polygonId in img_polygons :
+            polygon = img_polygons[polygonId]
+         else:
+            # New polygon ? Create it
+            polygon = Polygon(Action(actorCountry, actorRegion, actionDate, actorId))
+            img_polygons[polygonId] = polygon
+
+         polygon.points.append(Point(
+            int(x * SURFACE_RATIO),
+            int(y * SURFACE_RATIO)))
+
+      # Polygons are complete : add them to image
+      img.polygons.extend(polygon for polygon in img_polygons.values()
+                          if tuple((pt.x, pt.y) for pt in polygon.points) + action_key(polygon.action) not in exported)
+
+      if len(img.clicks) + len(img.notPvActions) + len(img.polygons) > nb_actions :
+         changed.append(img_id)
+
+      # Filter images having at least one click
+      if filter and len(img.clicks) == 0 and len(img.polygons) == 0 :
+         continue
+
+      yield img
+
+   if stats is not None :
+      dates = list(date for date in (since, clicks.last_date, polygons.last_date) if date is not None)
+      stats["changed"] = changed
+      stats["watermark"] = format_date(max(dates)) if dates else None
+
+
+def read_watermark(output_file):
+   """Last dateAction exported to output_file, or None"""
+   filename = output_file + WATERMARK_SUFFIX
+   if not os.path.exists(filename) :
+      return None
+   with open(filename) as f :
+      return json.load(f)["dateAction"]
+
+def write_watermark(output_file, campaign, date):
+   with open(output_file + WATERMARK_SUFFIX, "w") as f :
+      json.dump(dict(campaign=campaign, dateAction=date), f)
+
+
+def load_imgs(campaign, filter, connect=connect_mysql):
+   """Load image data from DB"""
+   return list(iter_imgs(connect, campaign, filter))
 
 
 if __name__ == '__main__':
 
    parser = argparse.ArgumentParser()
-   parser.add_argument('output_file', type=str, metavar="out.json", help="Output file")
+   parser.add_argument('output_file', type=str, metavar="out.json", help="Output file, or '-' for stdout")
    parser.add_argument('--campaign', '-c', type=str, choices=[Campaign.IGN, Campaign.GOOGLE], help="Campaign : either 'google' (default) or 'ign'", default=Campaign.GOOGLE)
    parser.add_argument('--filter', '-f', action="store_true",
                        help="Filter out images with no click nor polygon", default=False)
+   parser.add_argument('--sqlite', type=str, metavar="db.sqlite", help="Read from a SQLite copy of the DB instead of MySQL")
+   parser.add_argument('--format', type=str, choices=[FORMAT_JSON, FORMAT_JSONL], default=FORMAT_JSON,
+                       help="Output format : 'json' (default) for a JSON array, 'jsonl' for one image per line")
+   parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Number of rows fetched at once. %d by default" % BATCH_SIZE)
+   parser.add_argument('--since', type=str, metavar="DATE",
+                       help="Incremental export : only read actions with a later dateAction, and merge them into the existing output file. "
+                            "'%s' for the watermark of the previous export (<out_file>%s)" % (SINCE_LAST, WATERMARK_SUFFIX))
+   parser.add_argument('--changed', type=str, metavar="ids.txt",
+                       help="Write ids of images with new actions to this file, to be used with --ids @ids.txt of the analysis scripts")
    args = parser.parse_args()
 
-   load_dotenv()
-   imgs = load_imgs(args.campaign, args.filter)
-
-   print("Found %d images" % len(imgs))
-
-   to_json(imgs, args.output_file)
-
-
-
-
+   if args.sqlite :
+      connect = connect_sqlite(args.sqlite)
+   else :
+      load_dotenv()
+      connect = connect_mysql
+
+   since = args.since
+   if since == SINCE_LAST :
+      since = read_watermark(args.output_file)
+      if since is None :
+         eprint("No watermark found for %s : exporting all actions" % args.output_file)
+
+   # Merge with previous export
+   previous = None
+   if since is not None and os.path.exists(args.output_file) :
+      previous = {img.id : img for img in iter_js(args.output_file, use_cache=False)}
+
+   # Images are written as soon as they are complete, in a temporary file if output file is merged
+   out_file = args.output_file + ".tmp" if previous is not None else args.output_file
+   writer = ResultWriter(open_output(out_file), args.format, indent=2)
+   stats = dict()
+   count = 0
+   for img in iter_imgs(connect, args.campaign, args.filter, args.batch_size, since, previous, stats) :
+      writer.write([img])
+      count += 1
+   writer.close()
+
+   if previous is not None :
+      os.replace(out_file, args.output_file)
+
+   if args.output_file != '-' and stats["watermark"] is not None :
+      write_watermark(args.output_file, args.campaign, stats["watermark"])
+
+   if args.changed :
+      with open(args.changed, "w") as f :
+         f.writelines("%s\n" % id for id in stats["changed"])
+
+   print("Found %d images, %d with new actions. Watermark : %s" % (count, len(stats["changed"]), stats["watermark"]),
+         file=sys.stderr if args.output_file == '-' else sys.stdout)
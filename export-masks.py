@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# This script rasterizes the polygons of a polygon analysis (SurfaceResult) into segmentation masks,
+# written as PNG files or as a single archive (see lib/masks.py)
+#
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from progressbar import progressbar
+
+from lib.masks import FORMATS, FORMAT_PNG, mask_writer
+from lib.utils import iter_js, parse_ids
+from polygon_analysis import polygons_mask, WIDTH, HEIGHT
+
+DEFAULT_WORKERS=4
+
+# Masks encoded ahead of writing, per worker : bounds the memory of masks waiting to be written
+AHEAD_PER_WORKER=4
+
+def map_ahead(executor, func, items, size) :
+    """Ordered executor.map(), submitting at most size items ahead of the one returned"""
+    pending = deque()
+    for item in items :
+        pending.append(executor.submit(func, item))
+        if len(pending) > size :
+            yield pending.popleft().result()
+    while pending :
+        yield pending.popleft().result()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file', type=str, help="Output of polygon_analysis.py, or '-' for stdin")
+    parser.add_argument('output', type=str, help="Output folder for 'png', output file otherwise")
+    parser.add_argument('--format', '-f', type=str, choices=FORMATS, default=FORMAT_PNG,
+                        help="'png' (default) : one {id}.png file per mask. 'npy' : stack of masks of 0/1. "
+                             "'tar' : single tar of PNG files. 'bits' : stack of bit packed masks. "
+                             "Stacks come with an index of ids : <output>.ids.json")
+    parser.add_argument('--ids', "-i", metavar='id1,id2,id3', help="Filter on ids, or @file with one id per line")
+    parser.add_argument('--empty', action='store_true', help="Also write empty masks of images without polygon")
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_WORKERS,
+                        help="Number of parallel workers. %d by default" % DEFAULT_WORKERS)
+    args = parser.parse_args()
+
+    filter = parse_ids(args.ids) if args.ids else None
+    results = list(res for res in iter_js(args.input_file)
+                   if (filter is None or str(res.id) in filter) and (args.empty or res.polygons))
+
+    with mask_writer(args.format, args.output, len(results), (HEIGHT, WIDTH)) as writer :
+
+        def encode(res) :
+            return writer.encode(polygons_mask(res.polygons, value=1))
+
+        with ThreadPoolExecutor(args.workers) as executor :
+            # Masks are encoded in parallel, and written in order
+            masks = map_ahead(executor, encode, results, args.workers * AHEAD_PER_WORKER)
+            for idx, (res, data) in enumerate(progressbar(zip(results, masks), max_value=len(results))) :
+                writer.write(idx, res.id, data)
+
+    print("%d masks written to %s" % (len(results), args.output))
@@ -0,0 +1,215 @@
+"""Binary cache of input JSON files : images are stored as columns of numpy arrays, opened with memmap"""
+import hashlib
+import json
+import os
+import shutil
+from collections.abc import Sequence
+
+import numpy as np
+
+from lib.model import CompactImage
+
+CACHE_VERSION=1
+CACHE_SUFFIX=".cache"
+META_FILE="meta.json"
+IMAGES_FILE="images.json"
+
+# Metadata attributes of images
+IMAGE_ATTRS=("id", "city", "department", "region", "install_id")
+
+# Array columns : concatenation of the arrays of all CompactImage
+CLICK_COLS=("click_x", "click_y", "click_actor", "click_date")
+NOT_PV_COLS=("not_pv_actor", "not_pv_date")
+POLY_COLS=("poly_actor", "poly_date")
+
+def cache_path(filename) :
+    return filename + CACHE_SUFFIX
+
+def file_hash(filename) :
+    """SHA1 of a file"""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f :
+        for block in iter(lambda : f.read(1 << 20), b"") :
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def source_signature(filename, hash=True) :
+    stat = os.stat(filename)
+    res = dict(size=stat.st_size, mtime=stat.st_mtime)
+    if hash :
+        res["sha1"] = file_hash(filename)
+    return res
+
+def is_valid(filename) :
+    """True if the cache of filename exists and is up to date.
+    A cache with a different mtime stays valid if the content of the source has the same hash"""
+    return is_up_to_date(filename, os.path.join(cache_path(filename), META_FILE), CACHE_VERSION)
+
+def is_up_to_date(filename, meta_file, version) :
+    """True if a file derived from filename (cache, index), described by meta_file, exists and is up to date.
+    The meta file holds the version of the format and the signature of the source"""
+
+    if not os.path.exists(meta_file) :
+        return False
+
+    with open(meta_file) as f :
+        meta = json.load(f)
+
+    if meta["version"] != version :
+        return False
+
+    source = meta["source"]
+    current = source_signature(filename, hash=False)
+    if current["size"] != source["size"] :
+        return False
+    if current["mtime"] == source["mtime"] :
+        return True
+    if file_hash(filename) != source["sha1"] :
+        return False
+
+    # Same content : keep the cache for next time
+    source["mtime"] = current["mtime"]
+    with open(meta_file, "w") as f :
+        json.dump(meta, f)
+    return True
+
+
+def concat(arrays, shape=(0,)) :
+    """Concatenate arrays, ignoring empty ones so that their dtype is not promoted"""
+    arrays = list(arr for arr in arrays if len(arr) > 0)
+    return np.concatenate(arrays) if arrays else np.zeros(shape, dtype=np.int64)
+
+
+def build_cache(filename, imgs) :
+    """Build the cache of a JSON file
+    :param filename: Source JSON file
+    :param imgs: Images of this file, preferably as CompactImage
+    :return: Number of images"""
+
+    signature = source_signature(filename)
+
+    # Global tables of actors and dates
+    actors = dict()
+    dates = dict()
+
+    def remap(idx, table, local_table) :
+        mapping = np.array(list(table.setdefault(val, len(table)) for val in local_table) + [-1], dtype=np.int32)
+        return mapping[idx]
+
+    images = []
+    columns = {col : [] for col in CLICK_COLS + NOT_PV_COLS + POLY_COLS + ("vertices", "nb_polys")}
+    for img in imgs :
+
+        if not isinstance(img, CompactImage) :
+            if type(img).__name__ != "Image" :
+                raise Exception("Only images can be cached, got %s" % type(img).__name__)
+            img = CompactImage.from_image(img)
+
+        images.append(list(getattr(img, attr) for attr in IMAGE_ATTRS))
+
+        for col in CLICK_COLS + NOT_PV_COLS + POLY_COLS :
+            arr = getattr(img, col)
+            if col.endswith("_actor") :
+                arr = remap(arr, actors, img.actors)
+            elif col.endswith("_date") :
+                arr = remap(arr, dates, img.dates)
+            columns[col].append(arr)
+
+        columns["vertices"].append(img.vertices)
+        columns["nb_polys"].append(np.diff(img.poly_offsets))
+
+    # Write in a temporary folder, then move it
+    folder = cache_path(filename)
+    tmp_folder = "%s.tmp-%d" % (folder, os.getpid())
+    os.makedirs(tmp_folder)
+
+    def save(name, arr) :
+        np.save(os.path.join(tmp_folder, name + ".npy"), arr)
+
+    def offsets(arrays) :
+        return np.cumsum([0] + list(len(arr) for arr in arrays))
+
+    for col in CLICK_COLS + NOT_PV_COLS + POLY_COLS :
+        save(col, concat(columns[col]))
+    save("vertices", concat(columns["vertices"], (0, 2)))
+    save("poly_offsets", np.cumsum(np.concatenate([[0]] + columns["nb_polys"])))
+    save("img_clicks", offsets(columns["click_x"]))
+    save("img_not_pv", offsets(columns["not_pv_actor"]))
+    save("img_polys", offsets(columns["poly_actor"]))
+
+    with open(os.path.join(tmp_folder, IMAGES_FILE), "w") as f :
+        json.dump(dict(images=images, actors=list(actors), dates=list(dates)), f)
+
+    with open(os.path.join(tmp_folder, META_FILE), "w") as f :
+        json.dump(dict(version=CACHE_VERSION, source=signature, count=len(images)), f)
+
+    if os.path.exists(folder) :
+        shutil.rmtree(folder)
+    os.rename(tmp_folder, folder)
+
+    return len(images)
+
+
+class CachedDataset(Sequence) :
+    """Images of a cache, as CompactImage with arrays mapped in memory.
+    Pickling a dataset only sends the file name : workers map the same files, sharing memory"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        folder = cache_path(filename)
+
+        with open(os.path.join(folder, IMAGES_FILE)) as f :
+            tables = json.load(f)
+        self.images = tables["images"]
+        self.actors = list(tuple(actor) for actor in tables["actors"])
+        self.dates = tables["dates"]
+
+        self.arrays = dict()
+        for name in CLICK_COLS + NOT_PV_COLS + POLY_COLS + ("vertices", "poly_offsets", "img_clicks", "img_not_pv", "img_polys") :
+            self.arrays[name] = np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+
+    def __reduce__(self):
+        return CachedDataset, (self.filename,)
+
+    def find_ids(self, ids) :
+        """Positions of the images with an id in a set, sorted"""
+        return list(pos for pos, img in enumerate(self.images) if str(img[0]) in ids)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice) :
+            return list(self[j] for j in range(*i.indices(len(self))))
+
+        arrays = self.arrays
+        img = CompactImage.__new__(CompactImage)
+        for attr, val in zip(IMAGE_ATTRS, self.images[i]) :
+            setattr(img, attr, val)
+
+        # Tables are shared by all images
+        img.actors = self.actors
+        img.dates = self.dates
+
+        def view(cols, offsets) :
+            start, end = arrays[offsets][i], arrays[offsets][i + 1]
+            for col in cols :
+                setattr(img, col, arrays[col][start:end])
+
+        view(CLICK_COLS, "img_clicks")
+        view(NOT_PV_COLS, "img_not_pv")
+        view(POLY_COLS, "img_polys")
+
+        start, end = arrays["img_polys"][i], arrays["img_polys"][i + 1]
+        poly_offsets = arrays["poly_offsets"][start:end + 1]
+        img.vertices = arrays["vertices"][poly_offsets[0]:poly_offsets[-1]]
+        img.poly_offsets = poly_offsets - poly_offsets[0]
+
+        return img
+
+
+def open_cache(filename) :
+    """Open the cache of a file if it is valid, or return None"""
+    if filename == '-' or not is_valid(filename) :
+        return None
+    return CachedDataset(filename)
@@ -0,0 +1,146 @@
+"""Local cache of images : sharded folders indexed by a manifest, and LRU of decoded images"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+MANIFEST_FILE="manifest.txt"
+# Prefix of manifest lines of removed images
+TOMBSTONE="-"
+EXTENSION=".png"
+
+# Maximum size of decoded images kept in memory (bytes)
+LRU_SIZE=256 << 20
+
+def shard(id) :
+    """Sub folder of an image : 256 shards, by hash of id"""
+    return hashlib.md5(str(id).encode()).hexdigest()[:2]
+
+
+def read_manifest(path) :
+    """Ids listed in a manifest, in order of lines : a tombstone removes the id added before it"""
+    ids = set()
+    with open(path) as f :
+        for line in f :
+            line = line.strip()
+            if line.startswith(TOMBSTONE) :
+                ids.discard(line[len(TOMBSTONE):])
+            elif line :
+                ids.add(line)
+    return ids
+
+
+class ImageCache :
+    """Images stored in {folder}/{campaign}/{phase}/{shard}/{id}.png.
+    Ids of images present are listed in a manifest per campaign and phase, loaded once :
+    lookups by contains() do not touch the file system.
+    The manifest is only appended to : removed images are written as tombstones -{id}"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.indexes = dict()
+        self.lock = threading.Lock()
+
+    def phase_folder(self, campaign, phase) :
+        return os.path.join(self.folder, str(campaign), str(phase))
+
+    def path(self, campaign, phase, id) :
+        return os.path.join(self.phase_folder(campaign, phase), shard(id), "%s%s" % (id, EXTENSION))
+
+    def index(self, campaign, phase) :
+        """Set of ids present in cache"""
+        key = (str(campaign), str(phase))
+        with self.lock :
+            if not key in self.indexes :
+                manifest = os.path.join(self.phase_folder(campaign, phase), MANIFEST_FILE)
+                if os.path.exists(manifest) :
+                    self.indexes[key] = read_manifest(manifest)
+                else :
+                    self.indexes[key] = self._reindex(campaign, phase)
+            return self.indexes[key]
+
+    def _reindex(self, campaign, phase) :
+        """Scan the folder and write the manifest.
+        Images of the former flat layout ({phase}/{id}.png) are moved to their shard"""
+        folder = self.phase_folder(campaign, phase)
+        ids = set()
+        if os.path.exists(folder) :
+            for root, dirs, files in os.walk(folder) :
+                for file in files :
+                    if not file.endswith(EXTENSION) :
+                        continue
+                    id = file[:-len(EXTENSION)]
+                    if root == folder :
+                        target = self.path(campaign, phase, id)
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        os.replace(os.path.join(root, file), target)
+                    ids.add(id)
+
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, MANIFEST_FILE), "w") as f :
+            f.writelines("%s\n" % id for id in sorted(ids))
+        return ids
+
+    def reindex(self, campaign, phase) :
+        with self.lock :
+            self.indexes[(str(campaign), str(phase))] = self._reindex(campaign, phase)
+
+    def contains(self, campaign, phase, id) :
+        return str(id) in self.index(campaign, phase)
+
+    def _append(self, campaign, phase, line) :
+        # Single appended line : safe with several processes
+        with open(os.path.join(self.phase_folder(campaign, phase), MANIFEST_FILE), "a") as f :
+            f.write("%s\n" % line)
+
+    def add(self, campaign, phase, id) :
+        """Register an image written at its path"""
+        index = self.index(campaign, phase)
+        with self.lock :
+            if str(id) in index :
+                return
+            index.add(str(id))
+            self._append(campaign, phase, id)
+
+    def remove(self, campaign, phase, id) :
+        """Unregister a missing image : a tombstone is appended to the manifest"""
+        index = self.index(campaign, phase)
+        with self.lock :
+            if not str(id) in index :
+                return
+            index.discard(str(id))
+            self._append(campaign, phase, TOMBSTONE + str(id))
+
+
+class LRU :
+    """Thread safe LRU of numpy arrays, bounded by their total size in bytes"""
+
+    def __init__(self, max_bytes=LRU_SIZE):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load) :
+        """Get an item, or load it with load() and keep it. Items are read only"""
+        with self.lock :
+            if key in self.items :
+                self.items.move_to_end(key)
+                return self.items[key]
+
+        value = load()
+        value.flags.writeable = False
+
+        with self.lock :
+            if not key in self.items :
+                self.items[key] = value
+                self.size += value.nbytes
+                while self.size > self.max_bytes and len(self.items) > 1 :
+                    _, old = self.items.popitem(last=False)
+                    self.size -= old.nbytes
+            return self.items[key]
+
+    def clear(self) :
+        with self.lock :
+            self.items.clear()
+            self.size = 0
@@ -0,0 +1,179 @@
+"""Sidecar index of JSON files of images or results : byte offset and length of each item, with a few metadata columns.
+Items can then be looked up by id without parsing the whole file"""
+import json
+import os
+import shutil
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from lib import utils
+from lib.cache import source_signature, is_up_to_date
+from lib.model import parse_object, parse_compact
+
+INDEX_VERSION=1
+INDEX_SUFFIX=".index"
+META_FILE="meta.json"
+COLUMNS_FILE="columns.json"
+
+# Metadata columns : attributes of images, only "id" for results
+INDEX_COLS=("id", "department", "region", "install_id")
+
+def index_path(filename) :
+    return filename + INDEX_SUFFIX
+
+def is_valid(filename) :
+    """True if the index of filename exists and is up to date"""
+    return is_up_to_date(filename, os.path.join(index_path(filename), META_FILE), INDEX_VERSION)
+
+
+def build_index(filename) :
+    """Build the index of a JSON file made of a top level array
+    :return: Number of items"""
+
+    signature = source_signature(filename)
+
+    offsets = []
+    lengths = []
+    columns = {col : [] for col in INDEX_COLS}
+
+    # No newline translation : offsets are the ones of the file
+    with open(filename, encoding="utf-8", newline="") as infile :
+        stream = utils.JsonStream(infile, raw=True)
+        if not stream.is_array :
+            raise ValueError("Only JSON arrays can be indexed : %s" % filename)
+
+        for item, start, end in stream.spans() :
+            offsets.append(start)
+            lengths.append(end - start)
+            for col in INDEX_COLS :
+                columns[col].append(item.get(col) if isinstance(item, dict) else None)
+
+    # Write in a temporary folder, then move it
+    folder = index_path(filename)
+    tmp_folder = "%s.tmp-%d" % (folder, os.getpid())
+    os.makedirs(tmp_folder)
+
+    np.save(os.path.join(tmp_folder, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_folder, "lengths.npy"), np.array(lengths, dtype=np.int64))
+
+    with open(os.path.join(tmp_folder, COLUMNS_FILE), "w") as f :
+        json.dump(columns, f)
+
+    with open(os.path.join(tmp_folder, META_FILE), "w") as f :
+        json.dump(dict(version=INDEX_VERSION, source=signature, count=len(offsets)), f)
+
+    if os.path.exists(folder) :
+        shutil.rmtree(folder)
+    os.rename(tmp_folder, folder)
+
+    return len(offsets)
+
+
+class JsonIndex(Mapping) :
+    """Items of an indexed JSON file, by id : index[id] parses the last item with this id only, as a dict built from the file would.
+    Positions are the ranks of items in the file. Several items may have the same id (threshold sweeps) : see get_all()"""
+
+    def __init__(self, filename, compact=False):
+        self.filename = filename
+        self.compact = compact
+        folder = index_path(filename)
+
+        with open(os.path.join(folder, COLUMNS_FILE)) as f :
+            self.columns = json.load(f)
+        self.offsets = np.load(os.path.join(folder, "offsets.npy"), mmap_mode="r")
+        self.lengths = np.load(os.path.join(folder, "lengths.npy"), mmap_mode="r")
+
+        # Ids are looked up as strings, as in --ids
+        self.positions = dict()
+        for pos, id in enumerate(self.columns["id"]) :
+            self.positions.setdefault(str(id), []).append(pos)
+
+    def __reduce__(self):
+        return JsonIndex, (self.filename, self.compact)
+
+    def __getitem__(self, id):
+        return self.read(self.positions[str(id)][-1:])[0]
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, id):
+        return str(id) in self.positions
+
+    def read(self, positions) :
+        """Parse the items at given positions, in this order"""
+        object_hook = parse_compact if self.compact else parse_object
+        items = dict()
+        with open(self.filename, "rb") as f :
+            # Read in order of the file
+            for pos in sorted(set(positions)) :
+                f.seek(self.offsets[pos])
+                items[pos] = json.loads(f.read(self.lengths[pos]).decode("utf-8"), object_hook=object_hook)
+        return list(items[pos] for pos in positions)
+
+    def get_all(self, id) :
+        """All items with this id"""
+        return self.read(self.positions.get(str(id), []))
+
+    def lookup(self, ids) :
+        """Items of several ids, in the order of the file. Unknown ids are ignored"""
+        return self.read(self.find_ids(ids))
+
+    def find_ids(self, ids) :
+        """Positions of the items of several ids, sorted"""
+        return sorted(pos for id in ids for pos in self.positions.get(str(id), []))
+
+    def by_position(self) :
+        """Items as a sequence, parsed on access"""
+        return IndexedItems(self)
+
+    def find(self, **values) :
+        """Positions of the items with given values of metadata columns. Ex : find(department="...")"""
+        res = range(len(self.offsets))
+        for col, value in values.items() :
+            column = self.columns[col]
+            res = list(pos for pos in res if column[pos] == value)
+        return list(res)
+
+
+class IndexedItems(Sequence) :
+    """Items of an indexed JSON file by position, as a list that parses items on access.
+    Iteration streams the whole file"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice) :
+            return self.index.read(range(*pos.indices(len(self))))
+        if pos < 0 :
+            pos += len(self)
+        if not 0 <= pos < len(self) :
+            raise IndexError(pos)
+        return self.index.read([pos])[0]
+
+    def __len__(self):
+        return len(self.index.offsets)
+
+    def __iter__(self):
+        return utils.iter_js(self.index.filename, compact=self.index.compact, use_cache=False)
+
+
+def open_index(filename, compact=False, build=True) :
+    """Open the index of a file, building it if it is missing or out of date.
+    Return None for stdin, or if the index cannot be built"""
+    if filename == '-' :
+        return None
+    if not is_valid(filename) :
+        if not build :
+            return None
+        try :
+            build_index(filename)
+        except (OSError, ValueError) as e :
+            utils.eprint("Cannot index %s : %s" % (filename, e))
+            return None
+    return JsonIndex(filename, compact)
@@ -0,0 +1,127 @@
+"""Background I/O stage : source images are fetched ahead of compute, and output images are rendered and written
+by dedicated threads, so that compute only produces arrays.
+Disabled by default : tasks are then run inline, in the calling thread"""
+import os
+import queue
+import threading
+import traceback
+from collections import deque
+
+import cv2
+
+# Maximum number of pending tasks of each queue : producers wait beyond it
+DEFAULT_QUEUE_SIZE=64
+
+# Threads fetching images. Outputs are rendered by a single thread : matplotlib is not thread safe
+DEFAULT_FETCHERS=4
+
+_STOP = object()
+
+class IOStage :
+
+    def __init__(self):
+        self.fetchers = []
+        self.writer = None
+        self.fetches = None
+        self.writes = None
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.pid = None
+
+    @property
+    def enabled(self) :
+        # Threads are not inherited by forked processes (workers)
+        return self.writer is not None and self.pid == os.getpid()
+
+    def start(self, fetchers=DEFAULT_FETCHERS, queue_size=DEFAULT_QUEUE_SIZE) :
+        if self.enabled :
+            return
+        self.pid = os.getpid()
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.fetches = queue.Queue(queue_size)
+        self.writes = queue.Queue(queue_size)
+        self.fetchers = list(threading.Thread(target=self._run, args=(self.fetches,), daemon=True) for i in range(fetchers))
+        self.writer = threading.Thread(target=self._run, args=(self.writes,), daemon=True)
+        for thread in self.fetchers + [self.writer] :
+            thread.start()
+
+    def _run(self, tasks) :
+        while True :
+            task = tasks.get()
+            try :
+                if task is _STOP :
+                    return
+                func, args = task
+                func(*args)
+            except Exception :
+                with self.lock :
+                    self.errors += 1
+                traceback.print_exc()
+            finally :
+                tasks.task_done()
+
+    def fetch(self, func, *args) :
+        """Run func(*args) in a fetcher thread, or inline if the stage is not started"""
+        self._submit(self.fetches, func, args)
+
+    def write(self, func, *args) :
+        """Run func(*args) in the writer thread, in order of submission, or inline if the stage is not started"""
+        self._submit(self.writes, func, args)
+
+    def _submit(self, tasks, func, args) :
+        if not self.enabled :
+            func(*args)
+            return
+        # Waits when the queue is full
+        tasks.put((func, args))
+
+    def take_errors(self) :
+        """Return and reset the number of failed tasks"""
+        with self.lock :
+            errors = self.errors
+            self.errors = 0
+        return errors
+
+    def wait(self) :
+        """Wait for pending tasks"""
+        if self.enabled :
+            self.fetches.join()
+            self.writes.join()
+
+    def stop(self) :
+        """Wait for pending tasks and stop threads"""
+        if not self.enabled :
+            return
+        for thread in self.fetchers :
+            self.fetches.put(_STOP)
+        self.writes.put(_STOP)
+        for thread in self.fetchers + [self.writer] :
+            thread.join()
+        self.fetchers = []
+        self.writer = None
+
+
+# Global I/O stage of the process
+IO_STAGE = IOStage()
+
+def write_output(func, *args) :
+    """Render or write an output image in the background, if the I/O stage is started"""
+    IO_STAGE.write(func, *args)
+
+def write_png(filename, image) :
+    """Write an image with OpenCV. It reports failures by its result : raised as IOError"""
+    if not cv2.imwrite(filename, image) :
+        raise IOError("Could not write %s" % filename)
+
+
+def read_ahead(items, func, size) :
+    """Iterate over items, calling func(item) when the item is read, size items before it is returned"""
+    buffer = deque()
+    for item in items :
+        func(item)
+        buffer.append(item)
+        if len(buffer) > size :
+            yield buffer.popleft()
+    while buffer :
+        yield buffer.popleft()
@@ -0,0 +1,192 @@
+"""Segmentation masks archives : a folder of PNG, a NPY stack, a tar shard of PNG, or bit packed masks.
+Stacks (npy and bits) come with an index of ids and shape of masks ({archive}.ids.json) and are read with memmap"""
+import io
+import json
+import os
+import tarfile
+
+import cv2
+import numpy as np
+
+FORMAT_PNG="png"
+FORMAT_NPY="npy"
+FORMAT_TAR="tar"
+FORMAT_BITS="bits"
+FORMATS=[FORMAT_PNG, FORMAT_NPY, FORMAT_TAR, FORMAT_BITS]
+
+IDS_SUFFIX=".ids.json"
+
+# Value of mask pixels in PNG, as in the published dataset
+PNG_VALUE=255
+
+def ids_path(path) :
+    return os.path.splitext(path)[0] + IDS_SUFFIX
+
+def png_bytes(mask) :
+    ok, data = cv2.imencode(".png", mask)
+    if not ok :
+        raise Exception("Failed to encode mask as PNG")
+    return data.tobytes()
+
+
+class MaskWriter :
+    """Writes masks of fixed shape. encode() is thread safe and may be run by workers,
+    write() is called from a single thread"""
+
+    def __init__(self, path, count, shape) :
+        self.path = path
+        self.count = count
+        self.shape = shape
+        self.ids = []
+
+    def encode(self, mask) :
+        return mask
+
+    def write(self, idx, id, data) :
+        self.ids.append(id)
+
+    def close(self) :
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) :
+        self.close()
+
+
+class PngWriter(MaskWriter) :
+    """One {id}.png file per mask, in a folder"""
+
+    def __init__(self, path, count, shape) :
+        super().__init__(path, count, shape)
+        os.makedirs(path, exist_ok=True)
+
+    def encode(self, mask) :
+        return png_bytes(mask * PNG_VALUE)
+
+    def write(self, idx, id, data) :
+        super().write(idx, id, data)
+        with open(os.path.join(self.path, "%s.png" % id), "wb") as f :
+            f.write(data)
+
+
+class TarWriter(MaskWriter) :
+    """Single tar file of {id}.png members"""
+
+    def __init__(self, path, count, shape) :
+        super().__init__(path, count, shape)
+        self.tar = tarfile.open(path, "w")
+
+    def encode(self, mask) :
+        return png_bytes(mask * PNG_VALUE)
+
+    def write(self, idx, id, data) :
+        super().write(idx, id, data)
+        info = tarfile.TarInfo("%s.png" % id)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def close(self) :
+        self.tar.close()
+
+
+class StackWriter(MaskWriter) :
+    """NPY array of count x height x width masks of 0/1, and index of ids"""
+
+    format = FORMAT_NPY
+
+    def __init__(self, path, count, shape) :
+        super().__init__(path, count, shape)
+        self.stack = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(count,) + self.stack_shape(shape))
+        self.ids = [None] * count
+
+    def stack_shape(self, shape) :
+        return shape
+
+    def write(self, idx, id, data) :
+        self.stack[idx] = data
+        self.ids[idx] = id
+
+    def close(self) :
+        self.stack.flush()
+        del self.stack
+        with open(ids_path(self.path), "w") as f :
+            json.dump(dict(format=self.format, shape=self.shape, ids=self.ids), f)
+
+
+class BitsWriter(StackWriter) :
+    """Same as StackWriter, with 8 pixels per byte along rows"""
+
+    format = FORMAT_BITS
+
+    def stack_shape(self, shape) :
+        return shape[:-1] + ((shape[-1] + 7) // 8,)
+
+    def encode(self, mask) :
+        return np.packbits(mask, axis=-1)
+
+
+WRITERS = {
+    FORMAT_PNG : PngWriter,
+    FORMAT_NPY : StackWriter,
+    FORMAT_TAR : TarWriter,
+    FORMAT_BITS : BitsWriter}
+
+def mask_writer(format, path, count, shape) :
+    return WRITERS[format](path, count, shape)
+
+
+class MaskArchive :
+    """Read access to masks written by a MaskWriter, by index or by id. Masks are returned as arrays of 0/1"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tar = None
+
+        if os.path.isdir(path) :
+            self.format = FORMAT_PNG
+            self.ids = sorted(file[:-len(".png")] for file in os.listdir(path) if file.endswith(".png"))
+
+        elif tarfile.is_tarfile(path) :
+            self.format = FORMAT_TAR
+            self.tar = tarfile.open(path)
+            self.members = self.tar.getmembers()
+            self.ids = list(member.name[:-len(".png")] for member in self.members)
+
+        else :
+            self.stack = np.load(path, mmap_mode="r")
+            with open(ids_path(path)) as f :
+                index = json.load(f)
+            self.format = index["format"]
+            self.shape = tuple(index["shape"])
+            self.ids = index["ids"]
+
+        self.index = {str(id) : idx for idx, id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, idx):
+        if self.format == FORMAT_NPY :
+            return self.stack[idx]
+        if self.format == FORMAT_BITS :
+            return np.unpackbits(self.stack[idx], axis=-1, count=self.shape[-1])
+
+        if self.format == FORMAT_PNG :
+            data = np.fromfile(os.path.join(self.path, "%s.png" % self.ids[idx]), np.uint8)
+        else :
+            data = np.frombuffer(self.tar.extractfile(self.members[idx]).read(), np.uint8)
+        return (cv2.imdecode(data, cv2.IMREAD_GRAYSCALE) > 0).astype(np.uint8)
+
+    def get(self, id) :
+        return self[self.index[str(id)]]
+
+    def close(self) :
+        if self.tar is not None :
+            self.tar.close()
+
+
+def open_masks(path) :
+    """Open an archive of masks, of any format"""
+    return MaskArchive(path)
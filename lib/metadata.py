@@ -0,0 +1,127 @@
+"""Quality control of the metadata of installations (raw-metadata.csv) and association with segmentation masks.
+Vectorized version of the filters of metadata.ipynb"""
+import numpy as np
+import pandas as pd
+
+from lib.utils import iter_js
+
+RAW_METADATA="data/raw/raw-metadata.csv"
+JS_FILE_TEMPLATE="data/replication/campaign-{campaign}/polygon-analysis.json"
+
+# Campaigns, as named in columns, with the ground sampling distance of their images (m / pixel)
+CAMPAIGNS={"IGN" : 0.2, "Google" : 0.1}
+
+# Single variable filters : column => (minimum, maximum), both excluded
+BOUNDS={
+    "tilt" : (-1e6, 60.),
+    "kWp" : (0, 1e6),
+    "surface" : (0, 1e5),
+    "countArrays" : (0, 1e6)}
+
+# Minimum capacity per array
+MIN_CAPACITY=0
+
+# Capacities above this ratio to the surface (kWp / m2, once divided by 1000) are in W instead of kW, and rescaled
+RESCALE_RATIO=0.3425
+
+# Installations wrongly rescaled by the ratio, restored manually
+NOT_RESCALED=[36075, 10851, 4959, 31875]
+
+# Small surfaces with high rescaled capacity are not rescaled
+RESTORE_SURFACE_MAX=50.
+RESTORE_KWP_MIN=378000
+
+# Large surfaces with low capacity are rescaled
+RESCALE_SURFACE_MIN=500.
+RESCALE_KWP_MAX=10000
+
+# Remaining installations with a high capacity on a small surface are incoherent
+INCOHERENT_SURFACE_MAX=6000.
+INCOHERENT_KWP_MIN=1000
+
+# Range of the ratio of projected surfaces of the mask and of the metadata, for external consistency
+MIN_RATIO=0.75
+MAX_RATIO=1.25
+
+
+def polygon_stats(filename) :
+    """Number of polygons and total area (pixels) of each image of a polygon analysis, loaded once.
+    :return: DataFrame indexed by id, with columns 'nb_polygons' and 'area'"""
+    ids = []
+    nb_polygons = []
+    areas = []
+    for res in iter_js(filename) :
+        ids.append(str(res.id))
+        nb_polygons.append(len(res.polygons))
+        areas.append(sum(p.area for p in res.polygons))
+
+    stats = pd.DataFrame(dict(nb_polygons=nb_polygons, area=areas), index=pd.Index(ids, name="id"))
+    # Last result of an id wins, as in a dict
+    return stats[~stats.index.duplicated(keep="last")]
+
+
+def internal_consistency(table) :
+    """Add the column 'controlled' : the metadata of the installation are coherent.
+    :return: The table"""
+
+    coherent = np.ones(len(table), dtype=bool)
+    for column, (minimum, maximum) in BOUNDS.items() :
+        coherent &= ((table[column] < maximum) & (table[column] > minimum)).values
+    coherent &= (table["kWp"] / table["countArrays"] > MIN_CAPACITY).values
+
+    # Capacities in W are rescaled to kW
+    kWp = table["kWp"].values
+    surface = table["surface"].values
+    with np.errstate(divide="ignore", invalid="ignore") :
+        rescaled = (kWp / 1000) / surface >= RESCALE_RATIO
+    rescaled_kWp = np.where(rescaled, 1000 * kWp, kWp)
+
+    rescaled_kWp = np.where(table["idInstallation"].isin(NOT_RESCALED).values, kWp, rescaled_kWp)
+
+    restore = coherent & (surface <= RESTORE_SURFACE_MAX) & (rescaled_kWp >= RESTORE_KWP_MIN)
+    rescaled_kWp = np.where(restore, kWp, rescaled_kWp)
+
+    rescale = coherent & (surface >= RESCALE_SURFACE_MIN) & (rescaled_kWp <= RESCALE_KWP_MAX)
+    rescaled_kWp = np.where(rescale, kWp * 1000, rescaled_kWp)
+
+    incoherent = coherent & (surface <= INCOHERENT_SURFACE_MAX) & (rescaled_kWp / 1000 >= INCOHERENT_KWP_MIN)
+
+    table["controlled"] = coherent & ~incoherent
+    return table
+
+
+def external_consistency(table, campaign, stats, gsd=None) :
+    """Add the column '{campaign}Controlled' : the installation is controlled, its image has a single polygon,
+    and the projected surface of the polygon matches the one of the metadata.
+    :param campaign: 'Google' or 'IGN'
+    :param stats: Polygons of the images of the campaign, see polygon_stats()
+    :param gsd: Ground sampling distance of images (m / pixel). Default from CAMPAIGNS
+    :return: Projection table, with columns 'identifiant', 'estimated', 'target' and 'ratio', for images with a single polygon"""
+
+    if gsd is None :
+        gsd = CAMPAIGNS[campaign]
+
+    ids = table["identifiant"].astype(str)
+    unique = (ids.map(stats["nb_polygons"]) == 1).values
+
+    targets = table[unique]
+    projection = pd.DataFrame(dict(
+        identifiant=targets["identifiant"].values,
+        estimated=ids[unique].map(stats["area"]).values * (gsd ** 2),
+        target=targets["surface"].values * np.cos(targets["tilt"].values * np.pi / 180)))
+    projection["ratio"] = projection["estimated"] / projection["target"]
+
+    correct = projection[(projection["ratio"] < MAX_RATIO) & (projection["ratio"] > MIN_RATIO)]["identifiant"]
+    table["%sControlled" % campaign] = table["identifiant"].isin(correct.values).values & table["controlled"].values.astype(bool)
+
+    return projection
+
+
+def build_metadata(table, analysis_files) :
+    """Apply all filters.
+    :param table: Raw metadata (raw-metadata.csv)
+    :param analysis_files: Dict of campaign ('Google' or 'IGN') => polygon analysis file of this campaign
+    :return: Dict of campaign => projection table. The table is modified in place"""
+    internal_consistency(table)
+    return {campaign : external_consistency(table, campaign, polygon_stats(filename))
+            for campaign, filename in analysis_files.items()}
@@ -0,0 +1,180 @@
+"""Opt-in instrumentation : time spent per stage, latency of images, throughput and memory.
+Disabled by default : stage() then returns a shared no-op context, with negligible overhead"""
+import heapq
+import json
+import threading
+import time
+from contextlib import nullcontext
+
+try :
+    import resource
+except ImportError :
+    # Not available on Windows
+    resource = None
+
+# Upper bounds of buckets of the latency histogram (seconds)
+LATENCY_BUCKETS=(0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, float("inf"))
+
+# Number of slowest images reported
+NB_SLOWEST=10
+
+_NO_STAGE = nullcontext()
+
+class Stage :
+    """Context measuring the time of a stage"""
+
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+
+class Metrics :
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) :
+        # name => [count, total time, max time]
+        self.stages = dict()
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        # Heap of (latency, id)
+        self.slowest = []
+        self.images = 0
+        self.image_time = 0.0
+        self.start = time.perf_counter()
+
+    def stage(self, name) :
+        """Context measuring the time of a stage"""
+        if not self.enabled :
+            return _NO_STAGE
+        return Stage(self, name)
+
+    def add_time(self, name, duration) :
+        with self.lock :
+            stage = self.stages.get(name)
+            if stage is None :
+                self.stages[name] = [1, duration, duration]
+            else :
+                stage[0] += 1
+                stage[1] += duration
+                stage[2] = max(stage[2], duration)
+
+    def add_image(self, id, duration) :
+        """Record the processing time of an image"""
+        if not self.enabled :
+            return
+        with self.lock :
+            self.images += 1
+            self.image_time += duration
+            for idx, bound in enumerate(LATENCY_BUCKETS) :
+                if duration <= bound :
+                    self.histogram[idx] += 1
+                    break
+            if len(self.slowest) < NB_SLOWEST :
+                heapq.heappush(self.slowest, (duration, str(id)))
+            else :
+                heapq.heappushpop(self.slowest, (duration, str(id)))
+
+    def take(self) :
+        """Return and reset measures : used to send measures of workers to the main process"""
+        with self.lock :
+            res = dict(stages=self.stages, histogram=self.histogram, slowest=self.slowest, images=self.images, image_time=self.image_time)
+            self.reset()
+        return res
+
+    def merge(self, measures) :
+        with self.lock :
+            for name, (count, total, max_time) in measures["stages"].items() :
+                stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+                stage[0] += count
+                stage[1] += total
+                stage[2] = max(stage[2], max_time)
+            self.histogram = list(a + b for a, b in zip(self.histogram, measures["histogram"]))
+            self.slowest = heapq.nlargest(NB_SLOWEST, self.slowest + measures["slowest"])
+            heapq.heapify(self.slowest)
+            self.images += measures["images"]
+            self.image_time += measures["image_time"]
+
+    def report(self) :
+        """Measures as a dict"""
+        duration = time.perf_counter() - self.start
+        with self.lock :
+            return dict(
+                duration=duration,
+                images=self.images,
+                throughput=self.images / duration if duration > 0 else None,
+                peak_rss=peak_rss(),
+                peak_rss_children=peak_rss(children=True),
+                stages={name : dict(count=count, total=total, mean=total / count, max=max_time)
+                        for name, (count, total, max_time) in sorted(self.stages.items())},
+                image_time=self.image_time,
+                latency_histogram=list(dict(le=bound, count=count) for bound, count in zip(LATENCY_BUCKETS, self.histogram)),
+                slowest=list(dict(id=id, duration=latency) for latency, id in sorted(self.slowest, reverse=True)))
+
+    def write_json(self, filename) :
+        with open(filename, "w") as f :
+            json.dump(self.report(), f, indent=2, default=str)
+
+    def write_prometheus(self, filename, prefix="bdappv") :
+        """Write measures in the text format of Prometheus (node exporter textfile collector)"""
+        report = self.report()
+        lines = []
+
+        def metric(name, type, help, values) :
+            lines.append("# HELP %s_%s %s" % (prefix, name, help))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, type))
+            for labels, value in values :
+                lines.append("%s_%s%s %s" % (prefix, name, labels, repr(float(value))))
+
+        metric("run_duration_seconds", "gauge", "Duration of the run", [("", report["duration"])])
+        metric("images_total", "counter", "Number of images processed", [("", report["images"])])
+        metric("throughput_images_per_second", "gauge", "Images processed per second", [("", report["throughput"] or 0)])
+        if report["peak_rss"] is not None :
+            metric("peak_rss_bytes", "gauge", "Peak resident memory of the main process", [("", report["peak_rss"])])
+            metric("peak_rss_children_bytes", "gauge", "Peak resident memory of the largest worker process", [("", report["peak_rss_children"])])
+        metric("stage_seconds_total", "counter", "Total time spent per stage",
+               list(('{stage="%s"}' % name, stage["total"]) for name, stage in report["stages"].items()))
+        metric("stage_calls_total", "counter", "Number of calls per stage",
+               list(('{stage="%s"}' % name, stage["count"]) for name, stage in report["stages"].items()))
+
+        # Cumulative buckets
+        buckets = []
+        cumul = 0
+        for bucket in report["latency_histogram"] :
+            cumul += bucket["count"]
+            buckets.append(('{le="%s"}' % ("+Inf" if bucket["le"] == float("inf") else bucket["le"]), cumul))
+        lines.append("# HELP %s_image_seconds Processing time per image" % prefix)
+        lines.append("# TYPE %s_image_seconds histogram" % prefix)
+        for labels, value in buckets :
+            lines.append("%s_image_seconds_bucket%s %d" % (prefix, labels, value))
+        lines.append("%s_image_seconds_sum %s" % (prefix, repr(float(report["image_time"]))))
+        lines.append("%s_image_seconds_count %d" % (prefix, cumul))
+
+        with open(filename, "w") as f :
+            f.write("\n".join(lines) + "\n")
+
+
+def peak_rss(children=False) :
+    """Peak resident memory of the process, or of its largest terminated child, in bytes. None if unknown"""
+    if resource is None :
+        return None
+    # Kilobytes on Linux
+    return 1024 * resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+
+
+# Global metrics of the process
+METRICS = Metrics()
+
+def stage(name) :
+    """Context measuring the time of a stage in global metrics. No-op if they are disabled"""
+    return METRICS.stage(name)
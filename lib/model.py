@@ -1,20 +1,38 @@
 import json
 from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
 from typing import List
 
 import numpy as np
 
+@lru_cache(maxsize=None)
+def fields(clazz) :
+    """Names of __slots__ of a class and its parents, in order of declaration"""
+    return tuple(name for parent in reversed(clazz.__mro__) for name in parent.__dict__.get("__slots__", ()))
+
+def attributes(obj) :
+    """Attributes set on an object with __slots__, in order of declaration"""
+    res = OrderedDict()
+    for name in fields(type(obj)) :
+        if hasattr(obj, name) :
+            res[name] = getattr(obj, name)
+    return res
+
 class SimpleRepr(object):
     """A mixin implementing a simple __repr__."""
+    __slots__ = ()
+
     def __repr__(self):
         return "<{klass} @{id:x} {attrs}>".format(
             klass=self.__class__.__name__,
             id=id(self) & 0xFFFFFF,
-            attrs=" ".join("{}={!r}".format(k, v) for k, v in self.__dict__.items()),
+            attrs=" ".join("{}={!r}".format(k, v) for k, v in attributes(self).items()),
             )
 
 class Point(SimpleRepr) :
+   __slots__ = ("x", "y", "score")
+
    def __init__(self, x, y, score=None):
       self.x = x
       self.y = y
@@ -23,6 +41,8 @@ class Point(SimpleRepr) :
       self.score = score
 
 class Action(SimpleRepr) :
+   __slots__ = ("country", "region", "date", "actorId")
+
    def __init__(self, country, region, date, actorId):
       self.country = country
       self.region = region
@@ -30,6 +50,8 @@ class Action(SimpleRepr) :
       self.actorId = actorId
 
 class Click(Point) :
+   __slots__ = ("action",)
+
    def __init__(self, x, y, action=None, score=None):
       super().__init__(x, y)
       self.action = action
@@ -37,6 +59,8 @@ class Click(Point) :
         self.score=score
 
 class Polygon(SimpleRepr) :
+    __slots__ = ("points", "action", "score", "area")
+
     def __init__(self, action=None, score=None, area=None):
         self.points = []
         if action is not None :
@@ -47,6 +71,8 @@ class Polygon(SimpleRepr) :
             self.area = area
 
 class Image(SimpleRepr) :
+   __slots__ = ("clicks", "notPvActions", "polygons", "id", "city", "department", "region", "install_id")
+
    def __init__(self, id, city, department, region, install_id):
       self.clicks=[]
       self.notPvActions = []
@@ -57,16 +83,155 @@ class Image(SimpleRepr) :
       self.region = region
       self.install_id = install_id
 
+   def click_coords(self) :
+      """Coordinates of clicks, as arrays of x and y"""
+      return np.array(list(click.x for click in self.clicks)), np.array(list(click.y for click in self.clicks))
+
+   def polygon_points(self) :
+      """Vertices of each polygon, as arrays of shape (n, 2)"""
+      return list(np.array(list((pt.x, pt.y) for pt in poly.points)) for poly in self.polygons)
+
+   def polygon_actors(self) :
+      """Actor ids of each polygon"""
+      return list(poly.action.actorId for poly in self.polygons)
+
+class CompactImage(SimpleRepr) :
+    """Image holding its clicks and polygons in numpy arrays, with deduplicated actors and dates.
+    Accessors clicks, polygons and notPvActions build read only lists of objects, compatible with Image.
+    It is serialized as an Image."""
+
+    __slots__ = (
+        "id", "city", "department", "region", "install_id",
+        # Tables of distinct (country, region, actorId) and dates of actions
+        "actors", "dates",
+        # Clicks : coordinates, index of actor and date (-1 for no action)
+        "click_x", "click_y", "click_actor", "click_date",
+        # Actions of non PV answers
+        "not_pv_actor", "not_pv_date",
+        # Polygons : vertices of all polygons, offsets of each polygon in vertices, actor and date
+        "vertices", "poly_offsets", "poly_actor", "poly_date")
+
+    @classmethod
+    def from_image(cls, img) :
+        """Build from an Image, or from the dict of an Image (with attributes of children as dicts)"""
+
+        if isinstance(img, dict) :
+            get = lambda obj, key : obj.get(key)
+        else :
+            get = lambda obj, key : getattr(obj, key, None)
+
+        inst = cls.__new__(cls)
+        for key in ("id", "city", "department", "region", "install_id") :
+            setattr(inst, key, get(img, key))
+
+        actors = dict()
+        dates = dict()
+
+        def action_idx(action) :
+            if action is None :
+                return -1, -1
+            actor = (get(action, "country"), get(action, "region"), get(action, "actorId"))
+            return actors.setdefault(actor, len(actors)), dates.setdefault(get(action, "date"), len(dates))
+
+        def action_arrays(actions) :
+            idx = np.array(list(actions), dtype=np.int32).reshape(-1, 2)
+            return idx[:, 0].copy(), idx[:, 1].copy()
+
+        clicks = get(img, "clicks") or []
+        inst.click_x = np.array(list(get(click, "x") for click in clicks))
+        inst.click_y = np.array(list(get(click, "y") for click in clicks))
+        inst.click_actor, inst.click_date = action_arrays(action_idx(get(click, "action")) for click in clicks)
+
+        inst.not_pv_actor, inst.not_pv_date = action_arrays(action_idx(action) for action in get(img, "notPvActions") or [])
+
+        # Points may be compact [x, y] pairs
+        def xy(pt) :
+            return pt[:2] if isinstance(pt, list) else (get(pt, "x"), get(pt, "y"))
+
+        polygons = get(img, "polygons") or []
+        points = list(pt for poly in polygons for pt in get(poly, "points"))
+        inst.vertices = np.array(list(xy(pt) for pt in points)).reshape(-1, 2)
+        inst.poly_offsets = np.cumsum([0] + list(len(get(poly, "points")) for poly in polygons))
+        inst.poly_actor, inst.poly_date = action_arrays(action_idx(get(poly, "action")) for poly in polygons)
+
+        inst.actors = list(actors)
+        inst.dates = list(dates)
+
+        return inst
+
+    def _actions(self, actor_idx, date_idx) :
+        """List of Action, shared for same actor and date"""
+        cache = dict()
+        res = []
+        for actor, date in zip(actor_idx.tolist(), date_idx.tolist()) :
+            if actor < 0 :
+                res.append(None)
+                continue
+            if not (actor, date) in cache :
+                country, region, actorId = self.actors[actor]
+                cache[(actor, date)] = Action(country, region, self.dates[date], actorId)
+            res.append(cache[(actor, date)])
+        return res
+
+    @property
+    def clicks(self) :
+        actions = self._actions(self.click_actor, self.click_date)
+        return list(
+            Click(x, y, action)
+            for x, y, action in zip(self.click_x.tolist(), self.click_y.tolist(), actions))
+
+    @property
+    def notPvActions(self) :
+        return self._actions(self.not_pv_actor, self.not_pv_date)
+
+    @property
+    def polygons(self) :
+        res = []
+        for i, action in enumerate(self._actions(self.poly_actor, self.poly_date)) :
+            poly = Polygon(action)
+            start, end = self.poly_offsets[i], self.poly_offsets[i + 1]
+            poly.points = list(Point(x, y) for x, y in self.vertices[start:end].tolist())
+            res.append(poly)
+        return res
+
+    def click_coords(self) :
+        return self.click_x, self.click_y
+
+    def polygon_points(self) :
+        return np.split(self.vertices, self.poly_offsets[1:-1]) if len(self.poly_offsets) > 1 else []
+
+    def polygon_actors(self) :
+        return list(self.actors[actor][2] if actor >= 0 else None for actor in self.poly_actor.tolist())
+
+    def to_image(self) :
+        img = Image(self.id, self.city, self.department, self.region, self.install_id)
+        img.clicks = self.clicks
+        img.notPvActions = self.notPvActions
+        img.polygons = self.polygons
+        return img
+
 class ClickResult(SimpleRepr) :
-    def __init__(self, id):
+    __slots__ = ("id", "clicks", "threshold")
+
+    def __init__(self, id, threshold=None):
         self.id = id
         self.clicks = []
 
+        # For threshold sweeps only
+        if threshold is not None :
+            self.threshold = threshold
+
 class SurfaceResult(SimpleRepr):
-    def __init__(self, id):
+    __slots__ = ("id", "polygons", "threshold")
+
+    def __init__(self, id, threshold=None):
         self.id = id
         self.polygons : List[Polygon] = []
 
+        # For threshold sweeps only
+        if threshold is not None :
+            self.threshold = threshold
+
 # Register classes by names
 CLASSES = dict()
 for clazz in Point, Action, Click, Polygon, Image, ClickResult, SurfaceResult:
@@ -88,17 +253,115 @@ def to_dict(data) :
       return {key: to_dict(val) for key, val in data.items() if val is not None}
    elif isinstance(data, datetime) :
       return data.isoformat()
-   elif hasattr(data, '__dict__') :
+   elif isinstance(data, CompactImage) :
+      return to_dict(data.to_image())
+   elif isinstance(data, SimpleRepr) :
       dic = OrderedDict()
       dic["@type"] = type(data).__name__
-      dic.update(data.__dict__)
+      dic.update(attributes(data))
       return to_dict(dic)
    else :
       raise Exception("Not supported type ", type(data))
 
 def to_json(data, outfile) :
     out = open(outfile, "w") if isinstance(outfile, str) else outfile
-    json.dump(to_dict(data), out, indent=2, default=np_encoder)
+    json.dump(encode(data), out, indent=2, default=np_encoder)
+
+# Fields holding lists of points : written as [x, y] or [x, y, score] in compact mode
+POINT_FIELDS = {
+    Polygon : ("points",),
+    ClickResult : ("clicks",)}
+
+PRIMITIVES = (int, str, float, bool)
+
+class Codec :
+    """Fast encoder / decoder of a model class, with the same format as to_dict() / parse_dict().
+    Fields of the class are listed once, and values are dispatched by type. Unknown fields are ignored on decoding"""
+
+    def __init__(self, clazz, point_fields=()):
+        self.clazz = clazz
+        self.type_name = clazz.__name__
+        self.fields = fields(clazz)
+        self.known = frozenset(self.fields)
+        self.point_fields = point_fields
+
+    def encode(self, obj, compact=False) :
+        res = {"@type" : self.type_name}
+        for name in self.fields :
+            val = getattr(obj, name, None)
+            if val is None :
+                continue
+            if compact and name in self.point_fields :
+                res[name] = list(encode_point(pt) for pt in val)
+            else :
+                res[name] = encode(val, compact)
+        return res
+
+    def decode(self, data) :
+        inst = self.clazz.__new__(self.clazz)
+        for key, val in data.items() :
+            if key not in self.known :
+                continue
+            if key in self.point_fields :
+                val = list(Point(*pt) if type(pt) is list else pt for pt in val)
+            setattr(inst, key, val)
+        return inst
+
+# Codecs by class and by type name
+CODECS = {clazz : Codec(clazz, POINT_FIELDS.get(clazz, ())) for clazz in CLASSES.values()}
+DECODERS = {codec.type_name : codec for codec in CODECS.values()}
+
+def encode_point(pt) :
+    """Point as [x, y], or [x, y, score]"""
+    if type(pt) is not Point :
+        return encode(pt, True)
+    score = getattr(pt, "score", None)
+    return [pt.x, pt.y] if score is None else [pt.x, pt.y, score]
+
+def encode(data, compact=False) :
+    """Fast equivalent of to_dict().
+    :param compact: If True, write points of polygons and results as [x, y] pairs"""
+    clazz = type(data)
+    if clazz in PRIMITIVES :
+        return data
+    codec = CODECS.get(clazz)
+    if codec is not None :
+        return codec.encode(data, compact)
+    if clazz is list :
+        return list(encode(item, compact) for item in data)
+    if clazz is CompactImage :
+        return encode(data.to_image(), compact)
+    return to_dict(data)
+
+def parse_object(data) :
+    """ Hook for json decoders : instantiate objects with a @type as they are decoded """
+    type_name = data.pop("@type", None)
+    if type_name is None :
+        return data
+    return DECODERS[type_name].decode(data)
+
+def decode(data) :
+    """ Instantiate objects of a nested structure of dicts, like parse_dict(), with compact points """
+    clazz = type(data)
+    if clazz is list :
+        return list(decode(item) for item in data)
+    elif clazz is dict :
+        return parse_object({key: decode(val) for key, val in data.items()})
+    return data
+
+# Children of Image, kept as dicts by parse_compact
+IMAGE_CHILDREN = ("Point", "Click", "Action", "Polygon")
+
+def parse_compact(data) :
+    """ Hook for json decoders, like parse_object, but loading images as CompactImage """
+    typeName = data.get("@type")
+    if typeName in IMAGE_CHILDREN :
+        return data
+    elif typeName == "Image" :
+        return CompactImage.from_image(data)
+    else :
+        # Instantiate children left as dicts
+        return decode(data)
 
 def parse_dict(data) :
     """ Load a nested structure of dict into python objects """
@@ -108,6 +371,9 @@ def parse_dict(data) :
         return data
     elif isinstance(data, list):
         return list(parse_dict(item) for item in data)
+    elif isinstance(data, SimpleRepr):
+        # Already parsed
+        return data
 
     elif isinstance(data, dict):
         if "@type" in data :
@@ -115,8 +381,11 @@ def parse_dict(data) :
             typeName = data.pop("@type")
             clazz = CLASSES[typeName]
             inst = clazz.__new__(clazz)
+            known = fields(clazz)
             for key, val in data.items() :
-                setattr(inst, key, parse_dict(val))
+                # Fields of other versions
+                if key in known :
+                    setattr(inst, key, parse_dict(val))
             return inst
         else :
             # Raw dict
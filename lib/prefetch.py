@@ -0,0 +1,144 @@
+"""Bulk download of images into the local cache, with a pool of keep-alive connections"""
+import http.client
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+from progressbar import progressbar
+
+from lib import utils
+from lib.utils import eprint, image_url, image_cache, write_atomic
+
+DEFAULT_WORKERS=8
+DEFAULT_RETRIES=3
+# Delay before first retry, doubled on each retry (s)
+DEFAULT_BACKOFF=1.0
+DEFAULT_TIMEOUT=30
+
+# Client errors worth a retry : others (404...) fail at once
+RETRY_STATUS=(408, 429)
+
+class FetchError(Exception) :
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def retry(self) :
+        """Server errors may be transient, client errors are not"""
+        return self.status is None or self.status >= 500 or self.status in RETRY_STATUS
+
+class Downloader :
+    """HTTP client keeping one connection per thread and per host, reused between requests.
+    Connections of all threads are closed by close_all()"""
+
+    def __init__(self, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+        self.opened = set()
+        self.lock = threading.Lock()
+
+    def connection(self, scheme, netloc) :
+        if not hasattr(self.local, "connections") :
+            self.local.connections = dict()
+        key = (scheme, netloc)
+        if not key in self.local.connections :
+            clazz = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            conn = clazz(netloc, timeout=self.timeout)
+            self.local.connections[key] = conn
+            with self.lock :
+                self.opened.add(conn)
+        return self.local.connections[key]
+
+    def close(self, scheme, netloc) :
+        conn = self.local.connections.pop((scheme, netloc), None)
+        if conn is not None :
+            with self.lock :
+                self.opened.discard(conn)
+            conn.close()
+
+    def close_all(self) :
+        """Close connections of all threads. To be called once they are done"""
+        with self.lock :
+            opened = list(self.opened)
+            self.opened.clear()
+        for conn in opened :
+            conn.close()
+
+    def get(self, url) :
+        """Download an URL. Connection and server errors are retried, not client errors (see RETRY_STATUS). Returns its content"""
+        parts = urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+
+        for attempt in range(self.retries + 1) :
+            try :
+                conn = self.connection(parts.scheme, parts.netloc)
+                conn.request("GET", path)
+                res = conn.getresponse()
+                data = res.read()
+                if res.status != 200 :
+                    raise FetchError("HTTP %d for %s" % (res.status, url), res.status)
+                return data
+
+            except (OSError, http.client.HTTPException, FetchError) as e :
+                if isinstance(e, FetchError) and not e.retry :
+                    raise
+                # Connection may be broken : start a new one
+                self.close(parts.scheme, parts.netloc)
+                if attempt == self.retries :
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def download(self, url, out) :
+        """Download an URL to a file, atomically"""
+        write_atomic(out, self.get(url))
+
+
+def prefetch(ids, campaign, phase, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, progress=True) :
+    """Download images of given ids, that are not in cache yet.
+    :return: dict of counts 'cached', 'fetched', and list of 'failed' ids"""
+
+    cache = image_cache()
+    missing = list(id for id in ids if not cache.contains(campaign, phase, id))
+    stats = dict(cached=len(ids) - len(missing), fetched=0, failed=[])
+
+    if not missing :
+        return stats
+
+    downloader = Downloader(retries, backoff)
+
+    def download(id) :
+        path = cache.path(campaign, phase, id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        downloader.download(image_url(id, campaign, phase), path)
+        cache.add(campaign, phase, id)
+
+    try :
+        with ThreadPoolExecutor(workers) as executor :
+            futures = {executor.submit(download, id) : id for id in missing}
+
+            done = as_completed(futures)
+            if progress :
+                done = progressbar(done, max_value=len(futures))
+
+            for future in done :
+                try :
+                    future.result()
+                    stats["fetched"] += 1
+                except Exception as e :
+                    eprint("Failed to fetch image %s : %s" % (futures[future], e))
+                    stats["failed"].append(futures[future])
+    finally :
+        downloader.close_all()
+
+    return stats
+
+
+def set_url_pattern(pattern) :
+    """Change the URL pattern of images, for instance to use a mirror or a local server"""
+    utils.IMG_URL_PATTERN = pattern
@@ -0,0 +1,147 @@
+"""Headless rendering of diagnostic images with OpenCV : source image and heat map side by side, with annotations.
+Functions of numpy arrays only, without global state : safe in threads and processes, unlike pyplot.
+Colors are BGR, as OpenCV"""
+import cv2
+import numpy as np
+
+# Colormap of heat maps : viridis, as the default of matplotlib
+HEATMAP=cv2.COLORMAP_VIRIDIS
+
+# Values below are left blank, as NaN in plots
+MIN_HEAT=0.1
+
+BACKGROUND=(255, 255, 255)
+RED=(0, 0, 255)
+GREEN=(0, 255, 0)
+BLUE=(255, 0, 0)
+BLACK=(0, 0, 0)
+GRAY=(160, 160, 160)
+
+MARGIN=10
+LEGEND_HEIGHT=18
+COLORBAR_WIDTH=12
+FONT=cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE=0.4
+
+CLICK_SIZE=8
+MAXIMA_SIZE=14
+
+
+def to_bgr(image) :
+    """Image as read by load_image() (RGB(A), float in [0, 1] or uint8), as 8 bits BGR"""
+    if image.dtype != np.uint8 :
+        image = (np.clip(image, 0, 1) * 255).astype(np.uint8)
+    if image.ndim == 2 :
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(image[:, :, :3], cv2.COLOR_RGB2BGR)
+
+
+def max_value(matrix) :
+    """Maximum of a matrix, ignoring NaN. 0 if empty"""
+    return float(np.nanmax(matrix)) if np.any(matrix >= MIN_HEAT) else 0.
+
+
+def heatmap(matrix, vmax) :
+    """Colored heat map of a matrix, from 0 to vmax. Values below MIN_HEAT are blank"""
+    levels = np.clip(matrix * (255 / vmax), 0, 255).astype(np.uint8) if vmax > 0 else np.zeros(matrix.shape, np.uint8)
+    res = cv2.applyColorMap(levels, HEATMAP)
+    res[~(matrix >= MIN_HEAT)] = BACKGROUND
+    return res
+
+
+def colorbar(height, vmax) :
+    """Vertical scale of heat maps, with its bounds"""
+    levels = np.linspace(255, 0, height).astype(np.uint8)
+    bar = cv2.applyColorMap(np.repeat(levels[:, None], COLORBAR_WIDTH, axis=1), HEATMAP)
+
+    labels = ("%.1f" % vmax, "0")
+    width = max(cv2.getTextSize(label, FONT, FONT_SCALE, 1)[0][0] for label in labels)
+    res = np.full((height, COLORBAR_WIDTH + 4 + width, 3), BACKGROUND, np.uint8)
+    res[:, :COLORBAR_WIDTH] = bar
+    cv2.putText(res, labels[0], (COLORBAR_WIDTH + 4, 10), FONT, FONT_SCALE, BLACK, 1, cv2.LINE_AA)
+    cv2.putText(res, labels[1], (COLORBAR_WIDTH + 4, height - 2), FONT, FONT_SCALE, BLACK, 1, cv2.LINE_AA)
+    return res
+
+
+def draw_clicks(image, click_x, click_y) :
+    for x, y in zip(click_x, click_y) :
+        cv2.drawMarker(image, (int(x), int(y)), RED, cv2.MARKER_STAR, CLICK_SIZE, 1, cv2.LINE_AA)
+
+
+def draw_maximas(image, maxx, maxy, maxidx=None) :
+    """Selected points as black crosses, the one of index maxidx in green"""
+    for x, y in zip(maxx, maxy) :
+        cv2.drawMarker(image, (int(x), int(y)), BLACK, cv2.MARKER_TILTED_CROSS, MAXIMA_SIZE, 1, cv2.LINE_AA)
+    if maxidx is not None :
+        cv2.drawMarker(image, (int(maxx[maxidx]), int(maxy[maxidx])), GREEN, cv2.MARKER_TILTED_CROSS, MAXIMA_SIZE, 2, cv2.LINE_AA)
+
+
+def draw_polygons(image, polygons, color) :
+    """Outlines of polygons, as arrays of (x, y) points"""
+    cv2.polylines(image, list(np.asarray(pts, np.int32).reshape(-1, 1, 2) for pts in polygons), True, color, 1, cv2.LINE_AA)
+
+
+def legend(width, items) :
+    """Line of legend : list of (color, marker, label). Marker is an OpenCV marker type, or None for a line"""
+    res = np.full((LEGEND_HEIGHT, width, 3), BACKGROUND, np.uint8)
+    x = MARGIN
+    y = LEGEND_HEIGHT // 2
+    for color, marker, label in items :
+        if marker is None :
+            cv2.line(res, (x - 4, y), (x + 4, y), color, 2)
+        else :
+            cv2.drawMarker(res, (x, y), color, marker, CLICK_SIZE, 2)
+        cv2.putText(res, label, (x + 8, y + 4), FONT, FONT_SCALE, BLACK, 1, cv2.LINE_AA)
+        x += 20 + cv2.getTextSize(label, FONT, FONT_SCALE, 1)[0][0]
+    return res
+
+
+def side_by_side(image, heat, vmax, items) :
+    """Compose the source image and the heat map, with the scale and a legend on top"""
+    height, width = heat.shape[:2]
+    if image.shape[:2] != (height, width) :
+        image = cv2.resize(image, (width, height))
+    # Frame of the heat map, mostly blank
+    cv2.rectangle(heat, (0, 0), (width - 1, height - 1), GRAY, 1)
+
+    gap = np.full((height, MARGIN, 3), BACKGROUND, np.uint8)
+    row = np.hstack([gap, image, gap, heat, gap, colorbar(height, vmax), gap])
+    bottom = np.full((MARGIN, row.shape[1], 3), BACKGROUND, np.uint8)
+    return np.vstack([legend(row.shape[1], items), row, bottom])
+
+
+def click_plot(image, matrix, click_x, click_y, maxx, maxy, maxv, maxidx, threshold) :
+    """Diagnostic image of click analysis, as the plot of click_analysis.draw_plot()
+    :param image: Source image, as read by load_image()
+    :param matrix: Density of clicks
+    :param maxidx: Index of the point of maximum consensus, or None
+    :return: BGR image"""
+
+    vmax = max_value(matrix)
+    panels = (to_bgr(image), heatmap(matrix, vmax))
+    for panel in panels :
+        draw_clicks(panel, click_x, click_y)
+        draw_maximas(panel, maxx, maxy, maxidx)
+
+    items = [(RED, cv2.MARKER_STAR, "annotations"), (BLACK, cv2.MARKER_TILTED_CROSS, "selected points (> %0.1f)" % threshold)]
+    if maxidx is not None :
+        items.append((GREEN, cv2.MARKER_TILTED_CROSS, "maximum consensus (%0.1f)" % maxv[maxidx]))
+    return side_by_side(*panels, vmax, items)
+
+
+def polygon_plot(image, matrix, annotations, polygons, threshold) :
+    """Diagnostic image of polygon analysis : annotations in red, selected polygons in blue
+    :param image: Source image, as read by load_image()
+    :param matrix: Sum of polygon masks
+    :param annotations: Polygons of annotations, as arrays of (x, y) points
+    :param polygons: Selected polygons, as arrays of (x, y) points
+    :return: BGR image"""
+
+    vmax = max_value(matrix)
+    panels = (to_bgr(image), heatmap(matrix, vmax))
+    for panel in panels :
+        draw_polygons(panel, annotations, RED)
+        draw_polygons(panel, polygons, BLUE)
+
+    items = [(RED, None, "annotations"), (BLUE, None, "selected polygons (> %0.1f)" % threshold)]
+    return side_by_side(*panels, vmax, items)
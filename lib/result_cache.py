@@ -0,0 +1,119 @@
+"""On disk cache of analysis results, addressed by the hash of image annotations and analysis parameters"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from lib.model import encode, parse_object, np_encoder
+
+DEFAULT_MAX_SIZE=1024
+DEFAULT_MAX_AGE=30
+
+EXTENSION=".json"
+
+def dumps(data) :
+    return json.dumps(data, separators=(",", ":"), sort_keys=True, default=np_encoder)
+
+def content_key(item) :
+    """SHA1 of an item and all its annotations : changes when any of them is edited"""
+    return hashlib.sha1(dumps(encode(item)).encode()).hexdigest()
+
+
+class ResultCache :
+    """Results stored in {folder}/{shard}/{key}.json.
+    The key is the SHA1 of the image (all its annotations) and of the parameters of the analysis :
+    any change of them gives a new key, and old entries are eventually evicted"""
+
+    def __init__(self, folder, params, max_size=DEFAULT_MAX_SIZE, max_age=DEFAULT_MAX_AGE):
+        """
+        :param params: Dict of parameters of the analysis, including its version
+        :param max_size: Maximum size of the cache in MB
+        :param max_age: Maximum age of entries in days, since their last use"""
+        self.folder = folder
+        self.params = dumps(params)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def key(self, img) :
+        sha1 = hashlib.sha1(self.params.encode())
+        sha1.update(dumps(encode(img)).encode())
+        return sha1.hexdigest()
+
+    def path(self, key) :
+        return os.path.join(self.folder, key[:2], key + EXTENSION)
+
+    def get(self, key) :
+        """Cached results of a key, or None"""
+        path = self.path(key)
+        try :
+            with open(path) as f :
+                res = json.load(f, object_hook=parse_object)
+            # Last use, for eviction
+            os.utime(path)
+        except (OSError, ValueError) :
+            res = None
+
+        with self.lock :
+            if res is None :
+                self.misses += 1
+            else :
+                self.hits += 1
+        return res
+
+    def put(self, key, outs) :
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write atomically : concurrent readers never see partial entries
+        tmp = "%s.tmp-%d-%d" % (path, os.getpid(), threading.get_ident())
+        with open(tmp, "w") as f :
+            f.write(dumps(encode(outs)))
+        os.replace(tmp, path)
+
+    def take_counts(self) :
+        """Return and reset hit and miss counts : used to send counts of workers to the main process"""
+        with self.lock :
+            counts = (self.hits, self.misses)
+            self.hits = self.misses = 0
+        return counts
+
+    def add_counts(self, counts) :
+        with self.lock :
+            self.hits += counts[0]
+            self.misses += counts[1]
+
+    def evict(self) :
+        """Remove entries unused for more than max_age days, then least recently used ones above max_size.
+        :return: Number of entries removed"""
+        entries = []
+        for root, dirs, files in os.walk(self.folder) :
+            for file in files :
+                if file.endswith(EXTENSION) :
+                    path = os.path.join(root, file)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        min_time = time.time() - self.max_age * 24 * 3600
+        size = sum(entry[1] for entry in entries)
+        removed = 0
+        for mtime, file_size, path in entries :
+            if mtime >= min_time and size <= self.max_size * (1 << 20) :
+                break
+            os.remove(path)
+            size -= file_size
+            removed += 1
+        return removed
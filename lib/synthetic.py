@@ -0,0 +1,56 @@
+"""Generator of synthetic annotated images, for benchmarks and tests"""
+import math
+import random
+
+from lib.model import Image, Click, Action, Polygon, Point
+
+WIDTH=400
+HEIGHT=400
+
+# Radius of clicks and polygons around panels (pixels)
+SPREAD=15
+MIN_SIZE=10
+MAX_SIZE=60
+
+def synthetic_images(count, clicks=30, polygons=6, actors=20, vertices=4, panels=3, seed=0) :
+    """Generate images with clicks and polygons gathered around a few panels, as real annotations.
+    :param count: Number of images
+    :param clicks: Number of clicks per image
+    :param polygons: Number of polygons per image
+    :param actors: Number of distinct actors
+    :param vertices: Number of vertices per polygon
+    :param panels: Number of panels per image
+    :param seed: Seed of the generator : images are the same for the same parameters
+    :return: List of Image"""
+
+    rand = random.Random(seed)
+
+    def action(day) :
+        actor = rand.randrange(actors)
+        return Action("FR", "region-%d" % (actor % 13), "2019-01-%02dT10:00:00" % day, actor)
+
+    res = []
+    for i in range(count) :
+        img = Image(str(i), "city-%d" % (i % 100), "department-%d" % (i % 96), "region-%d" % (i % 13), i)
+
+        centers = list((rand.randint(MAX_SIZE, WIDTH - MAX_SIZE), rand.randint(MAX_SIZE, HEIGHT - MAX_SIZE)) for _ in range(panels))
+
+        for _ in range(clicks) :
+            x, y = rand.choice(centers)
+            img.clicks.append(Click(x + rand.randint(-SPREAD, SPREAD), y + rand.randint(-SPREAD, SPREAD), action(rand.randint(1, 28))))
+
+        for _ in range(polygons) :
+            x, y = rand.choice(centers)
+            radius = rand.randint(MIN_SIZE, MAX_SIZE) / 2
+            poly = Polygon(action(rand.randint(1, 28)))
+            for k in range(vertices) :
+                angle = 2 * math.pi * k / vertices + math.pi / 4
+                poly.points.append(Point(
+                    int(x + radius * math.cos(angle)) + rand.randint(-3, 3),
+                    int(y + radius * math.sin(angle)) + rand.randint(-3, 3)))
+            img.polygons.append(poly)
+
+        img.notPvActions.append(action(rand.randint(1, 28)))
+        res.append(img)
+
+    return res
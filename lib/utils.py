@@ -1,12 +1,20 @@
+import time
 import traceback
 import threading
-from contextlib import closing
+import multiprocessing
+import queue
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, nullcontext
+from functools import partial
 from urllib.parse import urlencode
 from urllib.request import Request, urlopen
 import os, sys
 import json
 
+import numpy as np
 from IPython.core.display import display
+from matplotlib.image import imread
 from ipywidgets import Output, HBox, Button
 from joblib import Parallel, delayed
 
@@ -14,15 +22,50 @@ from progressbar import progressbar
 from ipywidgets import HTML, VBox
 from plotly import graph_objects as go
 
-from lib.model import parse_dict, to_json
+from lib.cache import open_cache
+from lib import index as json_index
+from lib.images import ImageCache, LRU
+from lib.model import parse_dict, parse_object, parse_compact, encode, np_encoder, CompactImage
+from lib.result_cache import ResultCache, DEFAULT_MAX_SIZE, DEFAULT_MAX_AGE, content_key
+from lib.metrics import METRICS, stage
+from lib.io_stage import IO_STAGE, DEFAULT_FETCHERS, read_ahead
 import argparse
 from strenum import StrEnum
 
 
+# Size of chunks read by JsonStream
+READ_SIZE=1 << 16
+
+# Output formats of ResultWriter
+FORMAT_JSON="json"
+FORMAT_JSONL="jsonl"
+
+# Number of characters buffered by ResultWriter before writing
+WRITE_BUFFER_SIZE=1 << 16
+
+# Maximum number of images held for reordering results
+REORDER_SIZE=256
+
+# Execution backends of main_process
+BACKEND_THREAD="thread"
+BACKEND_PROCESS="process"
+
+# Number of images sent at once to process workers
+CHUNK_SIZE=16
+
+# Number of images whose source image is fetched ahead of processing, with --out or --display
+READ_AHEAD=16
+
+# Browsing in notebooks : number of items prepared ahead of the current one, and number of prepared items kept
+BROWSE_AHEAD=3
+BROWSE_CACHE_SIZE=32
+
 IMG_URL_PATTERN="https://www.bdpv.fr/_BDapPV/img{Campaign}{Surf}/img{Surf}_{id}.png"
 # Default folder
 CACHE_FOLDER="img/"
-CACHE_PATTERN="{campaign}/{phase}/{id}.png"
+
+# Decoded images, shared by renderers and notebooks
+DECODED_IMAGES=LRU()
 
 class Campaign(StrEnum) :
     GOOGLE="google"
@@ -33,43 +76,92 @@ class Phase(StrEnum) :
     SURF="surf"
 
 
+def write_atomic(out, data) :
+    """Write data to a temporary file, renamed once complete : no truncated file is left on failure"""
+    tmp = "%s.tmp-%d-%d" % (out, os.getpid(), threading.get_ident())
+    try :
+        with open(tmp, 'wb') as out_file:
+            out_file.write(data)
+        os.replace(tmp, out)
+    finally:
+        if os.path.exists(tmp) :
+            os.remove(tmp)
+
+
 def fetch(url, params, out) :
     """Fetch a file from an URL"""
     url = url + '?' + urlencode(params)
     req = Request(url)
 
     with closing(urlopen(req)) as res :
-        data = res.read()
-        with open(out, 'wb') as out_file:
-            out_file.write(data)
+        write_atomic(out, res.read())
+
+
+_image_cache = None
+
+def image_cache() :
+    """Cache of images in CACHE_FOLDER"""
+    global _image_cache
+    if _image_cache is None or _image_cache.folder != CACHE_FOLDER :
+        _image_cache = ImageCache(CACHE_FOLDER)
+    return _image_cache
 
 
 def img_path(campaign, phase, id) :
-    return os.path.join(CACHE_FOLDER, CACHE_PATTERN.format(id=id, campaign=campaign, phase=phase))
+    return image_cache().path(campaign, phase, id)
+
 
 
+def image_url(id, campaign, phase) :
+    return IMG_URL_PATTERN.format(
+        id=id,
+        Surf="" if phase == Phase.CLICK else "Surf",
+        Campaign=campaign.capitalize())
+
 
 def get_image(id, campaign, phase) :
 
     """Fetch image of given ID if not present in cache. Return local path"""
 
-    out_path = img_path(campaign, phase, id)
-
-    if not os.path.exists(out_path) :
+    cache = image_cache()
+    out_path = cache.path(campaign, phase, id)
 
-        folder = os.path.dirname(out_path)
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+    if not cache.contains(campaign, phase, id) :
 
-        url = IMG_URL_PATTERN.format(
-            id=id,
-            Surf="" if phase == Phase.CLICK else "Surf",
-            Campaign=campaign.capitalize())
+        # Fetched by another process since the manifest was loaded (prefetch of the main process)
+        if not os.path.exists(out_path) :
+            folder = os.path.dirname(out_path)
+            os.makedirs(folder, exist_ok=True)
 
-        fetch(url, {}, out_path)
+            fetch(image_url(id, campaign, phase), {}, out_path)
+        cache.add(campaign, phase, id)
 
     return out_path
 
+
+def prefetch_image(id, campaign, phase) :
+    """Fetch an image in the local cache, ahead of its use. Errors are only logged : the image is fetched again when used"""
+    try :
+        with stage("fetch") :
+            get_image(id, campaign, phase)
+    except Exception as e :
+        eprint("Cannot fetch image %s : %s" % (id, e))
+
+
+def load_image(id, campaign, phase) :
+    """Decoded image of given ID, fetched if needed. Images are kept in a LRU : they should not be modified"""
+
+    def load() :
+        with stage("image_io") :
+            try :
+                return imread(get_image(id, campaign, phase))
+            except FileNotFoundError :
+                # In the manifest, but removed from disk : fetch it again
+                image_cache().remove(campaign, phase, id)
+                return imread(get_image(id, campaign, phase))
+
+    return DECODED_IMAGES.get((str(campaign), str(phase), str(id)), load)
+
 class Arg :
     def __init__(self, *args, **kwargs):
         self.args = args
@@ -78,64 +170,489 @@ class Arg :
 def eprint(*args) :
     print(*args, file=sys.stderr)
 
+def parse_ids(value) :
+    """Parse --ids argument : comma separated list of ids, or @file with one id per line"""
+    if value.startswith("@") :
+        with open(value[1:]) as f :
+            return set(line.strip() for line in f if line.strip())
+    return set(value.split(","))
+
+def float_list(value) :
+    """Parse a comma separated list of floats"""
+    return list(float(val) for val in value.split(","))
+
+# Common argument for threshold sweeps
+THRESHOLDS_ARG = Arg('--thresholds', '-ts', type=float_list, metavar='t1,t2,t3',
+                     help="Sweep several thresholds in a single pass (overrides --threshold). "
+                          "Results are tagged with their threshold. "
+                          "If output_file contains '{threshold}', one file is written per threshold.")
+
+
+class ResultWriter :
+    """Streaming writer of results.
+    Format 'json' writes a valid JSON array, 'jsonl' writes one compact JSON document per line.
+    In ordered mode, results are written in the order of the sequence number of their input image :
+    at most reorder_size images are held in the buffer, writers of later images wait for earlier ones.
+    With compact_points, points are written as [x, y] pairs."""
+
+    def __init__(self, outfile, format=FORMAT_JSON, indent=None, ordered=False, reorder_size=REORDER_SIZE, compact_points=False):
+        self.outfile = outfile
+        self.format = format
+        self.compact_points = compact_points
+        self.ordered = ordered
+        self.reorder_size = reorder_size
+
+        self.encoder = json.JSONEncoder(
+            indent=indent if format == FORMAT_JSON else None,
+            separators=(",", ": ") if (indent is not None and format == FORMAT_JSON) else (",", ":"),
+            default=np_encoder)
+
+        self.cond = threading.Condition()
+        self.count = 0
+        self.next_seq = 0
+        self.pending = dict()
+        self.buffer = []
+        self.buffer_size = 0
+
+        if format == FORMAT_JSON :
+            self.outfile.write("[")
+
+    def write(self, outs, seq=None) :
+        """Write a list of results.
+        In ordered mode, seq is the sequence number of the input image :
+        each sequence number should be written exactly once, with an empty list if there is no result"""
 
-def main_process(img_function, extra_args=[]) :
+        try :
+            texts = list(self.encoder.encode(encode(out, self.compact_points)) for out in outs)
+        except Exception :
+            # Results of this image are skipped, its sequence number is still written : ordered output does not wait for it
+            eprint("Error on writing results of img %s" % ",".join(sorted(set(str(getattr(out, "id", "?")) for out in outs))))
+            traceback.print_exc()
+            texts = []
+
+        with self.cond :
+            if not self.ordered :
+                self._write(texts)
+                return
+
+            while seq >= self.next_seq + self.reorder_size :
+                self.cond.wait()
+
+            self.pending[seq] = texts
+            while self.next_seq in self.pending :
+                self._write(self.pending.pop(self.next_seq))
+                self.next_seq += 1
+
+            self.cond.notify_all()
+
+    def _write(self, texts) :
+        for text in texts :
+            if self.format == FORMAT_JSONL :
+                self.buffer.append(text + "\n")
+            else :
+                self.buffer.append(text if self.count == 0 else "," + text)
+            self.buffer_size += len(self.buffer[-1])
+            self.count += 1
+
+        if self.buffer_size >= WRITE_BUFFER_SIZE :
+            self._flush()
+
+    def _flush(self) :
+        self.outfile.write("".join(self.buffer))
+        self.buffer = []
+        self.buffer_size = 0
+
+    def close(self) :
+        with self.cond :
+            # Remaining gaps in sequence : should not happen
+            for seq in sorted(self.pending) :
+                self._write(self.pending.pop(seq))
+
+            if self.format == FORMAT_JSON :
+                self.buffer.append("]\n")
+            self._flush()
+
+            if self.outfile is sys.stdout :
+                self.outfile.flush()
+            else:
+                self.outfile.close()
+
+
+def open_output(filename) :
+    """Open output file, or stdout for '-'"""
+    return sys.stdout if filename == '-' else open(filename, 'w')
+
+
+def process_image(img_function, img, ids, kwargs, cache=None) :
+    """Call img_function on an image, logging errors.
+    If a ResultCache is provided, results of images already processed are read from it
+    :return: List of results"""
+    try :
+        if ids and not img.id in ids :
+            return []
+
+        if METRICS.enabled :
+            start = time.perf_counter()
+            outs = _process_image(img_function, img, kwargs, cache)
+            METRICS.add_image(img.id, time.perf_counter() - start)
+            return outs
+        return _process_image(img_function, img, kwargs, cache)
+
+    except Exception as e :
+        eprint("Error on img %s" %img.id)
+        traceback.print_exc()
+        return []
+
+def _process_image(img_function, img, kwargs, cache) :
+
+    if cache is not None :
+        with stage("result_cache") :
+            key = cache.key(img)
+            outs = cache.get(key)
+        if outs is not None :
+            return outs
+
+    outs = as_list(img_function(img, **kwargs))
+
+    if cache is not None :
+        with stage("result_cache") :
+            cache.put(key, outs)
+    return outs
+
+
+def as_list(outs) :
+    """Results of an image as a list : img_function may return a result, a list of results or None"""
+    if outs is None :
+        return []
+    if not isinstance(outs, list) :
+        return [outs]
+    return outs
+
+
+def process_batch(batch_function, imgs, ids, kwargs, cache=None) :
+    """Call batch_function on a list of images, with the same filter, result cache and metrics as process_image().
+    On error, images of the batch are processed one at a time, by process_image() : errors are logged per image
+    :return: List of results per image"""
+
+    res = [[] for img in imgs]
+    todo = []
+    keys = dict()
+    for idx, img in enumerate(imgs) :
+        if ids and not img.id in ids :
+            continue
+        if cache is not None :
+            start = time.perf_counter()
+            with stage("result_cache") :
+                keys[idx] = cache.key(img)
+                outs = cache.get(keys[idx])
+            if outs is not None :
+                res[idx] = outs
+                METRICS.add_image(img.id, time.perf_counter() - start)
+                continue
+        todo.append(idx)
+
+    if not todo :
+        return res
+
+    try :
+        start = time.perf_counter()
+        batch_outs = batch_function(list(imgs[idx] for idx in todo), **kwargs)
+        # Time of the batch is shared by its images
+        duration = (time.perf_counter() - start) / len(todo)
+    except Exception as e :
+        eprint("Error on batch of img %s : processing them one at a time" % ",".join(str(imgs[idx].id) for idx in todo))
+        traceback.print_exc()
+        # Batches of one image : same results as the batch, for the result cache
+        def single(img, **kwargs) :
+            return batch_function([img], **kwargs)[0]
+        for idx in todo :
+            res[idx] = process_image(single, imgs[idx], None, kwargs, cache)
+        return res
+
+    for idx, outs in zip(todo, batch_outs) :
+        res[idx] = as_list(outs)
+        METRICS.add_image(imgs[idx].id, duration)
+        if cache is not None :
+            with stage("result_cache") :
+                cache.put(keys[idx], res[idx])
+    return res
+
+
+def process_block(img_function, batch_function, block, ids, kwargs, cache=None) :
+    """Process a list of (seq, img), in a single batch if batch_function is provided.
+    :return: List of (seq, results)"""
+    if batch_function is None :
+        return list((seq, process_image(img_function, img, ids, kwargs, cache)) for seq, img in block)
+    outs = process_batch(batch_function, list(img for seq, img in block), ids, kwargs, cache)
+    return list(zip((seq for seq, img in block), outs))
+
+
+# State of process workers, set once by init_worker()
+_worker_args = None
+
+def init_worker(*args, metrics=False, io=False) :
+    global _worker_args
+    _worker_args = args
+    METRICS.enabled = metrics
+    # Output images are written in background, images are prefetched by the main process
+    if io :
+        IO_STAGE.start(fetchers=0)
+
+def process_chunk(chunk) :
+    """Process a chunk of (seq, img) in a worker. Returns list of (seq, results),
+    and stats of the worker : hit / miss counts of result cache, metrics and errors of output images
+    With a cached dataset, images are sent as their index in it.
+    With a batch_function, the chunk is processed in batches of batch_size"""
+    img_function, ids, kwargs, dataset, cache, batch_function, batch_size = _worker_args
+    if dataset is not None :
+        with stage("load") :
+            chunk = list((seq, dataset[img]) for seq, img in chunk)
+    results = []
+    for block in chunks(chunk, batch_size) :
+        results += process_block(img_function, batch_function, block, ids, kwargs, cache)
+    # Output images of the chunk are written before it is returned
+    IO_STAGE.wait()
+    stats = dict(
+        cache=cache.take_counts() if cache is not None else None,
+        metrics=METRICS.take() if METRICS.enabled else None,
+        io_errors=IO_STAGE.take_errors())
+    return results, stats
+
+
+# End of iteration in timed() : items may be None
+END=object()
+
+def timed(items, name) :
+    """Iterate over items, measuring the time to get each of them as a stage"""
+    items = iter(items)
+    while True :
+        with stage(name) :
+            item = next(items, END)
+        if item is END :
+            return
+        yield item
+
+
+def chunks(items, size) :
+    """Group items in lists of given size"""
+    chunk = []
+    for item in items :
+        chunk.append(item)
+        if len(chunk) == size :
+            yield chunk
+            chunk = []
+    if chunk :
+        yield chunk
+
+
+def pool_map(pool, func, tasks, max_pending, ordered=False) :
+    """Results of func(task) run by a process pool, like pool.imap() or pool.imap_unordered(),
+    with at most max_pending tasks submitted and not returned yet, to keep streaming input.
+    Tasks are submitted by the calling thread, with apply_async() : no thread of the pool waits for them,
+    and errors of workers or interruptions can terminate the pool"""
+    finished = queue.Queue()
+    results = dict()
+    submitted = 0
+    returned = 0
+
+    def take() :
+        nonlocal returned
+        while not (returned in results if ordered else results) :
+            num, value, error = finished.get()
+            if error is not None :
+                raise error
+            results[num] = value
+        returned += 1
+        return results.pop(returned - 1) if ordered else results.popitem()[1]
+
+    for task in tasks :
+        while submitted - returned >= max_pending :
+            yield take()
+        pool.apply_async(func, (task,),
+                         callback=lambda value, num=submitted : finished.put((num, value, None)),
+                         error_callback=lambda error, num=submitted : finished.put((num, None, error)))
+        submitted += 1
+
+    while returned < submitted :
+        yield take()
+
+
+def main_process(img_function, extra_args=[], cache_params=None, argv=None, batch_function=None, fetch_phase=None, check_args=None) :
     """Common parser of input arguments for analysis script.
     Parameters :
-        img_function(img) - function called for every image."""
+        img_function(img) - function called for every image. Returns a result, a list of results or None
+        cache_params(args) - function returning the dict of parameters results depend on, including the version of the analysis.
+            Required by --result-cache
+        argv - List of arguments, sys.argv by default
+        batch_function(imgs) - optional function processing a list of images at once. Returns a list of results of img_function.
+            Enables --batch-size
+        fetch_phase - Phase of source images used by img_function with --out or --display : they are fetched ahead of processing.
+            Or function(args) returning it, or None if no source image is used
+        check_args(args) - optional function returning an error message for invalid combinations of arguments, or None"""
 
     parser = argparse.ArgumentParser()
     parser.add_argument('input_file', type=str, help="Input file, or '-' for stdin")
     parser.add_argument('output_file', type=str, help="Output file, or '-' for stdout")
     parser.add_argument('--display', "-d", action='store_true', help="Display plots")
-    parser.add_argument('--parallel', "-p", action='store_true', help="Parallel compute")
+    parser.add_argument('--parallel', "-p", action='store_true', help="Parallel compute : same as --workers 4 --backend thread")
+    parser.add_argument('--workers', "-w", type=int, metavar='N', help="Number of parallel workers")
+    parser.add_argument('--backend', "-b", choices=[BACKEND_THREAD, BACKEND_PROCESS], default=BACKEND_THREAD,
+                        help="Parallel backend : 'thread' (default) or 'process'")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, metavar='N',
+                        help="Number of images sent at once to process workers. %d by default" % CHUNK_SIZE)
     parser.add_argument('--out', "-o",  metavar='out_dir', help="Output folder for processed images")
-    parser.add_argument('--ids', "-i", metavar='id1,id2,id3', help="Filter on ids")
+    parser.add_argument('--campaign', "-c", choices=[Campaign.GOOGLE, Campaign.IGN], default=Campaign.GOOGLE,
+                        help="Campaign of source images, shown with --out and --display : 'google' (default) or 'ign'")
+    parser.add_argument('--io-workers', type=int, default=DEFAULT_FETCHERS, metavar='N',
+                        help="Number of threads fetching source images in background, with --out and --display. %d by default" % DEFAULT_FETCHERS)
+    parser.add_argument('--ids', "-i", metavar='id1,id2,id3', help="Filter on ids, or @file with one id per line")
+    parser.add_argument('--compact', action='store_true', help="Load images in compact numpy arrays (CompactImage)")
+    parser.add_argument('--no-cache', action='store_true', help="Ignore the binary cache of input file (see build-cache.py)")
+    parser.add_argument('--format', "-f", choices=[FORMAT_JSON, FORMAT_JSONL], default=FORMAT_JSON,
+                        help="Output format : 'json' (default) for a JSON array, 'jsonl' for one result per line")
+    parser.add_argument('--indent', type=int, metavar='N', help="Indent JSON output. Compact by default")
+    parser.add_argument('--ordered', action='store_true', help="Keep the order of input images in output, with --parallel")
+    parser.add_argument('--compact-points', action='store_true', help="Write points as [x, y] pairs instead of objects")
+    parser.add_argument('--quiet', "-q", action='store_true', help="Hide progress bar")
+    parser.add_argument('--metrics', metavar='report.json',
+                        help="Measure time per stage and per image, throughput and memory, and write them to this JSON file")
+    parser.add_argument('--metrics-prom', metavar='metrics.prom',
+                        help="Same as --metrics, in the text format of Prometheus")
+    parser.add_argument('--result-cache', metavar='cache_dir',
+                        help="Folder of cached results : images with the same annotations and parameters are not processed again. "
+                             "Ignored with --out and --display")
+    parser.add_argument('--result-cache-size', type=int, default=DEFAULT_MAX_SIZE, metavar='MB',
+                        help="Maximum size of the result cache. %d MB by default" % DEFAULT_MAX_SIZE)
+    parser.add_argument('--result-cache-age', type=int, default=DEFAULT_MAX_AGE, metavar='DAYS',
+                        help="Results unused for this number of days are evicted. %d days by default" % DEFAULT_MAX_AGE)
+
+    if batch_function is not None :
+        parser.add_argument('--batch-size', type=int, default=1, metavar='N',
+                            help="Process images by batches of N, in single vectorized passes. 1 (one image at a time) by default")
 
     for arg in extra_args :
         parser.add_argument(*arg.args, **arg.kwargs)
 
-    args = parser.parse_args()
-
-    imgs = load_js(args.input_file)
-
-    if not isinstance(imgs, list) :
-        imgs = [imgs]
-
-    outfile = sys.stdout if args.output_file == '-' else open(args.output_file, 'w')
-    out_lock = threading.Lock()
-
-    ids = args.ids.split(",") if args.ids else None
-
-    def safe_function(img) :
-        if ids and not img.id in ids :
-            return
-        try :
-            out = img_function(img, **vars(args))
-            if out is not None :
-                with out_lock:
-                    to_json(out, outfile)
-                    outfile.write(",")
-
-        except Exception as e :
-            eprint("Error on img %s" %img.id)
-            traceback.print_exc()
+    args = parser.parse_args(argv)
+    error = check_args(args) if check_args is not None else None
+    if error :
+        parser.error(error)
+
+    METRICS.enabled = bool(args.metrics or args.metrics_prom)
+    METRICS.reset()
+
+    ids = parse_ids(args.ids) if args.ids else None
+
+    # Images are read from cache, or parsed as they are processed.
+    # With --ids, only the requested images are read : from the cache, or through the index of the input file
+    dataset = None if args.no_cache else open_cache(args.input_file)
+    index = json_index.open_index(args.input_file, compact=args.compact) if ids is not None and dataset is None else None
+    if dataset is not None :
+        positions = range(len(dataset)) if ids is None else dataset.find_ids(ids)
+        imgs = dataset if ids is None else list(dataset[pos] for pos in positions)
+    elif index is not None :
+        imgs = index.lookup(ids)
+    else :
+        imgs = iter_js(args.input_file, compact=args.compact, use_cache=False)
+    if METRICS.enabled :
+        imgs = timed(imgs, "load")
 
-    outfile.write("[")
+    def open_writer(filename) :
+        return ResultWriter(open_output(filename), args.format, args.indent, args.ordered, compact_points=args.compact_points)
 
-    # Parallel code ?
-    if args.parallel :
-        scheduler = Parallel(n_jobs=4, backend="threading")
-        scheduler(delayed(safe_function)(img) for img in progressbar(imgs))
+    # One output per threshold ?
+    thresholds = getattr(args, "thresholds", None)
+    if thresholds and "{threshold}" in args.output_file :
+        writers = {threshold : open_writer(args.output_file.format(threshold=threshold)) for threshold in thresholds}
     else :
-        for img in progressbar(imgs) :
-            safe_function(img)
+        writers = {None : open_writer(args.output_file)}
+
+    def write(seq, outs) :
+        with stage("write") :
+            for threshold, writer in writers.items() :
+                if threshold is None :
+                    writer.write(outs, seq)
+                else:
+                    writer.write(list(out for out in outs if out.threshold == threshold), seq)
+
+    kwargs = vars(args)
+
+    workers = args.workers if args.workers else (4 if args.parallel else 1)
+    progress = (lambda items : items) if args.quiet else progressbar
+
+    # Images are also written by img_function with --out and --display : no cache
+    cache = None
+    if args.result_cache and cache_params is not None and not args.out and not args.display :
+        cache = ResultCache(args.result_cache, cache_params(args), args.result_cache_size, args.result_cache_age)
+
+    batch_size = getattr(args, "batch_size", 1)
+    if batch_size <= 1 :
+        batch_function = None
+
+    # Source images are fetched, and output images are written, in background
+    io = bool(args.out or args.display)
+    if callable(fetch_phase) :
+        fetch_phase = fetch_phase(args)
+    io_errors = 0
+    if io :
+        IO_STAGE.start(fetchers=args.io_workers)
+
+    def fetch_ahead(items, get_img=lambda img : img) :
+        """Fetch source images of items ahead of their processing"""
+        if not io or fetch_phase is None :
+            return items
+        return read_ahead(items, lambda item : IO_STAGE.fetch(prefetch_image, get_img(item).id, args.campaign, fetch_phase), READ_AHEAD)
+
+    def safe_function(block) :
+        for seq, outs in process_block(img_function, batch_function, block, ids, kwargs, cache) :
+            write(seq, outs)
+
+    if workers > 1 and args.backend == BACKEND_PROCESS :
+
+        # Workers map the cache themselves : only send indices
+        items = fetch_ahead(positions, lambda pos : dataset[pos]) if dataset is not None else fetch_ahead(imgs)
+        # Chunks hold at least a batch
+        tasks = chunks(enumerate(progress(items)), max(args.chunk_size, batch_size))
+
+        initializer = partial(init_worker, metrics=METRICS.enabled, io=io)
+        initargs = (img_function, ids, kwargs, dataset, cache, batch_function, batch_size)
+        with multiprocessing.Pool(workers, initializer=initializer, initargs=initargs) as pool :
+            # Limit the number of chunks in flight, to keep streaming input
+            for chunk_results, stats in pool_map(pool, process_chunk, tasks, 2 * workers, args.ordered) :
+                if stats["cache"] is not None :
+                    cache.add_counts(stats["cache"])
+                if stats["metrics"] is not None :
+                    METRICS.merge(stats["metrics"])
+                io_errors += stats["io_errors"]
+                for seq, outs in chunk_results :
+                    write(seq, outs)
+
+    elif workers > 1 :
+        scheduler = Parallel(n_jobs=workers, backend="threading")
+        scheduler(delayed(safe_function)(block) for block in chunks(enumerate(progress(fetch_ahead(imgs))), batch_size))
+    else :
+        for block in chunks(enumerate(progress(fetch_ahead(imgs))), batch_size) :
+            safe_function(block)
+
+    IO_STAGE.stop()
+    io_errors += IO_STAGE.take_errors()
+    if io_errors :
+        eprint("%d errors while writing output images" % io_errors)
 
-    # Delete the last ","
-    outfile.seek(outfile.tell() - 1)
-    outfile.write("]")
+    for writer in writers.values() :
+        writer.close()
 
+    if cache is not None :
+        removed = cache.evict()
+        eprint("Result cache : %d hits, %d misses, %d entries evicted" % (cache.hits, cache.misses, removed))
 
+    if METRICS.enabled :
+        if args.metrics :
+            METRICS.write_json(args.metrics)
+        if args.metrics_prom :
+            METRICS.write_prometheus(args.metrics_prom)
+        report = METRICS.report()
+        eprint("%d images in %.1f s : %.1f images/s" % (report["images"], report["duration"], report["throughput"] or 0))
 
 
 def interactive_plot(df, fig, template, event="hover") :
@@ -162,30 +679,243 @@ def interactive_plot(df, fig, template, event="hover") :
     return VBox([fig, html])
 
 
-def load_js(filename):
-    if filename == '-':
-        infile = sys.stdin
-    else:
-        infile = open(filename, 'r')
+class JsonStream :
+    """Incremental reader of a JSON file made of a top level array.
+    Items are decoded one at a time, so that memory is bounded by the size of a single item.
+    Objects with a @type are instantiated as they are decoded.
+    If the document is not an array, is_array is False and its values are decoded one after another until the end of file :
+    a single value, or one value per line (JSON lines, as written by ResultWriter).
+    If compact is True, images are loaded as CompactImage. If raw is True, objects are decoded as dicts.
+    spans() also gives the byte offsets of items, for files opened as UTF-8 with newline=''."""
+
+    def __init__(self, infile, read_size=READ_SIZE, compact=False, raw=False):
+        self.infile = infile
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder() if raw else json.JSONDecoder(object_hook=parse_compact if compact else parse_object)
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+        # Number of bytes before buf[cursor]
+        self.cursor = 0
+        self.cursor_bytes = 0
+
+        self.is_array = self._peek() == "["
+        if self.is_array :
+            self.pos += 1
+
+    def _read(self, size) :
+        data = self.infile.read(size)
+        if not data :
+            self.eof = True
+        self._byte_offset(self.pos)
+        self.cursor = 0
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def _byte_offset(self, pos) :
+        """Offset in the file of a position in buf, in UTF-8 bytes. Positions should not decrease"""
+        self.cursor_bytes += len(self.buf[self.cursor:pos].encode("utf-8"))
+        self.cursor = pos
+        return self.cursor_bytes
+
+    def _peek(self) :
+        """Skip whitespaces and return next char, or None at the end of file"""
+        while True :
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace() :
+                self.pos += 1
+            if self.pos < len(self.buf) :
+                return self.buf[self.pos]
+            if self.eof :
+                return None
+            self._read(self.read_size)
+
+    def _decode(self) :
+        """Decode next value, reading more data until it is complete"""
+        while True :
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number may continue in next chunk
+                if end < len(self.buf) or self.eof :
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError :
+                if self.eof :
+                    raise
+
+            # Grow reads to keep parsing of large items linear
+            self._read(max(self.read_size, len(self.buf)))
+
+    def __iter__(self):
+
+        if not self.is_array :
+            while self._peek() is not None :
+                yield self._decode()
+            return
+
+        for value, start, end in self.spans() :
+            yield value
+
+    def spans(self) :
+        """Iterate over items of the array, as (item, start, end) : offsets of the item in the file, in bytes"""
+        first = True
+        while True :
+            char = self._peek()
+            if char == "]" :
+                return
+            if not first :
+                if char != "," :
+                    raise json.JSONDecodeError("Expecting ',' delimiter", self.buf, self.pos)
+                self.pos += 1
+                self._peek()
+            first = False
+            start = self._byte_offset(self.pos)
+            value = self._decode()
+            yield value, start, self._byte_offset(self.pos)
+
+
+def open_input(filename) :
+    """Open input file, or stdin for '-'"""
+    return nullcontext(sys.stdin) if filename == '-' else open(filename, 'r')
+
+
+def cached_items(dataset, compact) :
+    """Images of a binary cache, as CompactImage if compact, else as Image : lists of CompactImage are read only"""
+    if compact :
+        return iter(dataset)
+    return (img.to_image() if isinstance(img, CompactImage) else img for img in dataset)
+
+
+def iter_js(filename, compact=False, use_cache=True) :
+    """Iterate over the items of a JSON file, one at a time.
+    If compact is True, images are loaded as CompactImage.
+    If the file has a valid binary cache (see build-cache.py), images are read from it"""
+
+    dataset = open_cache(filename) if use_cache else None
+    if dataset is not None :
+        yield from cached_items(dataset, compact)
+        return
+
+    with open_input(filename) as infile :
+        yield from JsonStream(infile, compact=compact)
 
-    js = json.load(infile)
 
-    return parse_dict(js)
+def load_js(filename, compact=False, use_cache=True):
+    """Load all items of a JSON file. A JSON array, or JSON lines (.jsonl or several values), is returned as a list,
+    a single value as it is"""
 
+    dataset = open_cache(filename) if use_cache else None
+    if dataset is not None :
+        return list(cached_items(dataset, compact))
 
-def previous_next(items, func, **extra_args) :
-    """Meta interactive function to navigate through a list with preivus / next buttons """
+    with open_input(filename) as infile :
+        stream = JsonStream(infile, compact=compact)
+        items = list(stream)
+
+    if stream.is_array or len(items) != 1 or filename.endswith(".jsonl") :
+        return items
+    return items[0]
+
+
+def display_key(item, *params) :
+    """Key of an item in a Memo : its content, so that edited or reloaded items are prepared again, and parameters"""
+    return (content_key(item),) + params
+
+
+class Memo :
+    """Thread safe memo of the last values computed, by key.
+    A value being computed in another thread is waited for, instead of being computed again"""
+
+    def __init__(self, size=BROWSE_CACHE_SIZE):
+        self.size = size
+        # key => Future
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute) :
+        """Get a value, or compute it with compute() and keep it"""
+        with self.lock :
+            future = self.items.get(key)
+            created = future is None
+            if created :
+                future = self.items[key] = Future()
+                self._evict()
+            else :
+                self.items.move_to_end(key)
+
+        if not created :
+            return future.result()
+
+        try :
+            value = compute()
+        except Exception as e :
+            # Not kept : computed again on next call
+            with self.lock :
+                if self.items.get(key) is future :
+                    del self.items[key]
+            future.set_exception(e)
+            raise
+        future.set_result(value)
+        return value
+
+    def _evict(self) :
+        """Remove oldest values, but not the ones being computed"""
+        for key in list(self.items) :
+            if len(self.items) <= self.size :
+                break
+            if self.items[key].done() :
+                del self.items[key]
+
+    def clear(self) :
+        with self.lock :
+            self.items.clear()
+
+
+class Prefetcher :
+    """Background thread calling a function on items ahead of their use, typically to fill a Memo.
+    Items still waiting are dropped when new ones are requested"""
+
+    # Single thread shared by all prefetchers : widgets of notebooks are never closed
+    executor = ThreadPoolExecutor(1)
+
+    def __init__(self, func, **extra_args):
+        self.func = func
+        self.extra_args = extra_args
+        self.pending = []
+
+    def prefetch(self, items) :
+        for future in self.pending :
+            future.cancel()
+        self.pending = list(self.executor.submit(self._call, item) for item in items)
+
+    def _call(self, item) :
+        try :
+            self.func(item, **self.extra_args)
+        except Exception as e :
+            # Raised again when the item is shown
+            eprint("Cannot prepare item : %s" % e)
+
+
+def previous_next(items, func, prefetch=None, ahead=BROWSE_AHEAD, **extra_args) :
+    """Meta interactive function to navigate through a list with preivus / next buttons
+    If prefetch is set, prefetch(item, **extra_args) is called in background on the next items while one is shown :
+    it should prepare items in a Memo used by func (see prepare_display() of analysis scripts)"""
 
     previous_button = Button(description="Previous")
     next_button = Button(description="Next")
     output = Output()
 
     i = 0
+    prefetcher = Prefetcher(prefetch, **extra_args) if prefetch else None
 
     def show_current() :
         with  output :
             output.clear_output(wait=True)
             func(items[i], **extra_args)
+        if prefetcher :
+            # Next items first, then the previous one
+            positions = list(range(i + 1, i + 1 + ahead)) + [i - 1]
+            prefetcher.prefetch(list(items[pos] for pos in positions if 0 <= pos < len(items)))
 
     def previous(*args) :
         nonlocal i
@@ -209,15 +939,32 @@ def previous_next(items, func, **extra_args) :
 
 
 
-def interactive_plot(df, fig, display_func, event="hover"):
+def nearest_points(trace, ind, count) :
+    """Indices of the count points of a scatter trace nearest to point ind, relatively to the ranges of axes.
+    Next points if coordinates are not numbers"""
+    try :
+        coords = np.array([trace.x, trace.y], dtype=float).T
+    except (TypeError, ValueError) :
+        return list(range(ind + 1, min(ind + 1 + count, len(trace.x))))
+
+    scale = np.nanmax(coords, axis=0) - np.nanmin(coords, axis=0)
+    scale[~(scale > 0)] = 1
+    dist = np.sum(((coords - coords[ind]) / scale) ** 2, axis=1)
+    dist[ind] = np.inf
+    return np.argsort(dist, kind="stable")[:count].tolist()
+
+
+def interactive_plot(df, fig, display_func, event="hover", prefetch=None, ahead=BROWSE_AHEAD):
     """
     Make a plot react on hover or click of a data point and update a HTML preview below it.
     **template** Should be a string and contain placeholders like {colname} to be replaced by the value
     of the corresponding data row.
+    If prefetch is set, prefetch(row) is called in background on the nearest points of the one shown (see previous_next())
 
     """
 
     output = Output()
+    prefetcher = Prefetcher(prefetch) if prefetch else None
 
     def update(trace, points, state):
         ind = points.point_inds[0]
@@ -225,6 +972,8 @@ def interactive_plot(df, fig, display_func, event="hover"):
         with output :
             output.clear_output(wait=True)
             display_func(row)
+        if prefetcher :
+            prefetcher.prefetch(list(df.loc[pos].to_dict() for pos in nearest_points(trace, ind, ahead)))
 
     fig = go.FigureWidget(data=fig.data, layout=fig.layout)
 
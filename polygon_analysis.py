@@ -6,8 +6,11 @@ import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 
+from lib import render
+from lib.io_stage import write_output, write_png
+from lib.metrics import stage
 from lib.model import Polygon, Point, Image, SurfaceResult
-from lib.utils import get_image, main_process, Arg, Campaign, Phase
+from lib.utils import load_image, main_process, Arg, Campaign, Phase, Memo, THRESHOLDS_ARG, display_key
 
 WIDTH=400
 HEIGHT=400
@@ -17,6 +20,13 @@ THRESHOLD_AREA=100
 IMAGE_TYPE_THRES="threshold"
 IMAGE_TYPE_POLY="polygon"
 IMAGE_TYPE_ALL="all"
+IMAGE_TYPE_PLOT="plot"
+
+# Analyses and source images displayed in notebooks, see prepare_display()
+DISPLAYS=Memo()
+
+# Version of the analysis : to be increased when results change, to invalidate cached results
+VERSION=1
 
 def draw_polys(polys, label, selected_idx=None, color="red") :
     first=True
@@ -38,77 +48,186 @@ def points2cv2(points) :
     """Transform list of points to be used by opencv2"""
     return np.array([[pt.x, pt.y] for pt in points]).astype(np.int32)
 
-def process_img(
-        img : Image, threshold=DEFAULT_THRESHOLD, out=None,
-        image_type=IMAGE_TYPE_THRES, display=False, campaign=Campaign.GOOGLE,
-        polys_to_draw=None,
-        selected_idx=None, **kwargs):
+def polygons_mask(polygons, value=255) :
+    """Binary mask of a list of polygons, as segmentation masks of the dataset"""
+    mask = np.zeros((WIDTH, HEIGHT), np.uint8)
+    for poly in polygons:
+        cv2.fillPoly(mask, [points2cv2(poly.points)], (value,))
+    return mask
 
-        matrix = np.zeros((WIDTH, HEIGHT))
+def bbox_mask(pts, dtype=np.uint8) :
+    """Mask of a polygon, limited to its bounding box within the image.
+    :return: Mask and bounding box (x0, y0, x1, y1), or None if the polygon is outside of the image"""
 
-        res = SurfaceResult(img.id)
+    x0, y0 = np.maximum(pts.min(axis=0), 0)
+    x1, y1 = np.minimum(pts.max(axis=0) + 1, (WIDTH, HEIGHT))
+    if x0 >= x1 or y0 >= y1 :
+        return None, None
 
-        # No input polygon ? Not part of phase 2 : skip.
-        if len(img.polygons) == 0 :
-            return None
+    mask = np.zeros((y1 - y0, x1 - x0), dtype)
+    cv2.fillPoly(mask, [pts], 1, offset=(-int(x0), -int(y0)))
+    return mask, (x0, y0, x1, y1)
+
+
+def render_plot(filename, img_id, campaign, matrix, annotations, polygons, threshold) :
+    """Render the diagnostic image of an image to a PNG file, with OpenCV"""
+    image = load_image(img_id, phase=Phase.SURF, campaign=campaign)
+    with stage("render") :
+        write_png(filename, render.polygon_plot(image, matrix, annotations, polygons, threshold))
+
+
+def accumulate_polygons(img : Image) :
+    """Sum of the masks of all polygons of an image, blurred to prevent noise"""
+
+    matrix = np.zeros((WIDTH, HEIGHT))
+
+    # Draw polygons, in place, within their bounding box only
+    for pts in img.polygon_points() :
+
+        mask, bbox = bbox_mask(pts.astype(np.int32))
+        if mask is None :
+            continue
+
+        x0, y0, x1, y1 = bbox
+        matrix[y0:y1, x0:x1] += mask
+
+    # Blur image to prevent noise
+    return cv2.blur(matrix, (3, 3))
+
+
+def extract_polygons(img_id, matrix, threshold, nb_actors, tag=False) :
+    """Find polygons of the thresholded matrix.
+    :param tag: If true, tag the result with the threshold
+    :return: SurfaceResult, threshold mask and absolute threshold"""
+
+    res = SurfaceResult(img_id, threshold if tag else None)
+
+    # Threshold < 1 is ratio of number of actors
+    if threshold < 1 :
+        threshold = threshold * nb_actors
+
+    # Apply threshold
+    ret, thres = cv2.threshold(matrix, threshold, 255, 0)
+    thres = thres.astype(np.uint8)
+
+    # Find polygons in the resulting threshold mask
+    contours, _ = cv2.findContours(thres, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    for contour in contours :
+
+        area = cv2.contourArea(contour)
+        if area < THRESHOLD_AREA :
+            continue
 
-        # Draw polygons
-        for poly in img.polygons :
+        epsilon = 0.01 * cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, epsilon, True)
 
-            pts = list((pt.x, pt.y) for pt in poly.points)
+        points = list(Point(pt[0][0], pt[0][1]) for pt in approx)
 
-            poly_img = np.zeros((WIDTH, HEIGHT), np.uint8)
-            cv2.fillPoly(poly_img, np.array([pts]), 1)
+        # Compute score as mean of values within polygon, in its bounding box
+        poly_mask, (x0, y0, x1, y1) = bbox_mask(points2cv2(points), np.int8)
 
-            matrix += poly_img
+        # Mean value
+        score = np.sum(matrix[y0:y1, x0:x1] * poly_mask) / np.sum(poly_mask)
 
-        # Blur image to prevent noise
-        matrix = cv2.blur(matrix, (3, 3))
+        # Update output
+        poly = Polygon(score=score, area=area)
+        poly.points = points
 
-        nb_actors = len(set(poly.action.actorId for poly in img.polygons))
+        res.polygons.append(poly)
 
-        # Threshold < 1 is ratio of number of actors
-        if threshold < 1 :
-            threshold = threshold * nb_actors
+    return res, thres, threshold
 
-        # Apply threshold
-        ret, thres = cv2.threshold(matrix, threshold, 255, 0)
-        thres = thres.astype(np.uint8)
 
-        # Find polygons in the resulting threshold mask
-        contours, _ = cv2.findContours(thres, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+def analyse(img : Image, threshold=DEFAULT_THRESHOLD, thresholds=None) :
+    """Accumulate the polygons of an image, and extract the ones above threshold. See process_img() for parameters.
+    :return: Result, threshold mask, absolute threshold and matrix of accumulated polygons. For a sweep, list of results instead of result.
+        None if the image has no polygon"""
 
-        for contour in contours :
+    polygon_actors = img.polygon_actors()
 
-            area = cv2.contourArea(contour)
-            if area < THRESHOLD_AREA :
-                continue
+    # No input polygon ? Not part of phase 2 : skip.
+    if len(polygon_actors) == 0 :
+        return None
 
-            epsilon = 0.01 * cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, epsilon, True)
+    with stage("rasterize") :
+        matrix = accumulate_polygons(img)
 
-            points = list(Point(pt[0][0], pt[0][1]) for pt in approx)
+    nb_actors = len(set(polygon_actors))
 
-            # Compute score as mean of values within polygon
-            poly_mask = np.zeros((WIDTH, HEIGHT), np.int8)
-            pts = points2cv2(points)
-            cv2.fillPoly(poly_mask, [pts], 1)
+    # Threshold sweep : same matrix for all thresholds
+    if thresholds :
+        results = []
+        with stage("contours") :
+            for thres in thresholds :
+                res, _, _ = extract_polygons(img.id, matrix, thres, nb_actors, tag=True)
+                if len(res.polygons) > 0 :
+                    results.append(res)
+        return results, None, None, matrix
 
-            # Mean value
-            score = np.sum(matrix * poly_mask) / np.sum(poly_mask)
+    with stage("contours") :
+        res, thres, threshold = extract_polygons(img.id, matrix, threshold, nb_actors)
 
-            # Update output
-            poly = Polygon(score=score, area=area)
-            poly.points = points
+    return res, thres, threshold, matrix
 
-            res.polygons.append(poly)
 
-        if out :
+def prepare_display(img : Image, threshold=DEFAULT_THRESHOLD, campaign=Campaign.GOOGLE, **kwargs) :
+    """Analysis and source image of an image to display, memoized by annotations and parameters.
+    Safe in background threads : notebooks prepare the next images while one is shown (see previous_next()).
+    Other arguments of process_img() are ignored.
+    :return: Result, threshold mask, absolute threshold, matrix of accumulated polygons and source image.
+        None if the image has no polygon. They should not be modified"""
+
+    def prepare() :
+        analysis = analyse(img, threshold)
+        if analysis is None :
+            return None
+        return analysis + (load_image(img.id, phase=Phase.SURF, campaign=campaign),)
+
+    return DISPLAYS.get(display_key(img, threshold, str(campaign)), prepare)
+
+
+def process_img(
+        img : Image, threshold=DEFAULT_THRESHOLD, out=None,
+        image_type=IMAGE_TYPE_THRES, display=False, campaign=Campaign.GOOGLE,
+        polys_to_draw=None,
+        selected_idx=None, thresholds=None, **kwargs):
+        """
+        :param thresholds: List of thresholds to sweep in a single pass. Overrides threshold. No image is drawn.
+        :return: SurfaceResult or None if no polygon is found.
+            For a sweep, list of results (one per threshold with a match), tagged with their threshold
+        """
+
+        # Threshold sweep : no image is drawn
+        if thresholds :
+            analysis = analyse(img, thresholds=thresholds)
+            return analysis[0] if analysis is not None else None
+
+        if display :
+            # Memoized : see prepare_display()
+            analysis = prepare_display(img, threshold, campaign)
+        else :
+            analysis = analyse(img, threshold)
+
+        # No input polygon ? Not part of phase 2 : skip.
+        if analysis is None :
+            return None
+
+        res, thres, threshold, matrix = analysis[:4]
+
+        if out and image_type == IMAGE_TYPE_PLOT :
+
+            selected_polys = polys_to_draw if polys_to_draw else res.polygons
+            write_output(render_plot, os.path.join(out, "%s.png" % img.id), img.id, campaign,
+                         matrix, img.polygon_points(), list(points2cv2(poly.points) for poly in selected_polys), threshold)
+
+        elif out :
 
             if image_type == IMAGE_TYPE_THRES :
                 out_img = thres
 
             elif image_type == IMAGE_TYPE_ALL :
+                nb_actors = len(set(img.polygon_actors()))
                 out_matrix = (matrix * 255 / nb_actors).astype(np.uint8)
                 out_matrix[thres == 0] = 0
 
@@ -118,22 +237,20 @@ def process_img(
 
 
             elif image_type == IMAGE_TYPE_POLY :
-                out_img = np.zeros((WIDTH, HEIGHT), np.uint8)
-                for poly in res.polygons:
-                    cv2.fillPoly(out_img, [points2cv2(poly.points)], (255,))
+                out_img = polygons_mask(res.polygons)
 
-            cv2.imwrite(os.path.join(out, "%s.png" % img.id), out_img)
+            write_output(write_png, os.path.join(out, "%s.png" % img.id), out_img)
 
         # Plots
         if display :
 
             fig = plt.gcf()
 
-            path = get_image(img.id, phase=Phase.SURF, campaign=campaign)
-            image = plt.imread(path)
+            image = analysis[4]
 
             heat_ax = plt.subplot2grid((1, 2), (0, 1))
-            matrix[matrix < 0.1] = np.nan
+            # Not in place : the matrix may be rendered in background
+            matrix = np.where(matrix < 0.1, np.nan, matrix)
             heat_plt = plt.imshow(matrix)
             # draw_polys(polys, selected_idx)
 
@@ -165,14 +282,26 @@ def process_img(
 
 
 
-if __name__ == '__main__':
+def cache_params(args) :
+    """Parameters of the analysis, for the result cache"""
+    return dict(version=VERSION, threshold_area=THRESHOLD_AREA, threshold=args.threshold, thresholds=args.thresholds)
+
 
+def main(argv=None) :
     threshold_arg = Arg('--threshold', '-t', type=float, default=DEFAULT_THRESHOLD,
                         help="Threshold value as fraction of number of actors. %.2f by default" % DEFAULT_THRESHOLD)
-    image_type = Arg('--image-type', '-it', choices=[IMAGE_TYPE_POLY, IMAGE_TYPE_THRES, IMAGE_TYPE_ALL], default=IMAGE_TYPE_THRES,
+    image_type = Arg('--image-type', '-it', choices=[IMAGE_TYPE_POLY, IMAGE_TYPE_THRES, IMAGE_TYPE_ALL, IMAGE_TYPE_PLOT], default=IMAGE_TYPE_THRES,
                         help="Type of output images. "
                              "'polygon' : Outputs binary image of best polygon. "
                              "'threshold (default)' : Outputs binary image of threshold (before detection of polygon). "
-                             "'all' : Outputs both raw level of detection in gray and final polygon in red.")
+                             "'all' : Outputs both raw level of detection in gray and final polygon in red. "
+                             "'plot' : Outputs source image and level of detection side by side, with annotations in red and selected polygons in blue.")
+
+    # Source images are only used by plots
+    fetch_phase = lambda args : Phase.SURF if args.display or args.image_type == IMAGE_TYPE_PLOT else None
 
-    main_process(process_img, [threshold_arg, image_type])
\ No newline at end of file
+    main_process(process_img, [threshold_arg, THRESHOLDS_ARG, image_type], cache_params, argv, fetch_phase=fetch_phase)
+
+
+if __name__ == '__main__':
+    main()
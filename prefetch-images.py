@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# This script downloads in bulk the images of an input or result file into the local image cache.
+#
+import argparse
+import sys
+
+from lib.prefetch import prefetch, set_url_pattern, DEFAULT_WORKERS, DEFAULT_RETRIES, DEFAULT_BACKOFF
+from lib.utils import Campaign, Phase, iter_js, parse_ids
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file', type=str, help="JSON file of images or results, or '-' for stdin")
+    parser.add_argument('--campaign', '-c', type=str, choices=[Campaign.IGN, Campaign.GOOGLE], default=Campaign.GOOGLE,
+                        help="Campaign : either 'google' (default) or 'ign'")
+    parser.add_argument('--phase', type=str, choices=[Phase.CLICK, Phase.SURF], default=Phase.CLICK,
+                        help="Phase of the images : either 'click' (default) or 'surf'")
+    parser.add_argument('--ids', "-i", metavar='id1,id2,id3', help="Filter on ids, or @file with one id per line")
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_WORKERS,
+                        help="Number of parallel downloads. %d by default" % DEFAULT_WORKERS)
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help="Number of retries of downloads failed on connection or server errors. %d by default" % DEFAULT_RETRIES)
+    parser.add_argument('--backoff', type=float, default=DEFAULT_BACKOFF,
+                        help="Delay before first retry, doubled on each retry. %.1f s by default" % DEFAULT_BACKOFF)
+    parser.add_argument('--url-pattern', type=str, help="URL pattern of images, with placeholders {id}, {Campaign} and {Surf}")
+    args = parser.parse_args()
+
+    if args.url_pattern :
+        set_url_pattern(args.url_pattern)
+
+    ids = list(item.id for item in iter_js(args.input_file))
+    if args.ids :
+        filter = parse_ids(args.ids)
+        ids = list(id for id in ids if str(id) in filter)
+
+    stats = prefetch(ids, args.campaign, args.phase, args.workers, args.retries, args.backoff)
+
+    print("%d images already cached, %d fetched, %d failed" % (stats["cached"], stats["fetched"], len(stats["failed"])))
+    if stats["failed"] :
+        sys.exit(1)
@@ -0,0 +1,49 @@
+"""Memoized analyses of images browsed in notebooks"""
+import threading
+
+from lib.model import Click
+from lib.synthetic import synthetic_images
+from lib.utils import Memo, Prefetcher, display_key
+
+
+def test_display_key() :
+    img, other = synthetic_images(2)
+    key = display_key(img, 2.0, "google")
+    assert display_key(img, 2.0, "google") == key
+    assert display_key(img, 1.0, "google") != key
+    assert display_key(other, 2.0, "google") != key
+
+    # Edited annotations
+    img.clicks.append(Click(10, 20))
+    assert display_key(img, 2.0, "google") != key
+
+
+def test_memo() :
+    memo = Memo(size=2)
+    calls = []
+
+    def compute(value) :
+        return lambda : calls.append(value) or value
+
+    assert memo.get("a", compute(1)) == 1
+    assert memo.get("a", compute(2)) == 1
+    memo.get("b", compute(3))
+    memo.get("c", compute(4))
+    # Oldest key evicted
+    assert memo.get("a", compute(5)) == 5
+    assert calls == [1, 3, 4, 5]
+
+
+def test_prefetchers_share_thread() :
+    threads = set()
+    done = threading.Event()
+
+    def prepare(item) :
+        threads.add(threading.current_thread())
+        if item == "last" :
+            done.set()
+
+    Prefetcher(prepare).prefetch(["a", "b"])
+    Prefetcher(prepare).prefetch(["c", "last"])
+    assert done.wait(5)
+    assert len(threads) == 1
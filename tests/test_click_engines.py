@@ -0,0 +1,118 @@
+"""Density engines of click analysis, against the dense reference engine"""
+import numpy as np
+import pytest
+
+import click_analysis
+
+# Number of random click sets of each kind
+NB_SETS = 20
+
+
+def random_clicks(rand, kind) :
+    """Clicks spread over the image, gathered around a few panels, or between pixels and outside of the image"""
+    count = rand.randint(1, 60)
+    if kind == "spread" :
+        return rand.randint(0, 400, count).astype(float), rand.randint(0, 400, count).astype(float)
+    if kind == "panels" :
+        panels = rand.randint(30, 370, (rand.randint(1, 5), 2))
+        centers = panels[rand.randint(0, len(panels), count)]
+        return (np.clip(centers[:, 0] + rand.randint(-40, 41, count), 0, 399).astype(float),
+                np.clip(centers[:, 1] + rand.randint(-40, 41, count), 0, 399).astype(float))
+    return rand.uniform(-10, 410, count), rand.uniform(-10, 410, count)
+
+
+def click_sets() :
+    rand = np.random.RandomState(0)
+    return list(random_clicks(rand, kind) for kind in ("spread", "panels", "off_grid") for _ in range(NB_SETS))
+
+
+def dense_maximas(click_x, click_y) :
+    matrix = click_analysis.density_matrix(click_x, click_y, engine=click_analysis.ENGINE_DENSE)
+    maxx, maxy = click_analysis.find_maximas(matrix)
+    return maxx, maxy, matrix[maxy, maxx]
+
+
+def assert_same_maximas(expected, actual) :
+    """Same maximas and scores. Order of maximas of equal scores may differ by rounding"""
+    maxx, maxy, scores = expected
+    x, y, values = actual
+    assert sorted(zip(maxx.tolist(), maxy.tolist())) == sorted(zip(x.tolist(), y.tolist()))
+    by_point = dict(zip(zip(x.tolist(), y.tolist()), values))
+    assert np.allclose([by_point[point] for point in zip(maxx.tolist(), maxy.tolist())], scores, rtol=1e-9)
+    assert np.allclose(values, np.sort(scores)[::-1], rtol=1e-9)
+
+
+def test_coarse_engine() :
+    for click_x, click_y in click_sets() :
+        assert_same_maximas(dense_maximas(click_x, click_y), click_analysis.coarse_maximas(click_x, click_y))
+
+
+def test_maximas_along_ridge() :
+    """Two clicks at about 2 sigma : maximas of pixels between them are no mode of the density, nor reached from a click"""
+    click_x = np.array([170., 108., 122., 324.])
+    click_y = np.array([234., 13., 216., 30.])
+    maxx, maxy, scores = click_analysis.coarse_maximas(click_x, click_y)
+    assert (146, 225) in zip(maxx.tolist(), maxy.tolist())
+    assert_same_maximas(dense_maximas(click_x, click_y), (maxx, maxy, scores))
+
+
+def close_maximas(expected, matrix, actual, tolerance) :
+    """Maximas of expected above 0.5, higher than the pixels at 2 pixels by more than twice the tolerance,
+    have a maxima of actual at 1 pixel, of same score within tolerance. Others may vanish, or appear, on flat tops and slopes"""
+    maxx, maxy, scores = expected
+    x, y, values = actual
+    for px, py, score in zip(maxx, maxy, scores) :
+        window = matrix[max(py - 2, 0):py + 3, max(px - 2, 0):px + 3].copy()
+        window[1:-1, 1:-1] = -np.inf
+        if score >= 0.5 and score - window.max() > 2 * tolerance :
+            near = (np.abs(x - px) <= 1) & (np.abs(y - py) <= 1)
+            assert np.any(near), "No maxima close to (%d, %d)" % (px, py)
+            assert np.min(np.abs(values[near] - score)) <= tolerance
+
+
+@pytest.mark.parametrize("engine", [click_analysis.ENGINE_WINDOW, click_analysis.ENGINE_SEPARABLE])
+def test_truncated_engines(engine) :
+    """Truncated kernels : the density is the dense one within the truncation error of each kernel"""
+    error = np.exp(-click_analysis.TRUNCATE ** 2 / 2)
+    for click_x, click_y in click_sets() :
+        dense = click_analysis.density_matrix(click_x, click_y, engine=click_analysis.ENGINE_DENSE)
+        matrix = click_analysis.density_matrix(click_x, click_y, engine=engine)
+        tolerance = error * len(click_x)
+        assert np.max(np.abs(matrix - dense)) <= tolerance
+
+        maxx, maxy = click_analysis.find_maximas(matrix)
+        expected = dense_maximas(click_x, click_y)
+        actual = (maxx, maxy, matrix[maxy, maxx])
+        close_maximas(expected, dense, actual, tolerance)
+        close_maximas(actual, matrix, expected, tolerance)
+
+
+def test_window_and_separable() :
+    """Same truncated kernels : same density, up to rounding"""
+    for click_x, click_y in click_sets() :
+        window = click_analysis.density_matrix(click_x, click_y, engine=click_analysis.ENGINE_WINDOW)
+        separable = click_analysis.density_matrix(click_x, click_y, engine=click_analysis.ENGINE_SEPARABLE)
+        assert np.allclose(window, separable, rtol=1e-9, atol=1e-12)
+
+
+def test_batch_density() :
+    """Batches of images of any number of clicks, including none and a busy one : same density as the separable engine"""
+    rand = np.random.RandomState(1)
+    coords = click_sets()[:10] + [(np.zeros(0), np.zeros(0)), random_clicks(rand, "off_grid")]
+    coords.append((rand.randint(0, 400, 500).astype(float), rand.randint(0, 400, 500).astype(float)))
+
+    matrices = click_analysis.batch_density(coords)
+    for (click_x, click_y), matrix in zip(coords, matrices) :
+        separable = click_analysis.density_matrix(click_x, click_y, engine=click_analysis.ENGINE_SEPARABLE)
+        assert np.allclose(matrix, separable, rtol=1e-9, atol=1e-12)
+
+
+def test_batch_groups() :
+    counts = [3, 500, 0, 40, 70, 33, 90, 1000]
+    groups = click_analysis.batch_groups(counts)
+    assert sorted(idx for group in groups for idx in group) == list(range(len(counts)))
+    for group in groups :
+        sizes = list(counts[idx] for idx in group)
+        assert max(sizes) <= max(2 * min(sizes), click_analysis.BATCH_MIN_CLICKS)
+    # Busy images do not pad small ones
+    assert sorted(next(group for group in groups if 0 in group)) == [0, 2]
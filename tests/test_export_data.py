@@ -0,0 +1,113 @@
+"""Incremental export of export-data.py, on a SQLite copy of the DB"""
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+from lib.utils import load_js
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCHEMA = """
+CREATE TABLE prd_bdappv_image (idImage INTEGER, identifiant TEXT, idInstallation INTEGER);
+CREATE TABLE pv_installation (id_utilisateur INTEGER, ville TEXT, departement TEXT);
+CREATE TABLE pv_departement (numero TEXT, region TEXT, nom TEXT);
+CREATE TABLE prd_bdappv_bosseur (idBosseur INTEGER, region TEXT, pays TEXT);
+CREATE TABLE prd_bdappv_bosseurAction (idAction INTEGER, idImage INTEGER, sourceImg INTEGER, dateAction TEXT, idBosseur INTEGER);
+CREATE TABLE prd_bdappv_actionPV (idActionPV INTEGER, coordX INTEGER, coordY INTEGER, pv INTEGER);
+CREATE TABLE prd_bdappv_zoneSurface (idSurface INTEGER, idActionSurface INTEGER);
+CREATE TABLE prd_bdappv_zoneSurfacePoint (idSurfacePoint INTEGER, idSurface INTEGER, coordX INTEGER, coordY INTEGER);
+"""
+
+# Source of images for clicks and polygons of the google campaign
+CLICK_SRC = 1
+POLYGON_SRC = 4
+
+
+class Db :
+
+    def __init__(self, path) :
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+        self.conn.execute("INSERT INTO pv_departement VALUES ('01', 'ARA', 'Ain')")
+        self.conn.execute("INSERT INTO prd_bdappv_bosseur VALUES (1, 'ARA', 'France'), (2, 'IDF', 'France')")
+        for id in (1, 2, 3) :
+            self.conn.execute("INSERT INTO prd_bdappv_image VALUES (?, ?, ?)", (id, "img%d" % id, id))
+            self.conn.execute("INSERT INTO pv_installation VALUES (?, 'Lyon', '01')", (id,))
+        self.conn.commit()
+        self.next_id = 1
+
+    def _action(self, image, source, date, actor) :
+        id = self.next_id
+        self.next_id += 1
+        self.conn.execute("INSERT INTO prd_bdappv_bosseurAction VALUES (?, ?, ?, ?, ?)", (id, image, source, date, actor))
+        return id
+
+    def click(self, image, date, actor, x, y, pv=1) :
+        id = self._action(image, CLICK_SRC, date, actor)
+        self.conn.execute("INSERT INTO prd_bdappv_actionPV VALUES (?, ?, ?, ?)", (id, x, y, pv))
+        self.conn.commit()
+
+    def polygon(self, image, date, actor, points) :
+        id = self._action(image, POLYGON_SRC, date, actor)
+        self.conn.execute("INSERT INTO prd_bdappv_zoneSurface VALUES (?, ?)", (id, id))
+        for x, y in points :
+            self.conn.execute("INSERT INTO prd_bdappv_zoneSurfacePoint VALUES (?, ?, ?, ?)", (self.next_id, id, x, y))
+            self.next_id += 1
+        self.conn.commit()
+
+
+def export(db_path, out, *args) :
+    subprocess.run([sys.executable, "export-data.py", out, "--sqlite", db_path, "--format", "jsonl"] + list(args),
+                   cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    return load_js(out, use_cache=False)
+
+
+def actions(imgs) :
+    """Sorted actions of each image"""
+    return {img.id : (sorted((c.x, c.y, c.action.actorId) for c in img.clicks),
+                      sorted(a.actorId for a in img.notPvActions),
+                      sorted(tuple((pt.x, pt.y) for pt in p.points) for p in img.polygons))
+            for img in imgs}
+
+
+def test_incremental_export(tmp_path) :
+    db_path = str(tmp_path / "db.sqlite")
+    db = Db(db_path)
+    db.click(1, "2020-01-01 10:00:00", 1, 10, 20)
+    db.click(2, "2020-01-01 10:00:00", 1, 30, 40)
+    db.click(2, "2020-01-02 10:00:00", 2, 50, 60)
+    db.polygon(1, "2020-01-02 10:00:00", 2, [(100, 100), (200, 100), (200, 200)])
+
+    out = str(tmp_path / "out.jsonl")
+    assert len(export(db_path, out)) == 3
+    with open(out + ".watermark") as f :
+        assert json.load(f)["dateAction"] == "2020-01-02 10:00:00"
+
+    # Committed late, at the watermark date, and after it
+    db.click(3, "2020-01-02 10:00:00", 1, 70, 80)
+    db.click(1, "2020-01-03 10:00:00", 2, 15, 25, pv=0)
+    db.polygon(2, "2020-01-03 10:00:00", 1, [(10, 10), (20, 10), (20, 20)])
+
+    changed = str(tmp_path / "changed.txt")
+    merged = export(db_path, out, "--since", "last", "--changed", changed)
+    full = export(db_path, str(tmp_path / "full.jsonl"))
+
+    assert actions(merged) == actions(full)
+    with open(changed) as f :
+        assert sorted(f.read().split()) == ["img1", "img2", "img3"]
+    with open(out + ".watermark") as f :
+        assert json.load(f)["dateAction"] == "2020-01-03 10:00:00"
+
+
+def test_since_iso_date(tmp_path) :
+    db_path = str(tmp_path / "db.sqlite")
+    db = Db(db_path)
+    db.click(1, "2020-01-01 10:00:00", 1, 10, 20)
+
+    # Same date as given, with 'T' separator : still the latest one
+    out = str(tmp_path / "out.jsonl")
+    export(db_path, out, "--since", "2020-01-05T00:00:00")
+    with open(out + ".watermark") as f :
+        assert json.load(f)["dateAction"] == "2020-01-05 00:00:00"
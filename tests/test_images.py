@@ -0,0 +1,63 @@
+"""Local cache of images"""
+import os
+
+import numpy as np
+from matplotlib.image import imsave
+
+import lib.utils
+from lib.images import ImageCache, MANIFEST_FILE
+
+
+def write_image(cache, id) :
+    path = cache.path("google", "click", id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f :
+        f.write(b"png")
+    cache.add("google", "click", id)
+
+
+def manifest(cache) :
+    with open(os.path.join(cache.phase_folder("google", "click"), MANIFEST_FILE)) as f :
+        return f.read().split()
+
+
+def test_removed_image(tmp_path) :
+    cache = ImageCache(str(tmp_path))
+    for id in ("1", "2", "3") :
+        write_image(cache, id)
+    assert manifest(cache) == ["1", "2", "3"]
+
+    # Removal is appended : concurrent additions of other processes are kept
+    cache.remove("google", "click", "2")
+    other = ImageCache(str(tmp_path))
+    write_image(other, "4")
+    assert not cache.contains("google", "click", "2")
+    assert manifest(cache) == ["1", "2", "3", "-2", "4"]
+    assert ImageCache(str(tmp_path)).index("google", "click") == {"1", "3", "4"}
+
+    # Added again after its tombstone
+    write_image(cache, "2")
+    assert ImageCache(str(tmp_path)).index("google", "click") == {"1", "2", "3", "4"}
+
+
+def test_deleted_image(tmp_path, monkeypatch) :
+    """Images deleted from disk are fetched again when opening them fails"""
+    fetched = []
+
+    def fetch(url, params, out) :
+        fetched.append(url)
+        imsave(out, np.zeros((4, 4, 3)))
+
+    monkeypatch.setattr(lib.utils, "CACHE_FOLDER", str(tmp_path))
+    monkeypatch.setattr(lib.utils, "fetch", fetch)
+    lib.utils.DECODED_IMAGES.clear()
+
+    lib.utils.load_image("1", "google", "click")
+    assert len(fetched) == 1
+
+    os.remove(lib.utils.img_path("google", "click", "1"))
+    lib.utils.DECODED_IMAGES.clear()
+    assert lib.utils.load_image("1", "google", "click").shape[:2] == (4, 4)
+    assert len(fetched) == 2
+    assert ImageCache(str(tmp_path)).index("google", "click") == {"1"}
+    lib.utils.DECODED_IMAGES.clear()
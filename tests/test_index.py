@@ -0,0 +1,53 @@
+"""Id index of JSON files"""
+import pytest
+
+from lib.index import build_index, open_index
+from lib.model import ClickResult, Image
+from lib.synthetic import synthetic_images
+from lib.utils import ResultWriter, FORMAT_JSON, FORMAT_JSONL
+
+
+def write_file(path, items, format) :
+    writer = ResultWriter(open(path, "w"), format)
+    for item in items :
+        writer.write([item])
+    writer.close()
+
+
+def test_by_id_and_position(tmp_path) :
+    imgs = synthetic_images(5, clicks=3, polygons=1)
+    path = str(tmp_path / "images.json")
+    write_file(path, imgs, FORMAT_JSON)
+
+    index = open_index(path)
+    assert type(index["3"]) is Image and index["3"].id == "3"
+    assert list(img.id for img in index.lookup(["4", "1", "unknown"])) == ["1", "4"]
+
+    items = index.by_position()
+    assert len(items) == 5
+    assert items[2].id == "2" and items[-1].id == "4"
+    assert list(img.id for img in items[1:3]) == ["1", "2"]
+    assert list(img.id for img in items) == list(img.id for img in imgs)
+    with pytest.raises(IndexError) :
+        items[5]
+
+
+def test_last_item_of_id(tmp_path) :
+    """Several results of same id : index[id] is the last one, as with a dict built from the file"""
+    results = list(ClickResult("1", threshold) for threshold in (1.0, 2.0, 3.0))
+    path = str(tmp_path / "results.json")
+    write_file(path, results, FORMAT_JSON)
+
+    index = open_index(path)
+    assert index["1"].threshold == 3.0
+    assert list(res.threshold for res in index.get_all("1")) == [1.0, 2.0, 3.0]
+
+
+def test_json_lines(tmp_path) :
+    """Only JSON arrays are indexed : others are streamed"""
+    path = str(tmp_path / "images.jsonl")
+    write_file(path, synthetic_images(2, clicks=3, polygons=1), FORMAT_JSONL)
+
+    with pytest.raises(ValueError) :
+        build_index(path)
+    assert open_index(path) is None
@@ -0,0 +1,22 @@
+"""Background writes of the I/O stage"""
+import os
+
+import numpy as np
+import pytest
+
+from lib.io_stage import IOStage, write_png
+
+
+def test_failed_writes(tmp_path) :
+    image = np.zeros((4, 4, 3), np.uint8)
+    # Missing folder : cv2.imwrite() returns False
+    with pytest.raises(IOError) :
+        write_png(str(tmp_path / "missing" / "image.png"), image)
+
+    stage = IOStage()
+    stage.start(fetchers=1)
+    stage.write(write_png, str(tmp_path / "image.png"), image)
+    stage.write(write_png, str(tmp_path / "missing" / "image.png"), image)
+    stage.stop()
+    assert stage.take_errors() == 1
+    assert os.path.exists(str(tmp_path / "image.png"))
@@ -0,0 +1,90 @@
+"""Reading back files written by ResultWriter, in both formats"""
+import io
+import json
+
+from lib.cache import build_cache, open_cache
+from lib.model import encode, Image, Click, CompactImage
+from lib.synthetic import synthetic_images
+from lib.utils import JsonStream, ResultWriter, iter_js, load_js, FORMAT_JSON, FORMAT_JSONL
+
+
+def write_file(path, items, format, **kwargs) :
+    writer = ResultWriter(open(path, "w"), format, **kwargs)
+    for seq, item in enumerate(items) :
+        writer.write([item], seq)
+    writer.close()
+
+
+def dumps(items) :
+    return list(json.dumps(encode(item), sort_keys=True) for item in items)
+
+
+def test_jsonl_round_trip(tmp_path) :
+    imgs = synthetic_images(3, clicks=5, polygons=2)
+    path = str(tmp_path / "images.jsonl")
+    write_file(path, imgs, FORMAT_JSONL)
+
+    assert dumps(iter_js(path, use_cache=False)) == dumps(imgs)
+    assert dumps(load_js(path, use_cache=False)) == dumps(imgs)
+
+
+def test_json_round_trip(tmp_path) :
+    imgs = synthetic_images(3, clicks=5, polygons=2)
+    path = str(tmp_path / "images.json")
+    write_file(path, imgs, FORMAT_JSON, indent=2)
+
+    assert dumps(load_js(path, use_cache=False)) == dumps(imgs)
+
+
+def test_single_line_jsonl_is_a_list(tmp_path) :
+    imgs = synthetic_images(1, clicks=5, polygons=2)
+    path = str(tmp_path / "images.jsonl")
+    write_file(path, imgs, FORMAT_JSONL)
+
+    assert dumps(load_js(path, use_cache=False)) == dumps(imgs)
+
+
+def test_values_across_reads() :
+    # Small reads : values and numbers are split between chunks
+    text = "".join('{"a": %d, "b": [1.5, 2.25]}\n' % i for i in range(50)) + "12345"
+    values = list(JsonStream(io.StringIO(text), read_size=7, raw=True))
+    assert values == list({"a" : i, "b" : [1.5, 2.25]} for i in range(50)) + [12345]
+
+
+def test_single_document() :
+    stream = JsonStream(io.StringIO(' {"a": [1, 2]} '), raw=True)
+    assert list(stream) == [{"a" : [1, 2]}]
+    assert not stream.is_array
+
+
+def test_write_error_does_not_stall_ordered_output() :
+    imgs = synthetic_images(3, clicks=5, polygons=2)
+    out = io.StringIO()
+    out.close = lambda : None
+    writer = ResultWriter(out, FORMAT_JSONL, ordered=True)
+
+    writer.write([imgs[2]], 2)
+    # Not serializable
+    writer.write([object()], 0)
+    writer.write([imgs[1]], 1)
+    writer.close()
+
+    assert dumps(JsonStream(io.StringIO(out.getvalue()))) == dumps(imgs[1:])
+
+
+def test_binary_cache(tmp_path) :
+    """Images are read from the binary cache, as CompactImage only if asked"""
+    imgs = synthetic_images(3, clicks=5, polygons=2)
+    path = str(tmp_path / "images.json")
+    write_file(path, imgs, FORMAT_JSON)
+    build_cache(path, iter_js(path, compact=True, use_cache=False))
+    assert open_cache(path) is not None
+
+    loaded = load_js(path)
+    assert all(type(img) is Image for img in loaded)
+    assert dumps(loaded) == dumps(imgs)
+    loaded[0].clicks.append(Click(1, 2))
+    assert len(loaded[0].clicks) == 6
+
+    assert all(type(img) is CompactImage for img in iter_js(path, compact=True))
+    assert dumps(iter_js(path, compact=True)) == dumps(imgs)
@@ -0,0 +1,27 @@
+"""Archives of segmentation masks, in all formats"""
+
+import numpy as np
+import pytest
+
+from lib.masks import FORMATS, FORMAT_PNG, mask_writer, open_masks
+
+SHAPE = (40, 30)
+
+
+@pytest.mark.parametrize("format", FORMATS)
+def test_round_trip(tmp_path, format) :
+    rand = np.random.RandomState(0)
+    masks = list((rand.rand(*SHAPE) > 0.5).astype(np.uint8) for _ in range(5))
+    ids = list("img%d" % i for i in range(5))
+    path = str(tmp_path / "masks") if format == FORMAT_PNG else str(tmp_path / ("masks." + format))
+
+    with mask_writer(format, path, len(masks), SHAPE) as writer :
+        for idx, (id, mask) in enumerate(zip(ids, masks)) :
+            writer.write(idx, id, writer.encode(mask))
+
+    archive = open_masks(path)
+    assert len(archive) == 5
+    assert sorted(archive.ids) == ids
+    for id, mask in zip(ids, masks) :
+        assert np.array_equal(archive.get(id), mask)
+    archive.close()
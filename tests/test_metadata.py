@@ -0,0 +1,112 @@
+"""Filters of lib.metadata, against the row by row expressions of metadata.ipynb they replace"""
+import numpy as np
+import pandas as pd
+
+from lib import metadata
+from lib.model import Polygon, SurfaceResult, to_json
+from lib.utils import load_js
+
+GSD = 0.1
+
+
+def raw_table(nb=300) :
+    """Installations of random capacities (in W or kW), surfaces and tilts, including incoherent ones"""
+    rand = np.random.RandomState(0)
+    ids = rand.choice(np.arange(1, 50000), nb, replace=False)
+    ids[:len(metadata.NOT_RESCALED)] = metadata.NOT_RESCALED
+    surface = rand.uniform(1, 1000, nb).round(1)
+    surface[rand.randint(0, nb, 10)] = 0
+    kWp = (rand.uniform(0.5, 10, nb) * rand.choice([1, 1000, 100000], nb)).round(2)
+    kWp[rand.randint(0, nb, 10)] = 0
+    return pd.DataFrame(dict(
+        idInstallation=ids,
+        identifiant=list("img%d" % id for id in ids),
+        kWp=kWp,
+        surface=surface,
+        tilt=rand.uniform(-5, 80, nb).round(),
+        countArrays=rand.randint(0, 4, nb)))
+
+
+def write_results(table, filename) :
+    """Polygon analysis of the images : none, one or two polygons, of area close to the surface of the metadata or not"""
+    rand = np.random.RandomState(1)
+    results = []
+    for identifiant, surface, tilt in zip(table["identifiant"], table["surface"], table["tilt"]) :
+        nb_polygons = rand.choice([-1, 0, 1, 1, 1, 2])
+        if nb_polygons < 0 :
+            continue
+        res = SurfaceResult(identifiant)
+        target = surface * np.cos(tilt * np.pi / 180) / GSD ** 2
+        for i in range(nb_polygons) :
+            res.polygons.append(Polygon(score=1.0, area=float(target * rand.uniform(0.5, 1.5))))
+        results.append(res)
+    to_json(results, filename)
+
+
+def notebook_internal(table) :
+    """Internal consistency, as in metadata.ipynb"""
+    for key, (minimum, maximum) in metadata.BOUNDS.items() :
+        table['coherent_{}'.format(key)] = (table[key] < maximum) & (table[key] > minimum)
+    table['coherent_array'] = table['kWp'] / table['countArrays'] > metadata.MIN_CAPACITY
+    table['coherent'] = table['coherent_tilt'] * table['coherent_kWp'] * table['coherent_surface'] * table['coherent_countArrays'] * table['coherent_array']
+
+    table['rescaled'] = (table['kWp'] / 1000) / table['surface'] >= metadata.RESCALE_RATIO
+    table['rescaled_kWp'] = table['rescaled'] * 1000 * table['kWp'] + (1 - table["rescaled"]) * table['kWp']
+
+    for installation in metadata.NOT_RESCALED :
+        index = table[table['idInstallation'] == installation].index.item()
+        table.loc[index, 'rescaled_kWp'] = table.loc[index, 'kWp']
+
+    for index in table[(table['coherent'] == True) & (table['surface'] <= metadata.RESTORE_SURFACE_MAX) & (table['rescaled_kWp'] >= metadata.RESTORE_KWP_MIN)].index :
+        table.loc[index, 'rescaled_kWp'] = table.loc[index, 'kWp']
+
+    for index in table[(table['coherent'] == True) & (table['surface'] >= metadata.RESCALE_SURFACE_MIN) & (table['rescaled_kWp'] <= metadata.RESCALE_KWP_MAX)].index :
+        table.loc[index, 'rescaled_kWp'] = table.loc[index, 'kWp'] * 1000
+
+    table['true_kWp'] = table['rescaled_kWp'] / 1000
+    table['coherent_surface_kWp'] = True
+    for index in table[(table['coherent'] == True) & (table['surface'] <= metadata.INCOHERENT_SURFACE_MAX) & (table['true_kWp'] >= metadata.INCOHERENT_KWP_MIN)].index :
+        table.loc[index, 'coherent_surface_kWp'] = False
+
+    return table['coherent'] * table['coherent_surface_kWp']
+
+
+def notebook_external(table, filename, campaign) :
+    """External consistency, as in metadata.ipynb"""
+    res_polys = {r.id : r for r in load_js(filename, use_cache=False)}
+    unique = list(id in res_polys and len(res_polys[id].polygons) == 1 for id in table.identifiant)
+    areas = {r.id : sum(p.area for p in r.polygons) for r in res_polys.values()}
+
+    projection_items = []
+    for index in table[unique].index :
+        id = table.loc[index, 'identifiant']
+        est_proj = areas[id] * (GSD ** 2)
+        table_proj = table.loc[index, 'surface'] * np.cos(table.loc[index, 'tilt'] * np.pi / 180)
+        projection_items.append([id, est_proj, table_proj])
+
+    projection = pd.DataFrame(projection_items, columns=['identifiant', 'estimated', 'target'])
+    projection['ratio'] = projection['estimated'] / projection['target']
+
+    controlled = pd.Series(False, index=table.index)
+    for identifiant in projection[(projection['ratio'] < metadata.MAX_RATIO) & (projection['ratio'] > metadata.MIN_RATIO)]['identifiant'].values :
+        index = table[table['identifiant'] == identifiant].index
+        controlled[index] = table.loc[index, 'controlled'] * True
+    return projection, controlled
+
+
+def test_filters(tmp_path) :
+    filename = str(tmp_path / "polygon-analysis.json")
+    table = raw_table()
+    write_results(table, filename)
+
+    expected = notebook_internal(raw_table())
+    metadata.internal_consistency(table)
+    assert list(table["controlled"]) == list(expected.astype(bool))
+    assert 0 < table["controlled"].sum() < len(table)
+
+    projection = metadata.external_consistency(table, "Google", metadata.polygon_stats(filename), gsd=GSD)
+    expected_projection, expected_controlled = notebook_external(table.copy(), filename, "Google")
+    assert list(projection["identifiant"]) == list(expected_projection["identifiant"])
+    assert np.allclose(projection["ratio"], expected_projection["ratio"], rtol=1e-12, equal_nan=True)
+    assert list(table["GoogleControlled"]) == list(expected_controlled.astype(bool))
+    assert table["GoogleControlled"].sum() > 0
@@ -0,0 +1,66 @@
+"""Metrics report and Prometheus text output"""
+import json
+
+import click_analysis
+from lib.metrics import Metrics, METRICS
+from lib.model import to_json
+from lib.synthetic import synthetic_images
+
+
+def prometheus(metrics, tmp_path) :
+    path = str(tmp_path / "metrics.prom")
+    metrics.write_prometheus(path)
+    with open(path) as f :
+        return f.read().splitlines()
+
+
+def test_counters_and_histogram(tmp_path) :
+    metrics = Metrics()
+    metrics.enabled = True
+    for id, duration in (("a", 0.0015), ("b", 0.003), ("c", 0.3), ("d", 20)) :
+        metrics.add_image(id, duration)
+    metrics.add_time("density", 0.5)
+    metrics.add_time("density", 1.5)
+
+    report = metrics.report()
+    assert report["images"] == 4
+    assert report["stages"]["density"] == dict(count=2, total=2.0, mean=1.0, max=1.5)
+    assert list(item["id"] for item in report["slowest"]) == ["d", "c", "b", "a"]
+
+    lines = prometheus(metrics, tmp_path)
+    assert "bdappv_images_total 4.0" in lines
+    assert 'bdappv_stage_seconds_total{stage="density"} 2.0' in lines
+    assert 'bdappv_stage_calls_total{stage="density"} 2.0' in lines
+    assert "# TYPE bdappv_image_seconds histogram" in lines
+    # Cumulative buckets
+    assert 'bdappv_image_seconds_bucket{le="0.001"} 0' in lines
+    assert 'bdappv_image_seconds_bucket{le="0.002"} 1' in lines
+    assert 'bdappv_image_seconds_bucket{le="0.005"} 2' in lines
+    assert 'bdappv_image_seconds_bucket{le="0.5"} 3' in lines
+    assert 'bdappv_image_seconds_bucket{le="10"} 3' in lines
+    assert 'bdappv_image_seconds_bucket{le="+Inf"} 4' in lines
+    assert "bdappv_image_seconds_sum %r" % (0.0015 + 0.003 + 0.3 + 20) in lines
+    assert "bdappv_image_seconds_count 4" in lines
+
+
+def test_run_metrics(tmp_path) :
+    input_file = str(tmp_path / "in.json")
+    to_json(synthetic_images(5, clicks=20, polygons=1), input_file)
+    report_file = str(tmp_path / "report.json")
+    prom_file = str(tmp_path / "metrics.prom")
+    try :
+        click_analysis.main([input_file, str(tmp_path / "out.json"), "-q", "--metrics", report_file, "--metrics-prom", prom_file])
+    finally :
+        METRICS.enabled = False
+        METRICS.reset()
+
+    with open(report_file) as f :
+        report = json.load(f)
+    assert report["images"] == 5
+    assert sum(bucket["count"] for bucket in report["latency_histogram"]) == 5
+    assert report["stages"]["peaks"]["count"] == 5
+    with open(prom_file) as f :
+        lines = f.read().splitlines()
+    assert "bdappv_images_total 5.0" in lines
+    assert 'bdappv_image_seconds_bucket{le="+Inf"} 5' in lines
+    assert 'bdappv_stage_calls_total{stage="peaks"} 5.0' in lines
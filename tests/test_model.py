@@ -0,0 +1,106 @@
+"""Fast codec of lib.model, against the generic to_dict / parse_dict"""
+import json
+
+import numpy as np
+
+from lib.model import (Point, Action, Click, Polygon, Image, ClickResult, SurfaceResult, CompactImage, CLASSES,
+                       to_dict, parse_dict, encode, decode, parse_object, parse_compact, np_encoder)
+from lib.synthetic import synthetic_images
+
+
+def dumps(data) :
+    return json.dumps(data, default=np_encoder)
+
+
+def items() :
+    """Instances of all model classes, with optional fields set or not"""
+    imgs = synthetic_images(3, clicks=5, polygons=2)
+    imgs[0].notPvActions.append(Action("FR", "region-1", "2019-01-02T10:00:00", 3))
+
+    clicks = ClickResult("0")
+    clicks.clicks = [Point(10, 20, 3.5), Point(30, 40, np.float64(2.25))]
+    sweep = ClickResult("1", threshold=2.0)
+    sweep.clicks = [Point(np.int64(5), np.int64(6))]
+
+    polygon = Polygon(score=0.8, area=120.5)
+    polygon.points = [Point(1, 2), Point(3, 4), Point(5, 6)]
+    surfaces = SurfaceResult("0")
+    surfaces.polygons = [polygon]
+    empty = SurfaceResult("1", threshold=0.5)
+
+    return imgs + [clicks, sweep, surfaces, empty]
+
+
+def types(data) :
+    """@type of all nested objects of a JSON structure"""
+    if isinstance(data, list) :
+        return set().union(*(types(item) for item in data))
+    if isinstance(data, dict) :
+        return set([data["@type"]] if "@type" in data else []).union(*(types(val) for val in data.values()))
+    return set()
+
+
+def test_all_types() :
+    assert types(to_dict(items())) == set(CLASSES)
+
+
+def test_encode() :
+    data = items()
+    assert dumps(encode(data)) == dumps(to_dict(data))
+
+
+def test_parse_object() :
+    ref = dumps(to_dict(items()))
+    assert dumps(to_dict(json.loads(ref, object_hook=parse_object))) == ref
+    assert dumps(to_dict(parse_dict(json.loads(ref)))) == ref
+
+
+def test_compact_points() :
+    data = items()
+    ref = dumps(to_dict(data))
+    compact = dumps(encode(data, compact=True))
+
+    # Points of polygons and results are written as [x, y] or [x, y, score]
+    assert '"points": [[1, 2], [3, 4], [5, 6]]' in compact
+    assert '"clicks": [[10, 20, 3.5], [30, 40, 2.25]]' in compact
+    assert len(compact) < len(ref)
+
+    assert dumps(to_dict(json.loads(compact, object_hook=parse_object))) == ref
+    assert dumps(to_dict(decode(json.loads(compact)))) == ref
+
+
+def test_compact_image() :
+    data = items()
+    ref = dumps(to_dict(data))
+    loaded = json.loads(ref, object_hook=parse_compact)
+
+    assert all(type(item) is CompactImage for item in loaded[:3])
+    assert dumps(encode(loaded)) == ref
+    assert dumps(to_dict(list(item.to_image() if isinstance(item, CompactImage) else item for item in loaded))) == ref
+
+
+def test_model_classes() :
+    """Decoded objects are instances of their classes"""
+    ref = dumps(to_dict(items()))
+    loaded = json.loads(ref, object_hook=parse_object)
+    assert type(loaded[0]) is Image
+    assert type(loaded[0].clicks[0]) is Click
+    assert type(loaded[0].clicks[0].action) is Action
+    assert type(loaded[0].polygons[0]) is Polygon
+    assert type(loaded[0].polygons[0].points[0]) is Point
+    assert type(loaded[3]) is ClickResult
+    assert type(loaded[5]) is SurfaceResult
+
+
+def test_unknown_fields() :
+    """Fields of other versions of the model are ignored"""
+    text = dumps([{"@type" : "Image", "id" : "1", "clicks" : [{"@type" : "Click", "x" : 1, "y" : 2, "color" : "red"}], "source" : "test"},
+                  {"@type" : "Polygon", "points" : [[1, 2]], "label" : "roof"}])
+    for loaded in (json.loads(text, object_hook=parse_object), parse_dict(json.loads(text)), decode(json.loads(text))) :
+        assert loaded[0].id == "1"
+        assert not hasattr(loaded[0], "source")
+        assert (loaded[0].clicks[0].x, loaded[0].clicks[0].y) == (1, 2)
+        assert not hasattr(loaded[1], "label")
+
+    img = json.loads(text, object_hook=parse_compact)[0]
+    assert list(img.click_x) == [1]
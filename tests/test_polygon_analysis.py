@@ -0,0 +1,54 @@
+"""Polygons accumulated and scored within their bounding box, against the full frame computation"""
+import cv2
+import numpy as np
+
+import polygon_analysis
+from lib.model import Action, Point, Polygon
+from lib.synthetic import synthetic_images
+
+# Polygons crossing the border of the image, or touching it
+BORDER_POLYGONS = [
+    [(-20, -10), (80, -5), (70, 60), (-5, 50)],
+    [(330, 200), (399, 190), (399, 300), (340, 290)],
+    [(150, 350), (250, 340), (260, 420), (140, 410)]]
+
+
+def full_frame_matrix(img) :
+    """Accumulation of a full frame mask per polygon, as done before bounding boxes"""
+    matrix = np.zeros((polygon_analysis.WIDTH, polygon_analysis.HEIGHT))
+    for pts in img.polygon_points() :
+        poly_img = np.zeros((polygon_analysis.WIDTH, polygon_analysis.HEIGHT), np.uint8)
+        cv2.fillPoly(poly_img, [pts.astype(np.int32)], 1)
+        matrix += poly_img
+    return cv2.blur(matrix, (3, 3))
+
+
+def full_frame_score(matrix, points) :
+    poly_mask = np.zeros((polygon_analysis.WIDTH, polygon_analysis.HEIGHT), np.int8)
+    cv2.fillPoly(poly_mask, [polygon_analysis.points2cv2(points)], 1)
+    return np.sum(matrix * poly_mask) / np.sum(poly_mask)
+
+
+def images() :
+    imgs = synthetic_images(10, clicks=5, polygons=8)
+    for img in imgs :
+        for actor in range(5) :
+            for points in BORDER_POLYGONS :
+                poly = Polygon(Action("FR", "region", "2020-01-01T00:00:00", 100 + actor))
+                poly.points = list(Point(x + actor, y) for x, y in points)
+                img.polygons.append(poly)
+    return imgs
+
+
+def test_bbox_accumulation() :
+    border = 0
+    for img in images() :
+        matrix = polygon_analysis.accumulate_polygons(img)
+        assert np.array_equal(matrix, full_frame_matrix(img))
+
+        res, thres, threshold = polygon_analysis.extract_polygons(img.id, matrix, 0.3, len(set(img.polygon_actors())))
+        assert len(res.polygons) > 0
+        for poly in res.polygons :
+            assert np.isclose(poly.score, full_frame_score(matrix, poly.points), rtol=1e-12)
+            border += any(pt.x in (0, 399) or pt.y in (0, 399) for pt in poly.points)
+    assert border > 0
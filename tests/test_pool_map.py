@@ -0,0 +1,46 @@
+"""Bounded submission of tasks to a process pool"""
+import multiprocessing
+import time
+
+import pytest
+
+from lib.utils import pool_map
+
+
+def square(x) :
+    # Later tasks end first
+    time.sleep(0.01 * (5 - x % 5))
+    return x * x
+
+
+def fail(x) :
+    if x == 3 :
+        raise ValueError("task %d" % x)
+    return x
+
+
+def test_pool_map() :
+    read = []
+
+    def tasks() :
+        for x in range(20) :
+            read.append(x)
+            yield x
+
+    with multiprocessing.Pool(2) as pool :
+        results = []
+        for value in pool_map(pool, square, tasks(), 4, ordered=True) :
+            # Tasks read ahead of results : max_pending submitted, and the next one
+            assert len(read) <= len(results) + 5
+            results.append(value)
+        assert results == list(x * x for x in range(20))
+
+        assert sorted(pool_map(pool, square, range(20), 3)) == list(x * x for x in range(20))
+
+
+def test_worker_error() :
+    """Errors of workers are raised while tasks are still pending, and the pool terminates"""
+    with pytest.raises(ValueError) :
+        with multiprocessing.Pool(2) as pool :
+            for value in pool_map(pool, fail, iter(range(1000)), 2) :
+                pass
@@ -0,0 +1,75 @@
+"""Retries of the image downloader, against a local HTTP server"""
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from lib.prefetch import Downloader, FetchError
+
+
+class Handler(BaseHTTPRequestHandler) :
+    """Answers the status given by the path : /404, /503... Path /flaky fails once"""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) :
+        self.server.requests[self.path] += 1
+        status = int(self.path[1:]) if self.path[1:].isdigit() else 200
+        if self.path == "/flaky" and self.server.requests[self.path] == 1 :
+            status = 503
+        body = b"data"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) :
+        pass
+
+
+@pytest.fixture
+def server() :
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.requests = Counter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path) :
+    return "http://127.0.0.1:%d%s" % (server.server_address[1], path)
+
+
+def test_client_errors_fail_at_once(server) :
+    downloader = Downloader(retries=3, backoff=0.01)
+    with pytest.raises(FetchError) as error :
+        downloader.get(url(server, "/404"))
+    assert error.value.status == 404
+    assert server.requests["/404"] == 1
+
+
+def test_server_errors_are_retried(server) :
+    downloader = Downloader(retries=2, backoff=0.01)
+    with pytest.raises(FetchError) :
+        downloader.get(url(server, "/503"))
+    assert server.requests["/503"] == 3
+
+    assert downloader.get(url(server, "/flaky")) == b"data"
+    assert server.requests["/flaky"] == 2
+
+
+def test_close_all(server) :
+    downloader = Downloader()
+    threads = list(threading.Thread(target=downloader.get, args=(url(server, "/ok"),)) for _ in range(3))
+    for thread in threads :
+        thread.start()
+    for thread in threads :
+        thread.join()
+
+    opened = list(downloader.opened)
+    assert len(opened) == 3
+    downloader.close_all()
+    assert not downloader.opened
+    assert all(conn.sock is None for conn in opened)
@@ -0,0 +1,46 @@
+"""Batches and timing of images in main_process"""
+import pytest
+
+import click_analysis
+from lib.metrics import METRICS
+from lib.model import ClickResult
+from lib.result_cache import ResultCache
+from lib.synthetic import synthetic_images
+from lib.utils import process_batch, timed
+
+
+def batch_function(imgs, threshold=None) :
+    """Fails on batches of several images"""
+    if len(imgs) > 1 :
+        raise Exception("Batch failure")
+    return list(ClickResult(img.id, threshold) for img in imgs)
+
+
+def test_fallback_uses_cache(tmp_path) :
+    imgs = synthetic_images(3, clicks=5, polygons=1)
+    cache = ResultCache(str(tmp_path), dict(version=1))
+
+    res = process_batch(batch_function, imgs, None, dict(threshold=2.0), cache)
+    assert list(outs[0].id for outs in res) == ["0", "1", "2"]
+    assert all(outs[0].threshold == 2.0 for outs in res)
+
+    # Results of images processed one at a time are cached
+    for img in imgs :
+        assert cache.get(cache.key(img))[0].id == img.id
+
+
+def test_timed_none_items() :
+    """None items, as null values of a JSON array, do not end the stream"""
+    METRICS.enabled = True
+    try :
+        assert list(timed([1, None, 2], "load")) == [1, None, 2]
+    finally :
+        METRICS.enabled = False
+        METRICS.reset()
+
+
+def test_batch_engine(tmp_path) :
+    """Batches use the separable engine : other engines are rejected"""
+    with pytest.raises(SystemExit) as error :
+        click_analysis.main(["in.json", str(tmp_path / "out.json"), "--batch-size", "8", "--engine", "coarse"])
+    assert error.value.code == 2
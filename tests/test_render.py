@@ -0,0 +1,43 @@
+"""Headless rendering of diagnostic images"""
+import numpy as np
+
+import click_analysis
+import polygon_analysis
+from lib import render
+from lib.synthetic import synthetic_images
+
+
+def source_image() :
+    """Black RGBA image, as read by load_image()"""
+    image = np.zeros((400, 400, 4), np.float32)
+    image[:, :, 3] = 1
+    return image
+
+
+def check_image(res) :
+    assert res.dtype == np.uint8
+    assert res.ndim == 3 and res.shape[2] == 3
+    assert res.shape[0] > 400 and res.shape[1] > 800
+    assert np.count_nonzero(res) > 0
+
+
+def test_click_plot() :
+    img = synthetic_images(1, clicks=30, polygons=1)[0]
+    res, threshold, matrix = click_analysis.analyse(img, plot=True)
+    click_x, click_y = img.click_coords()
+    args = click_analysis.plot_args(matrix, click_x, click_y, res.clicks, threshold)
+
+    out = render.click_plot(source_image(), *args)
+    check_image(out)
+    # Clicks are drawn in red over the black source image
+    assert np.any(np.all(out == render.RED, axis=2))
+
+
+def test_polygon_plot() :
+    img = synthetic_images(1, clicks=5, polygons=6)[0]
+    matrix = polygon_analysis.accumulate_polygons(img)
+    annotations = list(pts.astype(np.int32) for pts in img.polygon_points())
+
+    out = render.polygon_plot(source_image(), matrix, annotations, annotations[:1], 0.45)
+    check_image(out)
+    assert np.any(np.all(out == render.BLUE, axis=2))
@@ -0,0 +1,86 @@
+"""On disk cache of analysis results"""
+import argparse
+import os
+import time
+
+import click_analysis
+from lib.model import ClickResult, Point
+from lib.result_cache import ResultCache
+from lib.synthetic import synthetic_images
+
+
+def result(img) :
+    res = ClickResult(img.id)
+    res.clicks = [Point(10, 20, 3.5)]
+    return [res]
+
+
+def test_hits_and_misses(tmp_path) :
+    cache = ResultCache(str(tmp_path), dict(version=1))
+    img = synthetic_images(1, clicks=5, polygons=1)[0]
+    key = cache.key(img)
+
+    assert cache.get(key) is None
+    cache.put(key, result(img))
+    outs = cache.get(key)
+    assert (outs[0].id, outs[0].clicks[0].x, outs[0].clicks[0].score) == (img.id, 10, 3.5)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.take_counts() == (1, 1)
+    assert (cache.hits, cache.misses) == (0, 0)
+
+    # Edited annotations : new key
+    img.clicks.pop()
+    assert cache.key(img) != key
+
+
+def test_key_params(monkeypatch) :
+    img = synthetic_images(1, clicks=5, polygons=1)[0]
+    args = argparse.Namespace(threshold=2.0, thresholds=None, engine=click_analysis.ENGINE_AUTO, batch_size=1)
+
+    def key() :
+        return ResultCache("unused", click_analysis.cache_params(args)).key(img)
+
+    ref = key()
+    assert key() == ref
+
+    args.threshold = 3.0
+    assert key() != ref
+    args.threshold = 2.0
+
+    args.engine = click_analysis.ENGINE_DENSE
+    assert key() != ref
+    args.engine = click_analysis.ENGINE_AUTO
+
+    monkeypatch.setattr(click_analysis, "VERSION", click_analysis.VERSION + 1)
+    assert key() != ref
+
+
+def test_eviction(tmp_path) :
+    imgs = synthetic_images(4, clicks=5, polygons=1)
+    cache = ResultCache(str(tmp_path), dict(version=1), max_size=1, max_age=30)
+    keys = list(cache.key(img) for img in imgs)
+    for img, key in zip(imgs, keys) :
+        cache.put(key, result(img))
+
+    # Unused for 40 days, or last used among entries above the maximum size
+    now = time.time()
+    os.utime(cache.path(keys[0]), (now - 40 * 24 * 3600,) * 2)
+    for idx in (1, 2, 3) :
+        os.utime(cache.path(keys[idx]), (now - idx,) * 2)
+
+    def cached() :
+        return list(idx for idx, key in enumerate(keys) if os.path.exists(cache.path(key)))
+
+    assert cache.evict() == 1
+    assert cached() == [1, 2, 3]
+
+    # Least recently used first
+    cache.max_size = 2.5 * os.path.getsize(cache.path(keys[1])) / (1 << 20)
+    assert cache.evict() == 1
+    assert cached() == [1, 2]
+
+    # Used entries are kept
+    cache.get(keys[2])
+    cache.max_size = 1.5 * os.path.getsize(cache.path(keys[1])) / (1 << 20)
+    assert cache.evict() == 1
+    assert cached() == [2]
@@ -0,0 +1,34 @@
+"""Threshold sweeps of both analyses, against one run per threshold"""
+import json
+
+import pytest
+
+import click_analysis
+import polygon_analysis
+from lib.model import to_json
+from lib.synthetic import synthetic_images
+
+
+def results(path) :
+    """Results of an output file, without their threshold tag"""
+    with open(path) as f :
+        data = json.load(f)
+    for result in data :
+        result.pop("threshold", None)
+    return data
+
+
+@pytest.mark.parametrize("analysis, thresholds", [(click_analysis, [2.0, 4.0, 0.2]), (polygon_analysis, [0.3, 0.45, 0.6])])
+def test_sweep_files(tmp_path, analysis, thresholds) :
+    input_file = str(tmp_path / "in.json")
+    to_json(synthetic_images(10, clicks=30, polygons=6), input_file)
+
+    sweep = str(tmp_path / "sweep-{threshold}.json")
+    analysis.main([input_file, sweep, "--thresholds", ",".join(map(str, thresholds)), "-q"])
+
+    for threshold in thresholds :
+        single = str(tmp_path / "single.json")
+        analysis.main([input_file, single, "-t", str(threshold), "-q"])
+        expected = results(single)
+        assert len(expected) > 0
+        assert results(sweep.format(threshold=threshold)) == expected